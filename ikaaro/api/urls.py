@@ -24,7 +24,11 @@ from views import ApiDevPanel_ResourceJSON, ApiDevPanel_ResourceRaw, ApiDevPanel
 from views import ApiDevPanel_ClassidViewDetails, ApiDevPanel_ClassidViewList
 from views import ApiDevPanel_Config, ApiDevPanel_Log
 from views import ApiDevPanel_CatalogReindex, UUIDView
+from views import ApiDevPanel_JobList, ApiDevPanel_JobView
+from views import ApiDevPanel_JobResult, ApiDevPanel_JobCancel
 from views import ApiDevPanel_ServerView, ApiDevPanel_ServerStop
+from views import ApiDevPanel_Metrics, ApiDevPanel_RateLimit
+from views import ApiDevPanel_ProfileList, ApiDevPanel_ProfileDownload
 
 
 urlpatterns = [
@@ -44,9 +48,22 @@ urlpatterns = [
     urlpattern('/devpanel/log/access', ApiDevPanel_Log(source_name='access')),
     urlpattern('/devpanel/log/events', ApiDevPanel_Log(source_name='events')),
     urlpattern('/devpanel/log/update', ApiDevPanel_Log(source_name='update')),
+    urlpattern('/devpanel/log/slow', ApiDevPanel_Log(source_name='slow')),
+    urlpattern('/devpanel/log/extraction',
+               ApiDevPanel_Log(source_name='extraction')),
     # Catalog
     urlpattern('/devpanel/catalog/reindex', ApiDevPanel_CatalogReindex),
+    # Jobs
+    urlpattern('/devpanel/jobs', ApiDevPanel_JobList),
+    urlpattern('/devpanel/jobs/{id}', ApiDevPanel_JobView),
+    urlpattern('/devpanel/jobs/{id}/result', ApiDevPanel_JobResult),
+    urlpattern('/devpanel/jobs/{id}/cancel', ApiDevPanel_JobCancel),
     # Server
     urlpattern('/devpanel/server', ApiDevPanel_ServerView),
     urlpattern('/devpanel/server/stop', ApiDevPanel_ServerStop),
+    urlpattern('/devpanel/metrics', ApiDevPanel_Metrics),
+    urlpattern('/devpanel/ratelimit', ApiDevPanel_RateLimit),
+    # Profiling
+    urlpattern('/devpanel/profile', ApiDevPanel_ProfileList),
+    urlpattern('/devpanel/profile/{name}', ApiDevPanel_ProfileDownload),
 ]
@@ -24,8 +24,12 @@ from itools.web.exceptions import NotFound, Forbidden, Unauthorized
 from itools.web.views import ItoolsView
 
 # Import from ikaaro
+from ikaaro.database import get_graph_values, get_handler_path
+from ikaaro.database import open_handler_file
 from ikaaro.fields import Boolean_Field, Char_Field, Integer_Field
 from ikaaro.fields import Email_Field, Password_Field, Datetime_Field
+from ikaaro.jobs import register_job
+from ikaaro.logtail import read_log
 from ikaaro.server import get_config
 from ikaaro.utils import get_resource_by_uuid_query
 
@@ -184,6 +188,10 @@ class ApiDevPanel_ResourceRaw(UUIDView):
         resource = self.get_resource(context)
         metadata = resource.metadata
         context.set_content_type('text/plain')
+        # Send the file as it is on the disk, if not modified
+        path = get_handler_path(context.database, metadata)
+        if path is not None:
+            return open_handler_file(path)
         return metadata.to_str()
 
 
@@ -273,24 +281,33 @@ class Api_LoginView(Api_View):
 
 
 class ApiDevPanel_Log(Api_View):
-    """ Return the dump of a log file
+    """ Return the last lines of a log file (the X-Log-Offset header tells
+    where to read the next lines from, with "since")
     """
 
     access = 'is_admin'
     source_name = None
     known_methods = ['GET']
+    query_schema = {
+        'tail': Integer_Field(title=MSG(u'Number of lines (default 1000)')),
+        'since': Integer_Field(title=MSG(u'Offset to read the lines from')),
+        'grep': Char_Field(title=MSG(u'Only the lines with this text')),
+    }
+
+    # Number of lines to send, if not told
+    default_tail = 1000
 
     def GET(self, root, context):
+        source = '{t}/log/{s}'.format(
+            t=context.server.target, s=self.source_name)
+        query = context.query
+        tail = query.get('tail')
+        since = query.get('since')
+        if not tail and since is None:
+            tail = self.default_tail
+        offset, data = read_log(source, since, tail, query.get('grep') or None)
         context.set_content_type('text/plain')
-        try:
-            source = '{t}/log/{s}'.format(
-                t=context.server.target, s=self.source_name)
-            log_file = open(source, 'r')
-        except IOError:
-            return ''
-        context.set_content_type('text/plain')
-        data = log_file.read()
-        log_file.close()
+        context._set_header('X-Log-Offset', str(offset))
         return data
 
 
@@ -302,9 +319,159 @@ class ApiDevPanel_CatalogReindex(Api_View):
     access = 'is_admin'
     known_methods = ['POST']
 
+    response_schema = {
+        'job': Char_Field(title=MSG(u'Id of the job, see /api/devpanel/jobs')),
+    }
+
+    def POST(self, root, context):
+        user = context.user.name if context.user else None
+        job_id = context.server.jobs.add('reindex_catalog',
+                                         u'Reindex the catalog', user=user)
+        kw = {'job': job_id}
+        return self.return_json(kw, context)
+
+
+
+def reindex_catalog(context, job, base_abspath='/'):
+    """Reindex the resources in the base path, return the number of
+    resources reindexed (the job of ApiDevPanel_CatalogReindex).
+    """
+    database = context.database
+    base_resource = database.get_resource(base_abspath, soft=True)
+    if base_resource is None:
+        return {'n': 0}
+    catalog = database.catalog
+    # The database may change while the job is paused (see Job.progress),
+    # so the resources are found again by path
+    paths = [ x.abspath for x in base_resource.traverse_resources() ]
+    total = len(paths)
+    # Forget the text of the documents not found, on full reindex (unless the
+    # text is indexed later, see ikaaro.textindex)
+    server = context.server
+    text_cache = server.text_cache
+    if base_abspath != '/' or server.text_indexer is not None:
+        text_cache = None
+    if text_cache is not None:
+        text_cache.start_sweep()
+    indexed = []
+    try:
+        for i, path in enumerate(paths):
+            resource = database.get_resource(path, soft=True)
+            if resource is not None:
+                values = resource.get_catalog_values()
+                catalog.index_document(values)
+                indexed.append(get_graph_values(values))
+            job.progress(i + 1, total)
+    except Exception:
+        if text_cache is not None:
+            text_cache.used = None
+        raise
+    database.save_catalog_changes()
+    database.update_graphs(indexed)
+    if text_cache is not None:
+        text_cache.end_sweep()
+    return {'n': len(indexed)}
+
+register_job('reindex_catalog', reindex_catalog)
+
+
+
+class ApiDevPanel_JobList(Api_View):
+    """ List the background jobs, the last queued first
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+    response_schema = {
+        'id': Char_Field(title=MSG(u'Id of the job')),
+        'name': Char_Field(title=MSG(u'Name of the job')),
+        'title': Char_Field(title=MSG(u'Title of the job')),
+        'user': Char_Field(title=MSG(u'User who queued the job')),
+        'status': Char_Field(title=MSG(
+            u'queued, running, done, failed, cancelled or interrupted')),
+        'done': Integer_Field(title=MSG(u'Steps done')),
+        'total': Integer_Field(title=MSG(u'Steps to do, if known')),
+        'created': Char_Field(title=MSG(u'Time of the queuing (timestamp)')),
+        'finished': Char_Field(title=MSG(u'Time of the end (timestamp)')),
+        'error': Char_Field(title=MSG(u'Error, if the job failed')),
+    }
+
+    def GET(self, root, context):
+        jobs = context.server.jobs.get_jobs()
+        return self.return_json(jobs, context)
+
+
+
+class ApiDevPanel_JobView(Api_View):
+    """ Status of a background job (for the admins and the user who queued
+    it)
+    """
+
+    access = True
+    known_methods = ['GET']
+    path_query_schema = {
+        'id': Char_Field(title=MSG(u'Id of the job'))
+    }
+    response_schema = ApiDevPanel_JobList.response_schema
+
+    def get_job(self, root, context):
+        job = context.server.jobs.get_job(context.path_query['id'])
+        if job is None:
+            raise NotFound
+        user = context.user
+        if user is None:
+            raise Unauthorized
+        if job['user'] != user.name and not root.is_admin(user, root):
+            raise Forbidden
+        return job
+
+
+    def GET(self, root, context):
+        job = self.get_job(root, context)
+        return self.return_json(job, context)
+
+
+
+class ApiDevPanel_JobResult(ApiDevPanel_JobView):
+    """ Result of a background job, once done: a file or JSON
+    """
+
+    response_schema = {}
+
+    def GET(self, root, context):
+        job = self.get_job(root, context)
+        if job['status'] != 'done':
+            raise NotFound
+        if job['result_type'] is None:
+            return self.return_json(job['result'], context)
+        path = context.server.jobs.get_path(job['id'], 'result')
+        try:
+            data = open(path, 'rb')
+        except IOError:
+            raise NotFound
+        context.set_content_type(job['result_type'])
+        if job['result_name']:
+            context.set_content_disposition('attachment', job['result_name'])
+        return data
+
+
+
+class ApiDevPanel_JobCancel(Api_View):
+    """ Cancel a background job: it is stopped at its next step, the
+    changes done since its last commit are lost
+    """
+
+    access = 'is_admin'
+    known_methods = ['POST']
+    path_query_schema = {
+        'id': Char_Field(title=MSG(u'Id of the job'))
+    }
+
     def POST(self, root, context):
-        n = context.database.reindex_catalog(base_abspath='/')
-        kw = {'n': n}
+        job = context.server.jobs.cancel(context.path_query['id'])
+        if job is None:
+            raise NotFound
+        kw = {'success': True}
         return self.return_json(kw, context)
 
 
@@ -318,18 +485,116 @@ class ApiDevPanel_ServerView(Api_View):
     response_schema = {
         'timestamp': Char_Field(title=MSG(u"Server's start timestamp")),
         'pid': Integer_Field(title=MSG(u"Server's PID")),
-        'port': Integer_Field(title=MSG(u"Server's port"))
+        'port': Integer_Field(title=MSG(u"Server's port")),
+        'catalog_reopen_count': Integer_Field(
+            title=MSG(u"Number of times the catalog has been reopened")),
+        'catalog_reopen_time': Char_Field(
+            title=MSG(u"Time spent reopening the catalog (seconds)")),
     }
 
     def GET(self, root, context):
         server = context.server
         kw = {'timestamp': server.timestamp,
               'pid': getpid(),
-              'port': server.port}
+              'port': server.port,
+              'catalog_reopen_count': server.catalog_reopen_count,
+              'catalog_reopen_time': server.catalog_reopen_time}
         return self.return_json(kw, context)
 
 
 
+class ApiDevPanel_Metrics(Api_View):
+    """ Time spent by the requests in each phase, by view, state of the
+    admission control, of the mail spool, of the deferred full-text
+    indexing, of the text extraction and of its cache, resources reindexed
+    because they depend on others (Prometheus text format)
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+
+    def GET(self, root, context):
+        context.set_content_type('text/plain', version='0.0.4')
+        server = context.server
+        text = (server.request_metrics.to_text() +
+                server.admission.to_text() +
+                server.mail_spool.to_text() +
+                server.dependencies.to_text())
+        if server.text_indexer is not None:
+            text += server.text_indexer.to_text()
+        if server.text_extractor is not None:
+            text += server.text_extractor.to_text()
+        if server.text_cache is not None:
+            text += server.text_cache.to_text()
+        return text
+
+
+
+class ApiDevPanel_RateLimit(Api_View):
+    """ Counters of the rate limiting, by rule (see "rate-limit-*" in
+    config.conf)
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+    response_schema = {
+        'name': Char_Field(title=MSG(u'Name of the rule')),
+        'rate': Char_Field(title=MSG(u'Requests per minute')),
+        'burst': Integer_Field(title=MSG(u'Requests at once')),
+        'allowed': Integer_Field(title=MSG(u'Requests allowed')),
+        'limited': Integer_Field(title=MSG(u'Requests refused')),
+        'clients': Integer_Field(title=MSG(u'Clients being counted')),
+    }
+
+    def GET(self, root, context):
+        stats = context.server.rate_limiter.get_stats()
+        return self.return_json(stats, context)
+
+
+
+class ApiDevPanel_ProfileList(Api_View):
+    """ List the profiles of the requests (see "profile-*" in config.conf)
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+    response_schema = {
+        'name': Char_Field(title=MSG(u'Name of the profile')),
+        'size': Integer_Field(title=MSG(u'Size of the file (bytes)')),
+        'mtime': Char_Field(title=MSG(u'Time of the request (timestamp)')),
+    }
+
+    def GET(self, root, context):
+        files = context.server.profiler.get_files()
+        return self.return_json(files, context)
+
+
+
+class ApiDevPanel_ProfileDownload(Api_View):
+    """ Download the profile of a request (pstats format)
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+    path_query_schema = {
+        'name': Char_Field(title=MSG(u'Name of the profile'))
+    }
+
+    def GET(self, root, context):
+        name = context.path_query['name']
+        path = context.server.profiler.get_file_path(name)
+        if path is None:
+            raise NotFound
+        try:
+            data = open(path, 'rb')
+        except IOError:
+            raise NotFound
+        context.set_content_type('application/octet-stream')
+        context.set_content_disposition('attachment', '%s.prof' % name)
+        return data
+
+
+
 class ApiDevPanel_ServerStop(Api_View):
     """ Stop the web server
     """
@@ -37,11 +37,71 @@ from itools.uri import normalize_path
 from itools.uri import decode_query, get_reference, Path, Reference
 from itools.web.context import get_form_value
 from itools.web import ERROR
+from itools.web.exceptions import BadRequest
 from itools.web.headers import get_type, Cookie, SetCookieDataType
 from itools.web.utils import NewJSONEncoder, fix_json, reason_phrases
 
 # Import from ikaaro
+from exceptions import RequestEntityTooLarge
 from skins import skin_registry
+from web.multipart import MultipartParser
+from web.uploads import get_upload_id
+
+
+def read_body(environ, server):
+    """Reads the body of the request and decodes it.  The values of the file
+    fields of the multipart bodies are (filename, mimetype, body) where body
+    is a file-like object (see ikaaro.web.multipart.UploadedFile).
+    """
+    # Get content type
+    value = environ.get('CONTENT_TYPE')
+    try:
+        content_type, type_parameters = get_type('content-type').decode(value)
+    except Exception:
+        content_type, type_parameters = (value or ''), {}
+    # The size of the body is limited
+    length = int(environ.get('CONTENT_LENGTH', '0') or 0)
+    max_size = server.max_upload_size
+    if max_size and length > max_size:
+        raise RequestEntityTooLarge
+    # Case 1: nothing
+    if not length:
+        return {}
+    # Case 2: multipart, read in chunks (files may be spooled to disk)
+    if content_type.startswith('multipart/'):
+        boundary = type_parameters.get('boundary')
+        if not boundary:
+            raise BadRequest
+        # Progress of the upload (see ProgressBarWidget)
+        upload_id = get_upload_id(environ)
+        on_read = None
+        if upload_id is not None:
+            upload_stats = server.upload_stats
+            upload_stats.start(upload_id, length)
+            on_read = lambda size: upload_stats.update(upload_id, size)
+        parser = MultipartParser(environ['wsgi.input'], length, boundary,
+                                 server.upload_spool_threshold,
+                                 max_size=max_size, on_read=on_read)
+        try:
+            return parser.parse()
+        finally:
+            if upload_id is not None:
+                upload_stats.finish(upload_id)
+    body = environ['wsgi.input'].read(length)
+    if not body:
+        return {}
+    # XXX
+    if content_type == 'application/x-www-form-urlencoded':
+        # Case 3: urlencoded
+        return decode_query(body)
+    elif content_type == 'application/json':
+        # Case 4: json
+        return fix_json(json.loads(body))
+    elif content_type.startswith('application/'):
+        return {'body': body}
+    # Case 5: Not managed content type
+    raise ValueError('Invalid content type "{0}"'.format(content_type))
+
 
 
 class CMSContext(prototype):
@@ -49,6 +109,8 @@ class CMSContext(prototype):
     accept_language = AcceptLanguageType.decode('')
     body = {}
     commit = True
+    timings = None
+    search_count = 0
     content_type = None
     cookies = {}
     database = None
@@ -80,7 +142,7 @@ class CMSContext(prototype):
     # WSGI environ
     #######################################################################
 
-    def init_from_environ(self, environ, user=None):
+    def init_from_environ(self, environ, user=None, body=None):
         from server import get_server
         # Set environ
         self.environ = environ
@@ -97,8 +159,9 @@ class CMSContext(prototype):
         self.root = self.database.get_resource('/')
         # The request method
         self.method = environ.get('REQUEST_METHOD')
-        # Get body
-        self.body = self.get_body_from_environ()
+        # Get body (read already if the database lock is held, see
+        # ikaaro.web.wsgi)
+        self.body = self.get_body_from_environ() if body is None else body
         # The query
         query = environ.get('QUERY_STRING')
         self.query = decode_query(query)
@@ -373,8 +436,8 @@ class CMSContext(prototype):
             self.status = 302
             self.set_header('Location', location)
             return
-        # Never cache if status != 200
-        if self.mtime and self.status != 200:
+        # Never cache if status != 200 (or 206, a part of the entity)
+        if self.mtime and self.status not in (200, 206):
             self.set_header('Last-Modified', self.mtime)
             self.set_header('Cache-Control', 'max-age=1')
 
@@ -461,81 +524,8 @@ class CMSContext(prototype):
         return self.get_form().keys()
 
 
-    def get_form_body(self, body):
-        return decode_query(body)
-
-
-    def get_json_body(self, body):
-        data = json.loads(body)
-        return fix_json(data)
-
-
     def get_body_from_environ(self):
-        # Get content type
-        response = self.get_header('content-type')
-        try:
-            content_type, type_parameters = response
-        except:
-            content_type = response
-        # Case 1: nothing
-        length = int(self.environ.get('CONTENT_LENGTH', '0') or 0)
-        body = self.environ['wsgi.input'].read(length)
-        if not body:
-            return {}
-        # XXX
-        if content_type == 'application/x-www-form-urlencoded':
-            # Case 1: urlencoded
-            return self.get_form_body(body)
-        elif content_type == 'application/json':
-            # Case 2: json
-            return self.get_json_body(body)
-        elif content_type.startswith('multipart/'):
-            # Case 3: multipart
-            return self.get_multipart_body(body)
-        elif content_type.startswith('application/'):
-            return {'body': body}
-        # Case 4: Not managed content type
-        raise ValueError('Invalid content type "{0}"'.format(content_type))
-
-
-    def get_multipart_body(self, body):
-        from itools.web.entities import Entity
-        content_type, type_parameters = self.get_header('content-type')
-        boundary = type_parameters.get('boundary')
-        boundary = '--%s' % boundary
-        form = {}
-        for part in body.split(boundary)[1:-1]:
-            # Parse the entity
-            entity = Entity(string=part)
-            # Find out the parameter name
-            header = entity.get_header('Content-Disposition')
-            value, header_parameters = header
-            name = header_parameters['name']
-            # Load the value
-            body = entity.get_body()
-            if 'filename' in header_parameters:
-                filename = header_parameters['filename']
-                if filename:
-                    # Strip the path (for IE).
-                    filename = filename.split('\\')[-1]
-                    # Default content-type, see
-                    # http://tools.ietf.org/html/rfc2045#section-5.2
-                    if entity.has_header('content-type'):
-                        mimetype = entity.get_header('content-type')[0]
-                    else:
-                        mimetype = 'text/plain'
-                    form[name] = filename, mimetype, body
-                else:
-                    form[name] = None
-            else:
-                if name not in form:
-                    form[name] = body
-                else:
-                    if isinstance(form[name], list):
-                        form[name].append(body)
-                    else:
-                        form[name] = [form[name], body]
-        return form
+        return read_body(self.environ, self.server)
 
     #######################################################################
     # ACL API
@@ -16,40 +16,271 @@
 
 # Import from standard library
 from copy import deepcopy
+from datetime import datetime
+from os import makedirs, rename
+from os.path import dirname, exists, getmtime, isabs, isfile
+from shutil import copyfileobj
+from time import time
+from weakref import WeakKeyDictionary
 
 # Import from gevent
-from gevent.lock import BoundedSemaphore
+from gevent import getcurrent, sleep, spawn
+from gevent.event import Event
+from greenlet import settrace
 
 # Import from itools
 from itools.database import RWDatabase, RODatabase as BaseRODatabase
+from itools.database import ReadonlyError
+from itools.database.rw import MSG_URI_IS_BUSY
 from itools.database import OrQuery, PhraseQuery, AndQuery
+from itools.log import log_error
 from itools.uri import Path
 from itools.web import get_context, set_context
 
+# Import from ikaaro
+from metrics import add_timing, count_search
+
+
+
+class ReadWriteLock(object):
+    """Readers/writer lock for greenlets.
+
+    Any number of greenlets may hold the lock for reading at the same time,
+    while a writer has an exclusive access.  Waiting writers have priority
+    over new readers, so a steady flow of GET requests cannot starve the
+    write transactions.
+    """
+
+    def __init__(self):
+        self.readers = set()
+        self.writer = None
+        self.waiting_writers = 0
+        self.released = Event()
+
+
+    def _wait(self):
+        self.released.wait()
+
+
+    def _notify(self):
+        # Wake up everybody waiting, and start a new generation
+        released = self.released
+        self.released = Event()
+        released.set()
+
+
+    def acquire(self, write=True):
+        current = getcurrent()
+        if current in self.readers or self.writer is current:
+            raise ValueError('The lock is already held by this greenlet')
+        if write:
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self._wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = current
+        else:
+            while self.writer is not None or self.waiting_writers:
+                self._wait()
+            self.readers.add(current)
+
+
+    def release(self):
+        current = getcurrent()
+        if self.writer is current:
+            self.writer = None
+        elif current in self.readers:
+            self.readers.discard(current)
+            if self.readers:
+                return
+        else:
+            raise ValueError('The lock is not held by this greenlet')
+        self._notify()
+
+
+    def is_reader(self):
+        return getcurrent() in self.readers
+
+
+DBSEM = ReadWriteLock()
+
+
+
+###########################################################################
+# One context per greenlet
+###########################################################################
+contexts = WeakKeyDictionary()
+
+def switch_context(event, args):
+    """Greenlet tracer that swaps the itools global context on every switch,
+    so concurrent readers each keep their own context.
+    """
+    if event in ('switch', 'throw'):
+        origin, target = args
+        contexts[origin] = get_context()
+        set_context(contexts.pop(target, None))
+    if previous_tracer is not None:
+        previous_tracer(event, args)
+
+
+previous_tracer = None
+def install_context_tracer():
+    global previous_tracer
+    previous_tracer = settrace(switch_context)
+
+
+
+###########################################################################
+# Catalog generation
+###########################################################################
+def get_generation_path(path):
+    return '%s/catalog.generation' % path
+
+
+def get_catalog_generation(path):
+    """Return the number of commits done on the database at 'path', by any
+    process.  Readers use it to know whether they must reopen the catalog.
+    """
+    try:
+        with open(get_generation_path(path)) as f:
+            return int(f.read() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def set_catalog_generation(path, generation):
+    generation_path = get_generation_path(path)
+    tmp_path = '%s.tmp' % generation_path
+    with open(tmp_path, 'w') as f:
+        f.write(str(generation))
+    # Atomic
+    rename(tmp_path, generation_path)
+
+
+def bump_catalog_generation(path):
+    """Tell the readers (other processes) the catalog of the database at
+    'path' has changed.
+    """
+    set_catalog_generation(path, get_catalog_generation(path) + 1)
+
+
+
+class WriteLockRequired(ReadonlyError):
+    """Raised when a greenlet holding the database lock for reading tries to
+    change the database (see check_write_lock).
+    """
+
+
+
+def check_write_lock():
+    """The changes of the transaction (the handlers changed, the resources
+    to index...) are kept by the database, shared by all the greenlets
+    holding the lock; so only the writer may change it.  The readers are
+    stopped before they change anything, and their context is told
+    (context.write_lock_required) so the request is served again with the
+    lock for writing (see ikaaro.web.wsgi).
+    """
+    if DBSEM.is_reader():
+        context = get_context()
+        if context is not None:
+            context.write_lock_required = True
+        raise WriteLockRequired('the database lock is held for reading')
 
-DBSEM = BoundedSemaphore(1)
 
 
 class RODatabase(BaseRODatabase):
 
-    def init_context(self, user=None, username=None, email=None, commit_at_exit=True):
+    def search(self, query=None, **kw):
+        count_search()
+        return super(RODatabase, self).search(query, **kw)
+
+
+    #######################################################################
+    # Only the writer changes the database (see check_write_lock)
+    #######################################################################
+    def set_handler(self, key, handler):
+        check_write_lock()
+        return super(RODatabase, self).set_handler(key, handler)
+
+
+    def del_handler(self, key):
+        check_write_lock()
+        return super(RODatabase, self).del_handler(key)
+
+
+    def touch_handler(self, key, handler=None):
+        check_write_lock()
+        return super(RODatabase, self).touch_handler(key, handler)
+
+
+    def copy_handler(self, source, target, exclude_patterns=None):
+        check_write_lock()
+        proxy = super(RODatabase, self)
+        return proxy.copy_handler(source, target, exclude_patterns)
+
+
+    def move_handler(self, source, target):
+        check_write_lock()
+        return super(RODatabase, self).move_handler(source, target)
+
+
+    def add_resource(self, resource):
+        check_write_lock()
+        return super(RODatabase, self).add_resource(resource)
+
+
+    def remove_resource(self, resource):
+        check_write_lock()
+        return super(RODatabase, self).remove_resource(resource)
+
+
+    def change_resource(self, resource):
+        check_write_lock()
+        return super(RODatabase, self).change_resource(resource)
+
+
+    def move_resource(self, source, new_path):
+        check_write_lock()
+        return super(RODatabase, self).move_resource(source, new_path)
+
+
+    def init_context(self, user=None, username=None, email=None,
+                     commit_at_exit=True, write_lock=False,
+                     group_commit=False):
         from ikaaro.context import CMSContext
         root = self.get_resource('/', soft=True)
         cls = root.context_cls if root else CMSContext
-        return ContextManager(cls, self)
+        return ContextManager(cls, self, write_lock=write_lock)
 
 
 
 class ContextManager(object):
 
-    def __init__(self, cls, database, user=None, username=None, email=None, commit_at_exit=True):
+    def __init__(self, cls, database, user=None, username=None, email=None,
+                 commit_at_exit=True, write_lock=True, group_commit=False):
         # Check if context is not already locked
         if get_context() != None:
             raise ValueError('Cannot acquire context. Already locked.')
-        # Acquire lock on database
-        DBSEM.acquire()
+        # Acquire lock on database (shared for readers, exclusive for writers)
+        t0 = time()
+        DBSEM.acquire(write=write_lock)
+        # Only the requests may join a group commit, the others commit the
+        # group first (see Database.save_changes_in_group).  The readers go
+        # on with the changes of the group, in the handlers cache, but not
+        # yet in the catalog
+        if write_lock and not group_commit:
+            if getattr(database, 'group', None) is not None:
+                try:
+                    database.flush_group()
+                except Exception:
+                    DBSEM.release()
+                    raise
         from server import get_server
         self.context = cls()
+        self.context.timings = {'lock_wait': time() - t0}
+        self.context.group_commit = group_commit
         self.context.database = database
         self.context.server = get_server()
         self.commit_at_exit = commit_at_exit
@@ -81,7 +312,10 @@ class ContextManager(object):
             if self.commit_at_exit:
                 self.context.database.save_changes()
             else:
-                if self.context.database.has_changed:
+                database = self.context.database
+                # The changes of a group commit are committed later
+                group = getattr(database, 'group', None)
+                if database.has_changed and group is None:
                     msg = 'Warning: Some changes have not been commited'
                     print(msg)
         except Exception:
@@ -94,6 +328,108 @@ class ContextManager(object):
 
 
 
+def pause_context(context):
+    """Commit the changes done so far and let the greenlets waiting for the
+    database in, then take the lock back.  This is for the long-running
+    jobs (see ikaaro.jobs), that must not hold the lock all the time.
+    """
+    database = context.database
+    database.save_changes()
+    database.save_catalog_changes()
+    set_context(None)
+    DBSEM.release()
+    sleep(0)
+    DBSEM.acquire(write=True)
+    database.flush_group()
+    set_context(context)
+
+
+
+###########################################################################
+# Group commit
+###########################################################################
+def encode(value):
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    return value
+
+
+
+class CommitGroup(object):
+    """The write transactions to be committed together (see
+    Database.save_changes).
+    """
+
+    def __init__(self):
+        self.t0 = time()
+        self.transactions = []
+        self.event = Event()
+        self.error = None
+        # The handlers of the group changed by the current transaction, as
+        # they were before: {key: (handler, copy)}, the copy is None if the
+        # group did not change the handler (see Database.undo_handlers)
+        self.undo = {}
+
+
+    def __len__(self):
+        return len(self.transactions)
+
+
+    def add(self, data):
+        """Add the data of a transaction, as returned by
+        Database._before_commit
+        """
+        self.transactions.append(data)
+        self.undo = {}
+
+
+    def get_data(self):
+        """Merge the data of the transactions.  The Git commit is made by the
+        author of the first transaction; its message tells the author and
+        the message of every transaction, and the other authors are given
+        as co-authors.
+        """
+        transactions = self.transactions
+        if len(transactions) == 1:
+            return transactions[0]
+
+        docs_to_index = {}
+        docs_to_unindex = set()
+        authors = []
+        lines = []
+        for git_author, git_date, git_msg, to_index, to_unindex in transactions:
+            for path in to_unindex:
+                docs_to_index.pop(path, None)
+                docs_to_unindex.add(path)
+            for resource, values in to_index:
+                docs_to_index[str(resource.abspath)] = (resource, values)
+            author = tuple([ encode(x) for x in git_author ])
+            if author not in authors:
+                authors.append(author)
+            git_msg = encode(git_msg) or 'no comment'
+            lines.append('%s <%s>: %s' % (author[0], author[1], git_msg))
+
+        git_msg = ['Group commit of %d transactions' % len(transactions), '']
+        git_msg.extend(lines)
+        if len(authors) > 1:
+            git_msg.append('')
+            for author in authors[1:]:
+                git_msg.append('Co-authored-by: %s <%s>' % author)
+        return (transactions[0][0], transactions[-1][1], '\n'.join(git_msg),
+                docs_to_index.values(), list(docs_to_unindex))
+
+
+    def wait(self):
+        """Wait for the group to be committed, return False if it failed.
+        """
+        self.event.wait()
+        return self.error is None
+
+
+    def done(self, error=None):
+        self.error = error
+        self.event.set()
+
 
 
 
@@ -102,14 +438,353 @@ class Database(RWDatabase):
     """Adds a Git archive to the itools database.
     """
 
-    def init_context(self, user=None, username=None, email=None, commit_at_exit=True):
+    # Told of the time events of the resources indexed, see ikaaro.scheduler
+    scheduler = None
+
+    # The dependencies between the resources, to find out those to reindex
+    # (see ikaaro.dependencies), the catalog is searched if not loaded
+    dependencies = None
+
+    # The resources reindexed by the commit being prepared because they
+    # depend on others changed, see _before_commit
+    cascaded = 0
+
+    # Group commit: the write transactions of the requests that follow each
+    # other within "commit_window" seconds are committed together (at most
+    # "commit_group_size" of them), see save_changes
+    commit_window = 0
+    commit_group_size = 20
+    group = None
+
+    def init_context(self, user=None, username=None, email=None,
+                     commit_at_exit=True, write_lock=True,
+                     group_commit=False):
         from ikaaro.context import CMSContext
         root = self.get_resource('/', soft=True)
         cls = root.context_cls if root else CMSContext
         return ContextManager(cls,
             database=self, user=user,
             username=username, email=email,
-            commit_at_exit=commit_at_exit)
+            commit_at_exit=commit_at_exit,
+            write_lock=write_lock,
+            group_commit=group_commit)
+
+
+    def search(self, query=None, **kw):
+        count_search()
+        return super(Database, self).search(query, **kw)
+
+
+    #######################################################################
+    # Only the writer changes the database (see check_write_lock), and the
+    # group is committed first if the changes cannot be undone alone (see
+    # undo_handlers)
+    #######################################################################
+    def set_handler(self, key, handler):
+        check_write_lock()
+        self.flush_group_first()
+        return super(Database, self).set_handler(key, handler)
+
+
+    def del_handler(self, key):
+        check_write_lock()
+        self.flush_group_first()
+        return super(Database, self).del_handler(key)
+
+
+    def set_handler_from_file(self, key, file):
+        """Same as set_handler, for a new file whose content is read from
+        the given file-like object: it is copied to the database, not
+        loaded in memory (the handler is loaded when used).
+        """
+        check_write_lock()
+        self.flush_group_first()
+        key = self.normalize_key(key)
+        if self._get_handler(key, soft=True) is not None:
+            raise RuntimeError, MSG_URI_IS_BUSY % key
+
+        path = self.fs.get_absolute_path(key)
+        folder = dirname(path)
+        if not exists(folder):
+            makedirs(folder)
+        file.seek(0)
+        with open(path, 'wb') as target:
+            copyfileobj(file, target)
+        self.added.add(key)
+        # Changed
+        self.removed.discard(key)
+        self.has_changed = True
+
+
+    def touch_handler(self, key, handler=None):
+        check_write_lock()
+        group = self.group
+        if group is not None:
+            key = self.normalize_key(key)
+            if handler is None:
+                handler = self._get_handler(key)
+            if self.is_phantom(handler):
+                self.flush_group_first()
+            elif key not in group.undo:
+                copy = handler.clone() if handler.dirty else None
+                group.undo[key] = (handler, copy)
+        return super(Database, self).touch_handler(key, handler)
+
+
+    def copy_handler(self, source, target, exclude_patterns=None):
+        check_write_lock()
+        self.flush_group_first()
+        proxy = super(Database, self)
+        return proxy.copy_handler(source, target, exclude_patterns)
+
+
+    def move_handler(self, source, target):
+        check_write_lock()
+        self.flush_group_first()
+        return super(Database, self).move_handler(source, target)
+
+
+    def add_resource(self, resource):
+        check_write_lock()
+        return super(Database, self).add_resource(resource)
+
+
+    def remove_resource(self, resource):
+        check_write_lock()
+        return super(Database, self).remove_resource(resource)
+
+
+    def change_resource(self, resource):
+        check_write_lock()
+        return super(Database, self).change_resource(resource)
+
+
+    def move_resource(self, source, new_path):
+        check_write_lock()
+        return super(Database, self).move_resource(source, new_path)
+
+
+    #######################################################################
+    # Commit
+    #######################################################################
+    def save_changes(self, *args, **kw):
+        # The readers have no changes of their own (see check_write_lock),
+        # those of the database are not theirs to commit
+        if DBSEM.is_reader():
+            return
+        has_changed = self.has_changed
+        context = get_context()
+        if self.group is not None or self.can_group_commit(context):
+            return self.save_changes_in_group(context)
+        # Time spent in the commit, but for _before_commit (see metrics)
+        timings = getattr(context, 'timings', None) or {}
+        before_commit = timings.get('before_commit', 0.0)
+        t0 = time()
+        proxy = super(Database, self)
+        result = proxy.save_changes(*args, **kw)
+        # Tell the readers (other processes) the catalog has changed
+        if has_changed:
+            bump_catalog_generation(self.path)
+            before_commit = timings.get('before_commit', 0.0) - before_commit
+            add_timing('commit', time() - t0 - before_commit, context)
+        return result
+
+
+    def save_catalog_changes(self):
+        """Save the changes made to the catalog out of a commit (the
+        documents reindexed directly), and tell the readers.
+        """
+        self.catalog.save_changes()
+        bump_catalog_generation(self.path)
+
+
+    def abort_changes(self):
+        # Nor to abort
+        if DBSEM.is_reader():
+            return
+        # Keep the changes of the group
+        if self.group is not None:
+            return self.undo_changes()
+        proxy = super(Database, self)
+        return proxy.abort_changes()
+
+
+    #######################################################################
+    # Group commit
+    #######################################################################
+    def can_group_commit(self, context):
+        return bool(self.commit_window and self.has_changed and
+                    getattr(context, 'group_commit', False))
+
+
+    def has_own_changes(self):
+        """Tell whether the current transaction has changed the database
+        (and not only the transactions of the group before it).
+        """
+        group = self.group
+        return bool(self.resources_old2new or self.resources_new2old or
+                    (group is not None and group.undo))
+
+
+    def undo_changes(self):
+        """Abort the changes of the current transaction, but keep those of
+        the group before it.
+        """
+        self.undo_handlers()
+        self.catalog.abort_changes()
+        self.resources_old2new.clear()
+        self.resources_new2old.clear()
+
+
+    def undo_handlers(self):
+        """Set back the handlers of the group changed by the current
+        transaction.  Only the handlers changed in place can be (see
+        touch_handler), the other changes commit the group first (see
+        flush_group_first).
+        """
+        group = self.group
+        for key, (handler, copy) in group.undo.iteritems():
+            if copy is None:
+                handler.abort_changes()
+                self.changed.discard(key)
+            else:
+                set_handler_state(handler, copy)
+        group.undo = {}
+
+
+    def flush_group_first(self):
+        """Commit the group before the current transaction changes the
+        database in a way that cannot be undone alone.  The handlers it
+        has changed so far are set apart meanwhile, so they are not
+        committed with the group.
+        """
+        group = self.group
+        if group is None:
+            return
+        changes = [ (key, handler, handler.clone())
+                    for key, (handler, copy) in group.undo.iteritems() ]
+        self.undo_handlers()
+        self.flush_group()
+        # Back to the changes of the transaction
+        proxy = super(Database, self)
+        for key, handler, copy in changes:
+            if key not in self.cache:
+                self.push_handler(key, handler)
+            proxy.touch_handler(key, handler)
+            set_handler_state(handler, copy)
+
+
+    def save_changes_in_group(self, context):
+        """Prepare the commit of the transaction, then commit it with the
+        transactions of the group, now or when the last one is done.
+        Meanwhile the transaction is told of the group (context.commit_group)
+        to wait for it (see ikaaro.web.wsgi).
+
+        Each transaction is prepared with its own context (mtime,
+        last_author), but the Git commit and the catalog are saved once for
+        all of them.  The transactions of the requests waiting for the
+        database join the group, until the window is over or the group is
+        full.  A transaction that fails or aborts does not join it (see
+        undo_changes).
+        """
+        group = self.group or CommitGroup()
+        if not group or self.has_own_changes():
+            try:
+                data = self._before_commit()
+            except Exception:
+                log_error('Transaction failed', domain='itools.database')
+                # The transactions of the group are not concerned
+                if self.group is not None:
+                    self.undo_changes()
+                    raise
+                try:
+                    self._abort_changes()
+                except Exception:
+                    log_error('Aborting failed', domain='itools.database')
+                self._cleanup()
+                raise
+            group.add(data)
+
+        # Wait for the next transactions, if any
+        if (getattr(context, 'group_commit', False) and DBSEM.waiting_writers
+                and len(group) < self.commit_group_size
+                and time() - group.t0 < self.commit_window):
+            if self.group is None:
+                self.group = group
+                spawn(self.flush_later, group)
+            context.commit_group = group
+            return
+
+        self.group = None
+        self.commit_group(group)
+
+
+    def commit_group(self, group):
+        has_changed = self.has_changed
+        t0 = time()
+        try:
+            self._save_changes(group.get_data())
+        except Exception, error:
+            log_error('Transaction failed', domain='itools.database')
+            try:
+                self._abort_changes()
+            except Exception:
+                log_error('Aborting failed', domain='itools.database')
+            group.done(error)
+            raise
+        finally:
+            self._cleanup()
+        # Tell the readers (other processes) the catalog has changed
+        if has_changed:
+            bump_catalog_generation(self.path)
+            add_timing('commit', time() - t0)
+        group.done()
+
+
+    def flush_group(self):
+        """Commit the transactions of the group, if any.
+        """
+        group = self.group
+        if group is not None:
+            self.group = None
+            self.commit_group(group)
+
+
+    def flush_later(self, group):
+        # Commit the group at the end of the window, if not yet done
+        sleep(self.commit_window)
+        if self.group is not group:
+            return
+        DBSEM.acquire(write=True)
+        try:
+            if self.group is group:
+                self.flush_group()
+        except Exception:
+            log_error('Group commit failed', domain='itools.database')
+        finally:
+            DBSEM.release()
+
+
+    #######################################################################
+    # Batch: the changes of many steps committed together (see
+    # Server.cron_manager), a failing step is undone alone
+    #######################################################################
+    def start_batch_step(self):
+        """Start a step of the batch, its changes are kept apart from those
+        of the steps before (see undo_changes) until save_batch_step.
+        """
+        if self.group is None:
+            self.group = CommitGroup()
+
+
+    def save_batch_step(self):
+        """Prepare the commit of the changes of the step, they are committed
+        with the batch (see flush_group).  If this fails, the changes of
+        the step are to be aborted (see abort_changes).
+        """
+        self.start_batch_step()
+        if self.has_own_changes():
+            self.group.add(self._before_commit())
 
 
     def close(self):
@@ -119,6 +794,7 @@ class Database(RWDatabase):
 
 
     def _before_commit(self):
+        t0 = time()
         root = self.get_resource('/')
         context = get_context()
         if context.database != self:
@@ -142,22 +818,11 @@ class Database(RWDatabase):
 
         # 2. Find out resources to re-index because they depend on another
         # resource that changed
-        to_reindex = set()
-        aux = set()
-        aux2 = set(self.resources_old2new.keys())
-        while len(aux) != len(aux2):
-            aux = set(aux2)
-            # XXX we regroup items by 200 because Xapian is slow
-            # when there's too much items in OrQuery
-            l_aux = list(aux)
-            for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
-                query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
-                query = OrQuery(*query)
-                search = self.search(query)
-                for brain in search.get_documents():
-                    path = brain.abspath
-                    aux2.add(path)
-                    to_reindex.add(path)
+        dependencies = self.dependencies
+        if dependencies is not None:
+            to_reindex = dependencies.get_dependents(self.resources_old2new)
+        else:
+            to_reindex = self.search_dependents(self.resources_old2new)
 
         # 3. Documents to unindex (the update_links methods calls
         # 'change_resource' which may modify the resources_old2new dictionary)
@@ -212,9 +877,97 @@ class Database(RWDatabase):
 
         # Ok
         git_date = context.fix_tzinfo(context.timestamp)
+        # Counted once committed (see _save_changes)
+        self.cascaded += len(to_reindex)
+        add_timing('before_commit', time() - t0, context)
         return git_author, git_date, git_msg, docs_to_index, docs_to_unindex
 
 
+    def _save_changes(self, data):
+        # The files changed are written to a new file, then renamed over the
+        # old one, so the responses still sending the old one (see
+        # open_handler_file) are not changed
+        cache = self.cache
+        for key in list(self.added) + list(self.changed):
+            handler = cache.get(key)
+            if handler is not None and handler.dirty:
+                self.replace_handler_file(handler)
+        super(Database, self)._save_changes(data)
+        # Once committed, keep the dependencies and the time events
+        # up-to-date
+        docs_to_index, docs_to_unindex = data[3:]
+        if self.dependencies is not None:
+            self.dependencies.count(self.cascaded)
+        indexed = [ get_graph_values(values) for resource, values
+                    in docs_to_index ]
+        self.update_graphs(indexed, docs_to_unindex)
+
+
+    def replace_handler_file(self, handler):
+        """Save the handler to a new file, renamed over the file it replaces
+        (if any, the new files are saved by itools).
+        """
+        path = get_key_path(self, handler.key)
+        if path is None:
+            return
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as file:
+            handler.save_state_to_file(file)
+        rename(tmp_path, path)
+        handler.timestamp = datetime.fromtimestamp(getmtime(path))
+        handler.dirty = None
+
+
+    def _cleanup(self):
+        super(Database, self)._cleanup()
+        self.cascaded = 0
+
+
+    def update_graphs(self, indexed, unindexed=()):
+        """Update the dependencies between the resources (see
+        ikaaro.dependencies) and their time events (see ikaaro.scheduler),
+        once the resources are indexed and the catalog saved.  The
+        resources indexed are given by get_graph_values, the resources
+        unindexed by path.
+        """
+        dependencies = self.dependencies
+        scheduler = self.scheduler
+        for abspath, onchange_reindex, next_time_event in indexed:
+            if dependencies is not None:
+                dependencies.update(abspath, onchange_reindex)
+            if scheduler is not None:
+                scheduler.update(abspath, next_time_event)
+        for path in unindexed:
+            if dependencies is not None:
+                dependencies.remove(path)
+            if scheduler is not None:
+                scheduler.remove(path)
+
+
+    def search_dependents(self, paths):
+        """Return the resources depending, directly or not, on the given
+        resources, searching the catalog (when the dependencies are not
+        loaded, see ikaaro.dependencies).
+        """
+        to_reindex = set()
+        aux = set()
+        aux2 = set(paths)
+        while len(aux) != len(aux2):
+            aux = set(aux2)
+            # XXX we regroup items by 200 because Xapian is slow
+            # when there's too much items in OrQuery
+            l_aux = list(aux)
+            for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
+                query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
+                query = OrQuery(*query)
+                search = self.search(query)
+                for brain in search.get_documents():
+                    path = brain.abspath
+                    aux2.add(path)
+                    to_reindex.add(path)
+        return to_reindex
+
+
     def get_dynamic_classes(self):
         search = self.search(base_classes='-model')
         for brain in search.get_documents():
@@ -223,6 +976,67 @@ class Database(RWDatabase):
 
 
 
+def get_graph_values(values):
+    """Return the values of the resource (see DBResource.get_catalog_values)
+    kept by the database out of the catalog (see Database.update_graphs).
+    """
+    return (values['abspath'], values.get('onchange_reindex'),
+            values.get('next_time_event'))
+
+
+
+def set_handler_state(handler, copy):
+    """Set the state of the handler back to that of the copy (see
+    File.clone).
+    """
+    exclude = handler.clone_exclude
+    for name in [ x for x in handler.__dict__ if x not in exclude ]:
+        delattr(handler, name)
+    for name, value in copy.__dict__.iteritems():
+        if name not in exclude:
+            setattr(handler, name, value)
+
+
+
+def get_handler_path(database, handler):
+    """Return the path of the file behind the handler, to read it directly
+    (without loading it in memory).  Return None if the handler has been
+    modified in the current transaction, or if it is not a file of the
+    database.
+    """
+    key = handler.key
+    if not key or handler.dirty:
+        return None
+    return get_key_path(database, key)
+
+
+
+def get_key_path(database, key):
+    """Return the path of the file of the database with the given key, or
+    None if there is no such file.
+    """
+    if isabs(key) and isfile(key):
+        return key
+    # Since 0.78 the files live in 'database_static', see Root.update_to_078
+    key = key.lstrip('/')
+    for folder in ('database_static', 'database'):
+        path = '%s/%s/%s' % (database.path.rstrip('/'), folder, key)
+        if isfile(path):
+            return path
+    return None
+
+
+
+def open_handler_file(path):
+    """Open the file at 'path' (see get_handler_path) for reading, to send
+    it once the lock is released (see ikaaro.web.wsgi).  The commits do not
+    rewrite the files in place but replace them (see
+    Database.replace_handler_file), so the file open is not changed.
+    """
+    return open(path, 'rb')
+
+
+
 def get_database(path, size_min, size_max, read_only=False, backend='git'):
     if read_only is True:
         return RODatabase(path, size_min, size_max, backend=backend)
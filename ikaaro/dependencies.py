@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The resources to reindex when another resource changes (see
+DBResource.get_onchange_reindex).
+
+The dependencies are kept in memory, both ways: the resources every resource
+depends on, and the resources depending on every resource.  They are loaded
+from the 'onchange_reindex' field of the catalog at start, and updated once
+the resources indexed are committed (see Database.update_graphs).  So
+finding the resources to reindex is a walk through the graph, not a catalog
+search.
+"""
+
+# Import from the Standard Library
+from collections import deque
+
+# Import from itools
+from itools.database import PhraseQuery
+
+
+def get_targets(value):
+    """Return the paths (a set of byte strings) from the value of the
+    'onchange_reindex' field.
+    """
+    if not value:
+        return set()
+    if type(value) is str:
+        return set([value])
+    return set([ str(x) for x in value ])
+
+
+
+class DependencyGraph(object):
+
+    def __init__(self):
+        # The resources every resource depends on: {abspath: set(abspath)}
+        self.targets = {}
+        # The resources depending on every resource: {abspath: set(abspath)}
+        self.dependents = {}
+        # Stats
+        self.commits = 0
+        self.cascaded = 0
+        self.last_cascaded = 0
+        self.max_cascaded = 0
+
+
+    def load(self, database):
+        """Load the dependencies from the catalog.
+        """
+        catalog = database.catalog
+        for target in catalog.get_unique_values('onchange_reindex'):
+            query = PhraseQuery('onchange_reindex', target)
+            for brain in database.search(query).get_documents():
+                self.add(brain.abspath, target)
+
+
+    def add(self, abspath, target):
+        self.targets.setdefault(abspath, set()).add(target)
+        self.dependents.setdefault(target, set()).add(abspath)
+
+
+    def update(self, abspath, value):
+        """Set the resources the given resource depends on, from the value
+        of its 'onchange_reindex' field.
+        """
+        targets = get_targets(value)
+        old_targets = self.targets.get(abspath, set())
+        if targets == old_targets:
+            return
+        for target in old_targets - targets:
+            self.discard(abspath, target)
+        for target in targets - old_targets:
+            self.add(abspath, target)
+
+
+    def discard(self, abspath, target):
+        targets = self.targets.get(abspath)
+        if targets is not None:
+            targets.discard(target)
+            if not targets:
+                del self.targets[abspath]
+        dependents = self.dependents.get(target)
+        if dependents is not None:
+            dependents.discard(abspath)
+            if not dependents:
+                del self.dependents[target]
+
+
+    def remove(self, abspath):
+        """Forget the dependencies of the given resource (removed).  Those
+        of the other resources on it are kept, they may be reindexed.
+        """
+        for target in list(self.targets.get(abspath, ())):
+            self.discard(abspath, target)
+
+
+    def get_dependents(self, paths):
+        """Return the resources depending, directly or not, on the given
+        resources.
+        """
+        dependents = self.dependents
+        found = set()
+        seen = set(paths)
+        queue = deque(seen)
+        while queue:
+            for path in dependents.get(queue.popleft(), ()):
+                found.add(path)
+                if path not in seen:
+                    seen.add(path)
+                    queue.append(path)
+        return found
+
+
+    #######################################################################
+    # Metrics
+    #######################################################################
+    def count(self, cascaded):
+        """Count the resources reindexed by a commit because they depend on
+        the resources changed.
+        """
+        self.commits += 1
+        self.cascaded += cascaded
+        self.last_cascaded = cascaded
+        self.max_cascaded = max(self.max_cascaded, cascaded)
+
+
+    def to_text(self):
+        """Return the stats, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, value, help in [
+            ('ikaaro_onchange_reindex_resources', 'gauge', len(self.targets),
+             'Resources depending on others.'),
+            ('ikaaro_onchange_reindex_commits_total', 'counter', self.commits,
+             'Commits.'),
+            ('ikaaro_onchange_reindex_total', 'counter', self.cascaded,
+             'Resources reindexed because they depend on others changed.'),
+            ('ikaaro_onchange_reindex_last', 'gauge', self.last_cascaded,
+             'Resources reindexed by the last commit because they depend on '
+             'others changed.'),
+            ('ikaaro_onchange_reindex_max', 'gauge', self.max_cascaded,
+             'Resources reindexed by a single commit, at most, because they '
+             'depend on others changed.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, value))
+        lines.append('')
+        return '\n'.join(lines)
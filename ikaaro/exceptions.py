@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from itools
+from itools.web.exceptions import ClientError
+
 
 # TODO Move this exception to itools
 class ParserError(StandardError):
@@ -23,3 +26,9 @@ class ParserError(StandardError):
 # TODO Move this exception to itools
 class ConsistencyError(StandardError):
     pass
+
+
+# TODO Move this exception to itools
+class RequestEntityTooLarge(ClientError):
+    code = 413
+    title = 'Request Entity Too Large'
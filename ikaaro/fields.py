@@ -44,6 +44,7 @@ from widgets import CheckboxWidget, RadioWidget, SelectWidget
 from widgets import BirthDateWidget, DateWidget, DatetimeWidget
 from widgets import PasswordWidget, ChoosePassword_Widget
 from widgets import ColorPickerWidget, ProgressBarWidget, RTEWidget
+from web.multipart import UploadedFile
 
 
 class Field(BaseField):
@@ -618,6 +619,7 @@ class File_Field(Field):
         - None (XXX remove handler?)
         - a handler
         - a byte string
+        - an uploaded file (ikaaro.web.multipart.UploadedFile)
         - a tuple
         - something else
         """
@@ -634,11 +636,17 @@ class File_Field(Field):
             return
 
         # Set handler
-        handler = self._get_handler_from_value(value)
         key = self._get_key(resource, name, language)
         database = resource.metadata.database
         if database.has_handler(key):
             database.del_handler(key)
+        # Uploaded file, maybe spooled to disk (see ikaaro.web.multipart):
+        # copied to the database, not loaded in memory
+        body = value[2] if type(value) is tuple else value
+        if isinstance(body, UploadedFile):
+            database.set_handler_from_file(key, body)
+            return
+        handler = self._get_handler_from_value(value)
         database.set_handler(key, handler)
 
 
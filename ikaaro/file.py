@@ -45,6 +45,13 @@ from resource_ import DBResource
 from resource_views import DBResource_GetImage
 
 
+# The text of these documents is extracted by another process, if
+# "text-extraction-processes" is set (see ikaaro.textextract), and kept in
+# the cache if "text-cache-size" is set (see ikaaro.textcache)
+extracted_handlers = (PDFFile, MSWordFile, MSExcelFile, MSPowerPointFile,
+                      MSWordXFile, MSExcelXFile, MSPowerPointXFile, RTFFile,
+                      ODTFile, ODSFile, ODPFile, SXWFile, SXCFile, SXIFile)
+
 
 ###########################################################################
 # Base File
@@ -89,7 +96,31 @@ class File(DBResource):
     #######################################################################
     def to_text(self):
         data = self.get_value('data')
-        return data and data.to_text() or u''
+        if not data:
+            return u''
+        if not isinstance(data, extracted_handlers):
+            return data.to_text() or u''
+
+        # Office documents
+        context = get_context()
+        server = context.server
+        cache = server.text_cache if server else None
+        if cache is not None:
+            key = cache.get_key(context.database, data)
+            text = cache.get(key)
+            if text is not None:
+                return text
+        extractor = server.text_extractor if server else None
+        if extractor is not None:
+            text = extractor.extract_text(data, self.abspath)
+            if text is None:
+                # Failed, try again next time
+                return u''
+        else:
+            text = data.to_text() or u''
+        if cache is not None:
+            cache.put(key, text)
+        return text
 
 
     def get_files_to_archive(self, content=False):
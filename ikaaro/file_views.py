@@ -32,6 +32,8 @@ from autoadd import AutoAdd
 from autoedit import AutoEdit
 from fields import ProgressBar_Field
 from folder import Folder
+from jobs import register_job
+from messages import MSG_JOB_QUEUED
 from resource_views import DBResource_GetFile
 from utils import process_name
 from widgets import PathSelectorWidget
@@ -287,23 +289,35 @@ class Archive_View(STLView):
 
 
     def action(self, resource, context, form):
-        # Get the list of paths to extract
-        handler = resource.get_value('data')
-        paths = handler.get_contents()
-        paths.sort()
-
         # Get the target resource
         target = form['target']
         target = resource.get_resource(target)
 
-        # Make the resources
+        # Make the resources, in the background
         language = resource.get_edit_languages(context)[0]
-        target.extract_archive(handler, language, update=form['update'])
+        user = context.user.name if context.user else None
+        job_id = context.server.jobs.add(
+            'extract_archive', u'Extract %s' % resource.abspath, user=user,
+            archive=str(resource.abspath), target=str(target.abspath),
+            language=language, update=form['update'])
 
         # Ok
-        message = MSG(u'Files extracted')
         goto = context.get_link(target)
-        return context.come_back(message, goto=goto)
+        return context.come_back(MSG_JOB_QUEUED, goto=goto, id=job_id)
+
+
+
+def extract_archive(context, job, archive, target, language, update=False):
+    """The job of Archive_View.
+    """
+    database = context.database
+    archive = database.get_resource(archive)
+    target = database.get_resource(target)
+    handler = archive.get_value('data')
+    target.extract_archive(handler, language, update=update,
+                           progress=job.progress)
+
+register_job('extract_archive', extract_archive)
 
 
 
@@ -49,6 +49,7 @@ from exceptions import ConsistencyError
 from messages import MSG_NAME_CLASH
 from resource_ import DBResource
 from utils import process_name, tidy_html, get_base_path_query
+from web.multipart import get_body_value
 
 
 
@@ -205,7 +206,7 @@ class Folder(DBResource):
 
         # Web Pages are first class citizens
         if mimetype == 'text/html':
-            body = tidy_html(body)
+            body = tidy_html(get_body_value(body))
             class_id = 'webpage'
         elif mimetype == 'application/xhtml+xml':
             class_id = 'webpage'
@@ -216,6 +217,7 @@ class Folder(DBResource):
         # Special case: web pages
         kw = {'filename': filename, 'data': body}
         if issubclass(cls, WebPage):
+            body = get_body_value(body)
             kk, kk, language = FileName.decode(filename)
             if language is None:
                 text = XHTMLFile(string=body).to_text()
@@ -225,17 +227,16 @@ class Folder(DBResource):
         return self.make_resource(name, cls, **kw)
 
 
-    def export_zip(self, paths):
-        stringio = StringIO()
-        archive = ZipFile(stringio, mode='w')
-
-        def _add_resource(resource):
-            for filename in resource.get_files_to_archive(True):
-                if filename.endswith('.metadata'):
-                    continue
-                path = Path(self.handler.key).get_pathto(filename)
-                archive.writestr(str(path), resource.handler.to_str())
-
+    def export_zip(self, paths, file=None, progress=None):
+        """Return the zip archive of the given paths as a byte string, or
+        write it into the given file-like object (and return it, ready to be
+        read).  The progress function, if given, is called with the number
+        of files archived.
+        """
+        # The resources to archive.  The database may change when the
+        # progress is told (see Job.progress), so they are found again by
+        # path
+        abspaths = []
         for path in paths:
             child = self.get_resource(path, soft=True)
             if child is None:
@@ -245,18 +246,50 @@ class Folder(DBResource):
                 for subchild in child.traverse_resources():
                     if subchild is None or isinstance(subchild, Folder):
                         continue
-                    _add_resource(subchild)
+                    abspaths.append(subchild.abspath)
             else:
-                _add_resource(child)
+                abspaths.append(child.abspath)
+
+        stringio = StringIO() if file is None else file
+        archive = ZipFile(stringio, mode='w')
+        base = Path(self.handler.key)
+        files = 0
+        for abspath in abspaths:
+            resource = self.get_resource(abspath, soft=True)
+            if resource is None:
+                continue
+            for filename in resource.get_files_to_archive(True):
+                if filename.endswith('.metadata'):
+                    continue
+                path = base.get_pathto(filename)
+                archive.writestr(str(path), resource.handler.to_str())
+                files += 1
+            if progress:
+                progress(files)
 
         archive.close()
+        if file is not None:
+            file.seek(0)
+            return file
         return stringio.getvalue()
 
 
     def extract_archive(self, handler, default_language, filter=None,
-                        postproc=None, update=False):
-        change_resource = self.database.change_resource
-        for path_str in handler.get_contents():
+                        postproc=None, update=False, progress=None):
+        """Make the resources from the files of the archive.  The progress
+        function, if given, is called with the number of files done and the
+        total.
+        """
+        database = self.database
+        change_resource = database.change_resource
+        abspath = self.abspath
+        contents = handler.get_contents()
+        for i, path_str in enumerate(contents):
+            if progress:
+                progress(i, len(contents))
+                # The database may have changed meanwhile (see Job.progress)
+                if database.get_resource(abspath, soft=True) is None:
+                    return
             # 1. Skip folders
             clean_path = "/".join([
               checkid(x) or 'file'
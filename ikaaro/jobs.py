@@ -0,0 +1,348 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Background jobs, for the long-running operations (reindex the catalog,
+update the instance, extract an archive...).
+
+A view queues the job and returns at once.  The jobs are run one after the
+other by a greenlet of the server (the writer, see ikaaro.workers), each
+within its own database context, as the user who queued it.
+
+The job table is kept in the 'jobs' folder of the instance, one JSON file
+by job (so the jobs can be followed from any process, see the
+/api/devpanel/jobs endpoints), next to the input ('<id>.data') and the
+result ('<id>.result') files of the job.  The jobs that were running when
+the server stopped are marked as interrupted, those that were queued are run
+at start.
+
+A job tells its progress with Job.progress, which also commits the changes
+done so far and lets the requests waiting for the database in, every
+"yield_interval" seconds: so the database lock is not held for the whole
+job.  A job cancelled is stopped the next time it tells its progress, the
+changes not committed by then are aborted.
+"""
+
+# Import from the Standard Library
+from collections import deque
+from json import dumps, loads
+from os import listdir, makedirs, remove, rename
+from os.path import exists
+from time import time
+from traceback import format_exc
+from uuid import uuid4
+
+# Import from gevent
+from gevent import spawn
+from gevent.event import Event
+
+# Import from itools
+from itools.log import log_error, log_info
+
+# Import from ikaaro
+from database import pause_context
+
+
+# The job functions, by name, see register_job
+job_functions = {}
+
+# The states of a job
+finished_states = ('done', 'failed', 'cancelled', 'interrupted')
+
+
+def register_job(name, function):
+    """Register the function to run the jobs of the given name.  It is
+    called with the context, the job and the keyword arguments given to
+    JobQueue.add; it returns the result of the job (JSON).
+    """
+    job_functions[name] = function
+
+
+
+class JobCancelled(Exception):
+    pass
+
+
+
+class Job(object):
+
+    # Commit and release the database lock every N seconds
+    yield_interval = 1.0
+
+    def __init__(self, queue, record):
+        self.queue = queue
+        self.record = record
+        self.context = None
+        self.last_yield = time()
+
+
+    @property
+    def id(self):
+        return self.record['id']
+
+
+    def get_data_path(self):
+        return self.queue.get_path(self.id, 'data')
+
+
+    def get_result_path(self):
+        return self.queue.get_path(self.id, 'result')
+
+
+    def set_result_file(self, content_type, filename=None):
+        """Tell the job made a file, at Job.get_result_path()
+        """
+        self.record['result_type'] = content_type
+        self.record['result_name'] = filename
+
+
+    def progress(self, done, total=None, message=None):
+        """Tell how far the job is.  Raise JobCancelled if the job has been
+        cancelled meanwhile.
+        """
+        record = self.record
+        record['done'] = done
+        if total is not None:
+            record['total'] = total
+        if message is not None:
+            record['message'] = message
+        if self.queue.is_cancelled(self.id):
+            raise JobCancelled
+        # Let the others in, from time to time
+        now = time()
+        if now - self.last_yield < self.yield_interval:
+            return
+        self.queue.save(record)
+        if self.context is not None:
+            pause_context(self.context)
+        self.last_yield = time()
+        if self.queue.is_cancelled(self.id):
+            raise JobCancelled
+
+
+
+class JobQueue(object):
+
+    # Keep the records of the last N jobs finished
+    max_jobs = 100
+
+    def __init__(self, path, database=None):
+        self.path = path
+        if not exists(path):
+            makedirs(path)
+        self.database = database
+        # The worker
+        self.greenlet = None
+        self.event = Event()
+        # The jobs to run (ids), and the jobs running to cancel
+        self.queue = deque()
+        self.cancelled = set()
+
+
+    def get_path(self, job_id, extension='json'):
+        return '%s/%s.%s' % (self.path, job_id, extension)
+
+
+    #######################################################################
+    # The job table
+    #######################################################################
+    def get_job(self, job_id):
+        """Return the record of the job, or None.
+        """
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self.get_path(job_id)) as file:
+                return loads(file.read())
+        except (IOError, ValueError):
+            return None
+
+
+    def get_jobs(self):
+        """Return the records of the jobs, the last queued first.
+        """
+        jobs = []
+        for name in listdir(self.path):
+            if name[-5:] != '.json':
+                continue
+            record = self.get_job(name[:-5])
+            if record is not None:
+                jobs.append(record)
+        jobs.sort(key=lambda x: x['created'], reverse=True)
+        return jobs
+
+
+    def save(self, record):
+        path = self.get_path(record['id'])
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as file:
+            file.write(dumps(record))
+        # Atomic
+        rename(tmp_path, path)
+
+
+    def remove(self, job_id):
+        for extension in ('json', 'data', 'result'):
+            path = self.get_path(job_id, extension)
+            if exists(path):
+                remove(path)
+
+
+    def clean(self):
+        """Forget the oldest jobs finished.
+        """
+        jobs = [ x for x in self.get_jobs() if x['status'] in finished_states ]
+        for record in jobs[self.max_jobs:]:
+            self.remove(record['id'])
+
+
+    #######################################################################
+    # API
+    #######################################################################
+    def add(self, name, title, user=None, data=None, **kw):
+        """Queue a job, return its id.  The data (a byte string) is kept in
+        a file for the job, see Job.get_data_path
+        """
+        if name not in job_functions:
+            raise ValueError('unknown job "%s"' % name)
+        job_id = uuid4().hex
+        if data is not None:
+            with open(self.get_path(job_id, 'data'), 'wb') as file:
+                file.write(data)
+        record = {
+            'id': job_id,
+            'name': name,
+            'title': title,
+            'user': user,
+            'kwargs': kw,
+            'status': 'queued',
+            'done': 0,
+            'total': None,
+            'message': None,
+            'created': time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'result_type': None,
+            'result_name': None,
+            'error': None}
+        self.save(record)
+        self.clean()
+        self.queue.append(job_id)
+        self.event.set()
+        return job_id
+
+
+    def cancel(self, job_id):
+        """Cancel the job, return its record (or None if there is no such
+        job).  A job running is stopped the next time it tells its progress.
+        """
+        record = self.get_job(job_id)
+        if record is None:
+            return None
+        if record['status'] == 'queued':
+            record['status'] = 'cancelled'
+            record['finished'] = time()
+            self.save(record)
+        elif record['status'] == 'running':
+            self.cancelled.add(job_id)
+        return record
+
+
+    def is_cancelled(self, job_id):
+        return job_id in self.cancelled
+
+
+    def recover(self):
+        """Run the jobs queued by the previous run, and mark as interrupted
+        those that were running.
+        """
+        for record in reversed(self.get_jobs()):
+            if record['status'] == 'running':
+                record['status'] = 'interrupted'
+                record['finished'] = time()
+                self.save(record)
+            elif record['status'] == 'queued':
+                if record['id'] not in self.queue:
+                    self.queue.append(record['id'])
+        self.event.set()
+
+
+    #######################################################################
+    # The worker
+    #######################################################################
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.run)
+
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            while self.queue:
+                job_id = self.queue.popleft()
+                try:
+                    self.run_job(job_id)
+                except Exception:
+                    log_error('Job error\n' + format_exc())
+
+
+    def run_job(self, job_id):
+        record = self.get_job(job_id)
+        if record is None or record['status'] != 'queued':
+            return
+        job = Job(self, record)
+        function = job_functions.get(record['name'])
+        if function is None:
+            record['status'] = 'failed'
+            record['error'] = 'unknown job "%s"' % record['name']
+            record['finished'] = time()
+            self.save(record)
+            return
+
+        log_info('Job %s (%s) started' % (job_id, record['name']))
+        record['status'] = 'running'
+        record['started'] = time()
+        self.save(record)
+        database = self.database
+        kw = dict([ (str(x), y) for x, y in record['kwargs'].items() ])
+        with database.init_context(username=record['user'],
+                                   commit_at_exit=False) as context:
+            context.git_message = u'[JOB] %s' % record['title']
+            job.context = context
+            try:
+                result = function(context, job, **kw)
+                database.save_changes()
+            except JobCancelled:
+                database.abort_changes()
+                record['status'] = 'cancelled'
+            except Exception:
+                log_error('Job error\n' + format_exc())
+                database.abort_changes()
+                record['status'] = 'failed'
+                record['error'] = format_exc().strip().splitlines()[-1]
+            else:
+                record['status'] = 'done'
+                record['result'] = result
+            job.context = None
+        self.cancelled.discard(job_id)
+        record['finished'] = time()
+        self.save(record)
+        # The input is not needed anymore
+        data_path = job.get_data_path()
+        if exists(data_path):
+            remove(data_path)
+        log_info('Job %s (%s) %s' % (job_id, record['name'],
+                                     record['status']))
@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read the log files without loading them in memory (see the
+/api/devpanel/log endpoints).
+
+The lines are read up to the end of the last complete line, the offset of
+which is returned: the client gives it back ("since") to read the lines
+written meanwhile.  An offset beyond the end of the file means the log has
+been rotated, then it is read from the start.
+"""
+
+# Import from the Standard Library
+from os import fstat
+
+
+chunk_size = 65536
+
+
+def split_lines(data):
+    """Split the data in lines, keeping the new line characters.
+    """
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [ x + '\n' for x in lines ]
+    if last:
+        lines.append(last)
+    return lines
+
+
+
+def get_end_offset(file, size):
+    """Return the offset just after the last complete line.
+    """
+    start = max(size - chunk_size, 0)
+    file.seek(start)
+    index = file.read(size - start).rfind('\n')
+    if index == -1:
+        return size
+    return start + index + 1
+
+
+
+def iter_lines_backwards(file, start, end):
+    """Yield the lines between the offsets, the last first.
+    """
+    position = end
+    rest = ''
+    while position > start:
+        size = min(chunk_size, position - start)
+        position -= size
+        file.seek(position)
+        lines = split_lines(file.read(size) + rest)
+        # The first line may start in the previous chunk
+        rest = lines.pop(0) if position > start else ''
+        for line in reversed(lines):
+            yield line
+    if rest:
+        yield rest
+
+
+
+def get_tail_offset(file, start, end, lines):
+    """Return the offset of the last lines.
+    """
+    offset = end
+    for i, line in enumerate(iter_lines_backwards(file, start, end)):
+        if i == lines:
+            break
+        offset -= len(line)
+    return offset
+
+
+
+def iter_log(file, start, end, grep=None):
+    """Yield the data of the file between the offsets, in chunks, only the
+    lines with the given text if any.
+    """
+    try:
+        file.seek(start)
+        left = end - start
+        if grep is None:
+            while left > 0:
+                data = file.read(min(left, chunk_size))
+                if not data:
+                    break
+                left -= len(data)
+                yield data
+            return
+
+        buffer = []
+        buffer_size = 0
+        while left > 0:
+            line = file.readline()
+            if not line:
+                break
+            left -= len(line)
+            if grep in line:
+                buffer.append(line)
+                buffer_size += len(line)
+                if buffer_size >= chunk_size:
+                    yield ''.join(buffer)
+                    buffer = []
+                    buffer_size = 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        file.close()
+
+
+
+def read_log(path, since=None, tail=None, grep=None):
+    """Return the offset to read the log from next time, and an iterator
+    over the lines from the given offset ("since"), only the last ones
+    ("tail"), with the given text ("grep").
+    """
+    try:
+        file = open(path, 'rb')
+    except IOError:
+        return 0, []
+    size = fstat(file.fileno()).st_size
+    end = get_end_offset(file, size)
+    start = since or 0
+    if start > size:
+        # Rotated
+        start = 0
+    elif start > end:
+        start = end
+
+    if tail:
+        if grep is None:
+            start = get_tail_offset(file, start, end, tail)
+        else:
+            lines = []
+            for line in iter_lines_backwards(file, start, end):
+                if grep in line:
+                    lines.append(line)
+                    if len(lines) == tail:
+                        break
+            file.close()
+            lines.reverse()
+            return end, lines
+
+    return end, iter_log(file, start, end, grep)
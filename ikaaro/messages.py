@@ -46,6 +46,12 @@ MSG_EMPTY_FILENAME = ERROR(u'The file must be entered.')
 
 MSG_EXISTANT_FILENAME = ERROR(u'A given name already exists.')
 
+MSG_JOB_QUEUED = INFO(
+    u'The operation has been queued, it runs in the background (job {id}).')
+
+MSG_ARCHIVE_QUEUED = INFO(
+    u'The archive is being built, download it from {url} once done.')
+
 MSG_INVALID_EMAIL = ERROR(u'The email address provided is invalid.')
 
 MSG_NAME_CLASH = ERROR(u'There is already another resource with this name.')
@@ -0,0 +1,175 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time spent by the requests in each phase, aggregated by view into
+histograms, and exported in the Prometheus text format.
+
+The phases are:
+
+- lock_wait: waiting for the database lock (DBSEM)
+- catalog_reopen: reopening the catalog after a commit
+- init: building the context from the environ, authentication included
+- view: the view itself (what is left of the request handling)
+- skin: rendering the skin, see Root.after_traverse
+- before_commit: Database._before_commit
+- commit: saving the handlers, git commit and catalog indexing
+- commit_wait: waiting for the group commit, once the database lock has
+  been released (see Database.save_changes_in_group)
+- response_write: sending the response to the client
+- total: the whole request
+
+The time of nested phases (catalog_reopen in init for instance) is also
+counted in the enclosing phase, but not in the view.
+"""
+
+# Import from the Standard Library
+from time import time
+
+# Import from itools
+from itools.web import get_context
+
+
+class Histogram(object):
+
+    # Upper bounds of the buckets (seconds)
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+    def get_buckets(self):
+        """Return the cumulative counts, as [(upper bound, count), ...].
+        """
+        buckets = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            buckets.append((repr(bound), total))
+        buckets.append(('+Inf', self.count))
+        return buckets
+
+
+
+def escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+
+class RequestMetrics(object):
+
+    name = 'ikaaro_request_phase_seconds'
+
+    def __init__(self):
+        # {(route, phase): Histogram}
+        self.histograms = {}
+
+
+    def observe(self, route, phase, seconds):
+        key = (route, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+    def add_request(self, route, timings):
+        for phase, seconds in timings.iteritems():
+            self.observe(route, phase, seconds)
+
+
+    def to_text(self):
+        name = self.name
+        lines = [
+            '# HELP %s Time spent by the requests in each phase.' % name,
+            '# TYPE %s histogram' % name]
+        for (route, phase), histogram in sorted(self.histograms.items()):
+            labels = 'route="%s",phase="%s"' % (escape_label(route), phase)
+            for bound, count in histogram.get_buckets():
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (name, labels, bound, count))
+            lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+
+def add_timing(phase, seconds, context=None):
+    """Add the given time to the phase of the current request (if any).
+    """
+    if context is None:
+        context = get_context()
+    timings = getattr(context, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+
+def count_search(context=None):
+    """Count the catalog searches of the current request (if any).
+    """
+    if context is None:
+        context = get_context()
+    if getattr(context, 'timings', None) is not None:
+        context.search_count += 1
+
+
+
+class timer(object):
+    """Count the time spent in the block in the given phase of the current
+    request:
+
+        with timer('skin'):
+            ...
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+
+
+    def __enter__(self):
+        self.t0 = time()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_timing(self.phase, time() - self.t0)
+
+
+
+def get_route(context):
+    """Return the name of the view class, the label of the request.
+    """
+    view = getattr(context, 'view', None)
+    if view is None:
+        return 'none'
+    # Views are prototypes, skip the anonymous ones: View(access=False)
+    cls = view if isinstance(view, type) else view.__class__
+    for cls in cls.__mro__:
+        if not cls.__name__.startswith('[anonymous]'):
+            return cls.__name__
+    return 'none'
@@ -0,0 +1,140 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sampled profiling of the requests.
+
+A request is profiled when it is the Nth one ("profile-sample"), when its
+path starts with one of "profile-paths", or when its view name (the part
+after ';') is one of "profile-views".  Its profile is written (in pstats
+format) to the "log/profile" folder, if the request lasted at least
+"profile-min-time" milliseconds.  With only "profile-min-time" set, one
+request every "default_sample" is profiled, and only the slow ones are
+kept.
+
+The profiler works on the whole thread, so only one request is profiled at
+a time, and the other greenlets run while it waits (on the database lock,
+the network...) are counted in its profile.
+"""
+
+# Import from the Standard Library
+from cProfile import Profile
+from os import getpid, listdir, makedirs, remove, stat
+from os.path import exists
+from time import strftime, time
+
+
+class RequestProfiler(object):
+
+    # Keep only the most recent profiles
+    max_files = 100
+
+    # Profile one request every N when only the minimum time is given (the
+    # requests are profiled one at a time)
+    default_sample = 100
+
+    def __init__(self, path, sample=0, paths=(), views=(), min_time=0):
+        self.path = path
+        self.sample = sample or 0
+        self.paths = tuple(paths or ())
+        self.views = frozenset(views or ())
+        self.min_time = (min_time or 0) / 1000.0
+        if self.min_time and not (self.sample or self.paths or self.views):
+            self.sample = self.default_sample
+        self.counter = 0
+        self.saved = 0
+        self.profiling = False
+
+
+    def is_enabled(self):
+        return bool(self.sample or self.paths or self.views or self.min_time)
+
+
+    def match(self, environ):
+        path = environ.get('PATH_INFO') or '/'
+        # Path
+        if self.paths and path.startswith(self.paths):
+            return True
+        # View name
+        if self.views:
+            name = path.rsplit('/', 1)[-1]
+            if name[:1] == ';' and name[1:] in self.views:
+                return True
+        # 1 in N
+        if self.sample:
+            self.counter += 1
+            return self.counter % self.sample == 0
+        return False
+
+
+    def start(self, environ):
+        """Start profiling the request, if it is selected. Return the
+        profiler, to be given to 'stop'.
+        """
+        if self.profiling or not self.is_enabled():
+            return None
+        if not self.match(environ):
+            return None
+        self.profiling = True
+        profile = Profile()
+        profile.t0 = time()
+        profile.enable()
+        return profile
+
+
+    def stop(self, profile, route):
+        profile.disable()
+        self.profiling = False
+        seconds = time() - profile.t0
+        if seconds < self.min_time:
+            return
+        # Save
+        if not exists(self.path):
+            makedirs(self.path)
+        self.saved += 1
+        name = '%s-%d-%d-%dms-%s' % (strftime('%Y%m%d%H%M%S'), getpid(),
+                                     self.saved, seconds * 1000, route)
+        profile.dump_stats('%s/%s.prof' % (self.path, name))
+        # Remove the oldest files
+        files = self.get_files()
+        for file in files[self.max_files:]:
+            try:
+                remove(self.get_file_path(file['name']))
+            except OSError:
+                pass
+
+
+    def get_file_path(self, name):
+        if not name or '/' in name or name[0] == '.':
+            return None
+        return '%s/%s.prof' % (self.path, name)
+
+
+    def get_files(self):
+        """Return the profiles saved, the most recent first.
+        """
+        if not exists(self.path):
+            return []
+        files = []
+        for filename in listdir(self.path):
+            if not filename.endswith('.prof'):
+                continue
+            try:
+                st = stat('%s/%s' % (self.path, filename))
+            except OSError:
+                continue
+            files.append({'name': filename[:-5], 'size': st.st_size,
+                          'mtime': st.st_mtime})
+        files.sort(key=lambda x: x['mtime'], reverse=True)
+        return files
@@ -29,7 +29,7 @@ from itools.core import is_prototype, lazy
 from itools.database import MetadataProperty
 from itools.database import Resource, register_field
 from itools.database import PhraseQuery
-from itools.datatypes import DateTime, Date, Decimal
+from itools.datatypes import Boolean, DateTime, Date, Decimal
 from itools.datatypes import Integer, String, Unicode
 from itools.gettext import MSG
 from itools.handlers import Folder as FolderHandler
@@ -592,11 +592,16 @@ class DBResource(Resource):
         context = get_context()
         server = context.server
         if server and server.index_text:
-            try:
-                values['text'] = self.to_text()
-            except Exception:
-                log = 'Indexation failed: %s' % abspath
-                log_warning(log, domain='ikaaro')
+            text_indexer = server.text_indexer
+            if text_indexer is not None:
+                # Later (see ikaaro.textindex)
+                text_indexer.defer(self, values)
+            else:
+                try:
+                    values['text'] = self.to_text()
+                except Exception:
+                    log = 'Indexation failed: %s' % abspath
+                    log_warning(log, domain='ikaaro')
         # Time events for the CRON
         reminder, payload = self.next_time_event()
         values['next_time_event'] = reminder
@@ -912,6 +917,7 @@ register_field('links', String(multiple=True, indexed=True))
 register_field('onchange_reindex', String(multiple=True, indexed=True))
 # Full text search
 register_field('text', Unicode(indexed=True))
+register_field('text_pending', Boolean(indexed=True))
 # Time events
 register_field('next_time_event', DateTime(stored=True))
 register_field('next_time_event_payload', String(stored=True))
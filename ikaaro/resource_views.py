@@ -19,6 +19,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from os.path import getsize
+
 # Import from itools
 from itools.core import guess_extension, merge_dicts
 from itools.database import OrQuery, PhraseQuery
@@ -28,20 +31,24 @@ from itools.stl import stl
 from itools.uri import get_reference, get_uri_path
 from itools.web import get_context
 from itools.web import BaseView, STLView, INFO, ERROR
-from itools.web import Conflict, NotFound, NotImplemented
+from itools.web import Conflict, NotFound, NotImplemented, NotModified
 
 # Import from ikaaro
 from ikaaro.views.folder_views import Folder_BrowseContent
+from ikaaro.web.ranges import FileSlice, check_if_range, get_etag
+from ikaaro.web.ranges import get_file_etag, get_file_multipart_byteranges
+from ikaaro.web.ranges import get_multipart_byteranges, is_not_modified
+from ikaaro.web.ranges import parse_range
 
 # Import from ikaaro
 from autoform import AutoForm
 from buttons import Remove_Button
+from database import get_handler_path, open_handler_file
 from emails import send_email
 from exceptions import ConsistencyError
 from messages import MSG_LOGIN_WRONG_NAME_OR_PASSWORD
 
 
-
 class DBResource_Remove(AutoForm):
 
     access = 'is_allowed_to_remove'
@@ -125,7 +132,76 @@ class DBResource_GetFile(BaseView):
         filename = self.get_filename(handler, field_name, resource)
         context.set_content_disposition(disposition, filename)
         # Ok
-        return handler.to_str()
+        return self.get_body(handler, content_type, context)
+
+
+    def get_etag(self, handler, data=None, path=None):
+        """Return the strong ETag of the file, given by its content or by
+        its path (then the file is not read, see get_file_etag).
+        """
+        if path is not None:
+            return get_file_etag(path)
+        return get_etag(data)
+
+
+    def get_body(self, handler, content_type, context):
+        """Return the body of the file, or a part of it for the byte-range
+        requests.
+
+        If possible the file (see open_handler_file) is read from the file
+        system while the response is sent (see ikaaro.web.wsgi), instead of
+        being loaded in memory.
+        """
+        path = get_handler_path(context.database, handler)
+        if path is None:
+            data = handler.to_str()
+            size = len(data)
+            etag = self.get_etag(handler, data=data)
+        else:
+            data = None
+            size = getsize(path)
+            etag = self.get_etag(handler, path=path)
+        mtime = handler.get_mtime()
+        context._set_header('ETag', etag)
+        context._set_header('Accept-Ranges', 'bytes')
+        # Conditional request (If-Modified-Since alone is checked by itools)
+        environ = context.environ
+        if is_not_modified(environ, etag, mtime):
+            raise NotModified
+
+        # Range
+        ranges = None
+        if context.method == 'GET' and check_if_range(environ, etag, mtime):
+            ranges = parse_range(environ.get('HTTP_RANGE'), size)
+        if ranges is None:
+            if data is None:
+                return open_handler_file(path)
+            return data
+        if not ranges:
+            # Range Not Satisfiable
+            context.status = 416
+            context._set_header('Content-Range', 'bytes */%d' % size)
+            return ''
+
+        context.status = 206
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            context._set_header('Content-Range',
+                                'bytes %d-%d/%d' % (first, last, size))
+            if data is None:
+                context._set_header('Content-Length', str(last - first + 1))
+                return FileSlice(open_handler_file(path), first, last)
+            return data[first:last+1]
+
+        if data is None:
+            content_type, length, body = get_file_multipart_byteranges(
+                open_handler_file(path), size, ranges, content_type)
+            context._set_header('Content-Length', str(length))
+        else:
+            content_type, body = get_multipart_byteranges(data, ranges,
+                                                          content_type)
+        context.content_type = content_type
+        return body
 
 
 
@@ -49,6 +49,7 @@ from config_register import RegisterForm, TermsOfService_View
 from context import CMSContext
 from fields import Char_Field
 from folder import Folder
+from metrics import timer
 from resource_views import LoginView
 from skins import skin_registry
 from utils import get_base_path_query
@@ -241,23 +242,24 @@ class Root(Folder):
 
 
     def after_traverse(self, context):
-        body = context.entity
-        is_str = type(body) is str
-        is_xml = is_xml_stream(body)
-        if not is_str and not is_xml:
-            return
-
-        # If there is not a content type, just serialize the content
-        if context.content_type:
-            if is_xml:
-                context.entity = stream_to_str_as_html(body)
-            return
-
-        # Standard page, wrap the content into the general template
-        if is_str:
-            body = XMLParser(body, doctype=xhtml_doctype)
-        context.entity = self.get_skin(context).template(body)
-        context.content_type = 'text/html; charset=UTF-8'
+        with timer('skin'):
+            body = context.entity
+            is_str = type(body) is str
+            is_xml = is_xml_stream(body)
+            if not is_str and not is_xml:
+                return
+
+            # If there is not a content type, just serialize the content
+            if context.content_type:
+                if is_xml:
+                    context.entity = stream_to_str_as_html(body)
+                return
+
+            # Standard page, wrap the content into the general template
+            if is_str:
+                body = XMLParser(body, doctype=xhtml_doctype)
+            context.entity = self.get_skin(context).template(body)
+            context.content_type = 'text/html; charset=UTF-8'
 
 
     def get_available_languages(self):
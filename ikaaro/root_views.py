@@ -42,7 +42,9 @@ from buttons import Button
 from config_captcha import CaptchaDatatype, CaptchaWidget
 from datatypes import FileDataType
 from folder import Folder
-from messages import MSG_UNEXPECTED_MIMETYPE
+from jobs import register_job
+from messages import MSG_JOB_QUEUED, MSG_UNEXPECTED_MIMETYPE
+from web.multipart import get_body_value
 from widgets import FileWidget
 from widgets import HiddenWidget, SelectWidget, MultilineWidget, TextWidget
 
@@ -58,7 +60,11 @@ class NotAllowedView(STLView):
 
 
 class UnavailableView(STLView):
+    """Sent with a "503 Service Unavailable" status when the server is
+    overloaded, see ikaaro.web.admission.
+    """
 
+    access = True
     template = '/ui/ikaaro/root/unavailable.xml'
 
     def get_namespace(self, resource, context):
@@ -271,78 +277,92 @@ class UpdateDocs(AutoForm):
 
 
     def action(self, resource, context, form):
-        skip = set(['application/javascript', 'application/octet-stream',
-                    'text/css', 'text/plain'])
-        keep = set(['application/pdf', 'image/png'])
-        language = form['language']
-
-        def rewrite(value):
-            if value[0] == '#':
-                return value
-            ref = get_reference(value)
-            if ref.scheme:
-                return value
-            name = ref.path.get_name()
-            name, extension, langage = FileName.decode(name)
-            if extension in ('png', 'pdf'):
-                name = '%s/;download' % name
-            ref.path[-1] = name
-            return '../%s' % ref
-
-        def filter(path, mimetype, body):
-            # HTML
-            if mimetype == 'text/html':
-                source = XHTMLFile(string=body)
-                target = XHTMLFile()
-                elem = get_element(source.events, 'div', **{'class': 'body'})
-                if not elem:
-                    print 'E', path
-                    return None
-                elements = elem.get_content_elements()
-                elements = rewrite_uris(elements, rewrite)
-                elements = list(elements)
-                target.set_body(elements)
-                return target.to_str()
-            # Skip
-            elif mimetype in skip:
-                return None
-            # Keep
-            elif mimetype in keep:
-                return body
-            # Unknown
-            else:
-                print 'X', path, mimetype
-                return body
-
-        def postproc(file):
-            # Share
-            file.set_value('share', ['everybody'])
-            # Title
-            if file.class_id != 'webpage':
-                return
-            handler = file.get_handler()
-            events = handler.events
-            elem = get_element(events, 'h1')
-            if elem:
-                title = [
-                    unicode(x[1], 'utf8')
-                    for x in elem.get_content_elements() if x[0] == TEXT ]
-                if title[-1] == u'¶':
-                    title.pop()
-                title = u''.join(title)
-                file.set_property('title', title, language)
-                handler.events = events[:elem.start] + events[elem.end+1:]
-
-        # 1. Make the '/docs/' folder
-        docs = resource.get_resource('docs', soft=True)
-        if not docs:
-            docs = resource.make_resource('docs', Folder)
-        # 2. Extract
+        # Extract the archive in the background
         filename, mimetype, body = form['file']
-        cls = get_handler_class_by_mimetype(mimetype)
-        handler = cls(string=body)
-        docs.extract_archive(handler, language, filter, postproc, True)
-
+        user = context.user.name if context.user else None
+        job_id = context.server.jobs.add(
+            'update_docs', u'Update docs', user=user,
+            data=get_body_value(body), mimetype=mimetype,
+            language=form['language'])
         # Ok
-        message = MSG(u'Documentation updated.')
-        return context.come_back(message, goto='./docs')
+        return context.come_back(MSG_JOB_QUEUED, id=job_id)
+
+
+
+def update_docs(context, job, mimetype, language):
+    """The job of UpdateDocs.
+    """
+    resource = context.root
+    skip = set(['application/javascript', 'application/octet-stream',
+                'text/css', 'text/plain'])
+    keep = set(['application/pdf', 'image/png'])
+
+    def rewrite(value):
+        if value[0] == '#':
+            return value
+        ref = get_reference(value)
+        if ref.scheme:
+            return value
+        name = ref.path.get_name()
+        name, extension, langage = FileName.decode(name)
+        if extension in ('png', 'pdf'):
+            name = '%s/;download' % name
+        ref.path[-1] = name
+        return '../%s' % ref
+
+    def filter(path, mimetype, body):
+        # HTML
+        if mimetype == 'text/html':
+            source = XHTMLFile(string=body)
+            target = XHTMLFile()
+            elem = get_element(source.events, 'div', **{'class': 'body'})
+            if not elem:
+                print 'E', path
+                return None
+            elements = elem.get_content_elements()
+            elements = rewrite_uris(elements, rewrite)
+            elements = list(elements)
+            target.set_body(elements)
+            return target.to_str()
+        # Skip
+        elif mimetype in skip:
+            return None
+        # Keep
+        elif mimetype in keep:
+            return body
+        # Unknown
+        else:
+            print 'X', path, mimetype
+            return body
+
+    def postproc(file):
+        # Share
+        file.set_value('share', ['everybody'])
+        # Title
+        if file.class_id != 'webpage':
+            return
+        handler = file.get_handler()
+        events = handler.events
+        elem = get_element(events, 'h1')
+        if elem:
+            title = [
+                unicode(x[1], 'utf8')
+                for x in elem.get_content_elements() if x[0] == TEXT ]
+            if title[-1] == u'¶':
+                title.pop()
+            title = u''.join(title)
+            file.set_property('title', title, language)
+            handler.events = events[:elem.start] + events[elem.end+1:]
+
+    # 1. Make the '/docs/' folder
+    docs = resource.get_resource('docs', soft=True)
+    if not docs:
+        docs = resource.make_resource('docs', Folder)
+    # 2. Extract
+    cls = get_handler_class_by_mimetype(mimetype)
+    with open(job.get_data_path(), 'rb') as file:
+        handler = cls(string=file.read())
+    docs.extract_archive(handler, language, filter, postproc, True,
+                         progress=job.progress)
+
+register_job('update_docs', update_docs)
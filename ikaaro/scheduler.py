@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Scheduler of the time events (see DBResource.next_time_event and
+DBResource.time_event).
+
+The time of the next event of every resource is kept in a heap, loaded from
+the catalog at start and updated once the resources indexed are committed
+(see Database.update_graphs).  The scheduler sleeps until the first event is
+due, then calls the cron manager (Server.cron_manager), which sends the
+events due by then.  With "cron-interval" the catalog is also checked at
+least every "cron-interval" seconds, in case an event was missed.
+
+A resource whose time event fails is left aside for a while ("retry_delay"
+seconds, twice as long every next time), so it does not hold the others.
+"""
+
+# Import from the Standard Library
+from calendar import timegm
+from heapq import heappop, heappush
+from time import time
+from traceback import format_exc
+
+# Import from gevent
+from gevent import spawn
+from gevent.event import Event
+
+# Import from itools
+from itools.database import RangeQuery
+from itools.log import log_error
+
+
+def get_timestamp(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return timegm(value.timetuple())
+    return timegm(value.utctimetuple())
+
+
+
+class TimeEventScheduler(object):
+
+    # Wait before sending again the event of a resource that failed
+    # (seconds, doubled every time up to the maximum)
+    retry_delay = 60
+    max_retry_delay = 3600
+
+    def __init__(self, callback, interval=0):
+        self.callback = callback
+        self.interval = interval or None
+        # The heap of (time, abspath), and the time of the next event of
+        # every resource: {abspath: time}.  The items of the heap that do
+        # not match are old, they are skipped.
+        self.heap = []
+        self.times = {}
+        # The resources that failed: {abspath: [failures, time]}
+        self.failures = {}
+        # The worker
+        self.event = Event()
+        self.greenlet = None
+
+
+    def load(self, database, context):
+        """Load the time events from the catalog.
+        """
+        since = context.timestamp.replace(year=1970, month=1, day=1)
+        query = RangeQuery('next_time_event', since, None)
+        for brain in database.search(query).get_documents():
+            self.update(brain.abspath, brain.next_time_event)
+
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.run)
+
+
+    def run(self):
+        while True:
+            self.event.wait(self.get_timeout())
+            self.event.clear()
+            self.pop_due(time())
+            try:
+                self.callback()
+            except Exception:
+                log_error('Cron error\n' + format_exc(), domain='itools.cron')
+
+
+    def get_timeout(self):
+        heap = self.heap
+        times = self.times
+        while heap and times.get(heap[0][1]) != heap[0][0]:
+            heappop(heap)
+        if not heap:
+            return self.interval
+        timeout = max(heap[0][0] - time(), 0)
+        if self.interval:
+            return min(timeout, self.interval)
+        return timeout
+
+
+    def pop_due(self, now):
+        """Forget the events due by now, the cron manager is going to send
+        them (and the resources will be indexed with their next event).
+        """
+        heap = self.heap
+        times = self.times
+        while heap and heap[0][0] <= now:
+            when, abspath = heappop(heap)
+            if times.get(abspath) == when:
+                del times[abspath]
+
+
+    def update(self, abspath, next_time_event):
+        """Set the time of the next event of the resource.
+        """
+        when = get_timestamp(next_time_event)
+        failure = self.failures.get(abspath)
+        if failure and when is not None:
+            when = max(when, failure[1])
+        if when is None:
+            self.times.pop(abspath, None)
+            return
+        if self.times.get(abspath) == when:
+            return
+        self.times[abspath] = when
+        heappush(self.heap, (when, abspath))
+        # Wake up the worker, if this is the first event now
+        if self.heap[0][1] == abspath:
+            self.event.set()
+
+
+    def remove(self, abspath):
+        self.times.pop(abspath, None)
+        self.failures.pop(abspath, None)
+
+
+    #######################################################################
+    # Failures
+    #######################################################################
+    def is_failing(self, abspath, now):
+        failure = self.failures.get(abspath)
+        return failure is not None and failure[1] > now
+
+
+    def failed(self, abspath):
+        failures = self.failures.get(abspath, [0, 0])[0] + 1
+        delay = min(self.retry_delay * 2 ** (failures - 1),
+                    self.max_retry_delay)
+        when = int(time() + delay)
+        self.failures[abspath] = [failures, when]
+        self.times[abspath] = when
+        heappush(self.heap, (when, abspath))
+
+
+    def succeeded(self, abspath):
+        self.failures.pop(abspath, None)
@@ -19,8 +19,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from cProfile import runctx
-from email.parser import HeaderParser
 from json import loads
 from io import BytesIO
 from datetime import timedelta
@@ -29,12 +27,11 @@ import inspect
 import json
 import pickle
 from os import fdopen, getpgid, getpid, kill, mkdir, remove
-from os.path import join
+from os.path import basename, join
 from psutil import pid_exists
 import sys
 from time import time
 from traceback import format_exc
-from smtplib import SMTP, SMTPRecipientsRefused, SMTPResponseException
 from signal import SIGINT, SIGTERM
 from requests import Request
 from socket import gaierror
@@ -56,7 +53,6 @@ from itools.i18n import init_language_selector
 from itools.log import Logger, register_logger
 from itools.log import DEBUG, INFO, WARNING, ERROR, FATAL
 from itools.log import log_error, log_warning, log_info
-from itools.loop import cron
 from itools.uri import get_reference, get_uri_path, Path
 from itools.web import WebLogger
 from itools.web.context import select_language
@@ -65,12 +61,28 @@ from itools.web.dispatcher import URIDispatcher
 from itools.web.server import AccessLogger
 
 # Import from ikaaro
-from ikaaro.web.wsgi import application
+from ikaaro.web.admission import AdmissionControl, budget_names
+from ikaaro.web.compression import compressible_types
+from ikaaro.web.ratelimit import RateLimiter, rule_names
+from ikaaro.web.uploads import UploadStats
+from ikaaro.web.wsgi import application, forwarded_application
 
 # Import from ikaaro.web
-from database import get_database
+from database import get_database, get_catalog_generation
+from database import bump_catalog_generation, get_graph_values
+from database import install_context_tracer
 from datatypes import ExpireValue
+from dependencies import DependencyGraph
+from jobs import JobQueue
+from metrics import RequestMetrics, add_timing
+from profiling import RequestProfiler
+from watchdog import SlowRequestWatchdog
 from root import Root
+from scheduler import TimeEventScheduler
+from spool import MailSpool
+from textcache import TextCache
+from textextract import TextExtractor
+from textindex import TextIndexer
 from views import CachedStaticView
 from skins import skin_registry
 from views import IkaaroStaticView
@@ -106,6 +118,18 @@ smtp-from = {smtp_from}
 smtp-login =
 smtp-password =
 
+# The messages are sent in batches of "smtp-batch-size" (default is 50), at
+# most "smtp-rate" messages per second (if zero, the default, the rate is
+# not limited). After an error a message is sent again, up to
+# "smtp-max-retries" times (default is 5), waiting "smtp-retry-delay"
+# seconds (default is 60) the first time and twice as long every next time.
+# Then it is moved to the 'spool/failed' folder.
+#
+smtp-rate = 0
+smtp-batch-size = 50
+smtp-max-retries = 5
+smtp-retry-delay = 60
+
 # The "log-level" variable may have one of these values (from lower to
 # higher verbosity): 'critical' 'error', 'warning', 'info' and 'debug'.
 # The default is 'warning'.
@@ -115,9 +139,10 @@ smtp-password =
 log-level = warning
 log-email = {log_email}
 
-# The "cron-interval" variable defines the number of seconds between every
-# call to the cron job manager. If zero (the default) the cron job won't be
-# run at all.
+# The "cron-interval" variable enables the time events of the resources, if
+# zero (the default) they won't be sent at all. The events are sent when
+# they are due, the catalog is also checked every "cron-interval" seconds in
+# case one was missed.
 #
 cron-interval = 0
 
@@ -137,12 +162,57 @@ session-timeout = 0
 database-size = 19500:20500
 database-readonly = 0
 
+# The write transactions of the requests that follow each other within
+# "database-commit-window" milliseconds are committed together, in one Git
+# commit and one catalog update (at most "database-commit-group-size" of
+# them).  The response to a request is sent once its changes are committed.
+# The Git commit is made by the author of the first transaction, its message
+# tells the author and the message of every transaction.  If a request
+# aborts its changes while its group is not yet committed, the changes of the
+# whole group are lost (the requests are answered with an error).  Set to 0
+# (the default) to commit every transaction on its own.
+#
+database-commit-window = 0
+database-commit-group-size = 20
+
 # The "index-text" variable defines whether the catalog must process full-text
 # indexing. It requires (much) more time and third-party applications.
 # To speed up catalog updates, set this option to 0 (default is 1).
 #
 index-text = 1
 
+# The "index-text-deferred" variable defines whether the full-text indexing
+# is done later, in the background, instead of within the commit: the text of
+# the files (PDF, office documents...) is not extracted while the database is
+# locked.  Until then, the resources are not found by their text.  The
+# default is 0.
+#
+index-text-deferred = 0
+
+# The text of the office documents (PDF, MS Office, ODF...) is extracted by
+# other processes, reused from one document to the next, at most
+# "text-extraction-processes" at the same time (if zero, the default, it is
+# extracted by the server itself).  An extraction is stopped after
+# "text-extraction-timeout" seconds (default is 60), and a process may not
+# use more than "text-extraction-memory" megabytes (default is 512).  The
+# documents bigger than "text-extraction-max-size" bytes are not read (if
+# zero, the default, there is no limit).  The documents whose text cannot be
+# extracted are indexed without it, and logged to the 'log/extraction' file.
+#
+text-extraction-processes = 0
+text-extraction-timeout = 60
+text-extraction-memory = 512
+text-extraction-max-size = 0
+
+# The text extracted from the office documents is kept in the 'text_cache'
+# folder, so it is not extracted again when the document has not changed
+# (when the catalog is rebuilt for instance).  The "text-cache-size" variable
+# defines the maximum size of the cache, in megabytes; the texts used the
+# longest time ago are removed first.  If zero (the default) there is no
+# cache.
+#
+text-cache-size = 0
+
 # The "accept-cors" variable defines whether the web server accept
 # cross origin requests or not.
 # To accept cross origin requests, set this option to 1 (default is 0)
@@ -154,6 +224,88 @@ accept-cors = 0
 #
 max-width =
 max-height =
+
+# The text responses bigger than "gzip-min-size" bytes (default is 1024) are
+# compressed if the client accepts it. If zero, nothing is compressed.
+# The "gzip-types" variable is the list of the types to compress (if empty
+# the default list, of the text types, is used).
+#
+# Use icms-compress-ui.py to compress the skin files once and for all.
+#
+gzip-min-size = 1024
+gzip-types =
+
+# The "max-upload-size" variable defines the maximum size, in bytes, of the
+# body of a request (ie. max-upload-size = 104857600 for 100 MB). Bigger
+# requests are refused with a "413 Request Entity Too Large" error. If zero
+# (the default) the size is not limited.
+#
+# Uploaded files bigger than "upload-spool-threshold" bytes are written to a
+# temporary file instead of being kept in memory (default is 1048576).
+#
+max-upload-size = 0
+upload-spool-threshold = 1048576
+
+# Requests can be profiled, one profile (pstats format) per request is
+# written to the 'log/profile' folder:
+#
+# - "profile-sample" profiles one request every N (if zero, the default,
+#   there is no sampling);
+# - "profile-paths" profiles the requests whose path starts with one of the
+#   given paths (ie. profile-paths = /users /api/);
+# - "profile-views" profiles the requests to the given views (the name after
+#   the ';' in the URL, ie. profile-views = browse_content edit);
+# - "profile-min-time" keeps only the profiles of the requests that took at
+#   least the given number of milliseconds. If it is the only option set,
+#   one request every 100 is profiled.
+#
+# With the '--profile-time' option of icms-start.py and none of these
+# options set, every request is profiled.
+#
+profile-sample = 0
+profile-paths =
+profile-views =
+profile-min-time = 0
+
+# The requests that take more than "slow-request-time" milliseconds are
+# logged to the 'log/slow' file, with the stack of the request sampled every
+# "slow-request-interval" milliseconds (default is 200) once the time is
+# over. If zero (the default) the slow requests are not logged.
+#
+slow-request-time = 0
+slow-request-interval = 200
+
+# Admission control: the requests are sorted into three budgets, the
+# anonymous GET (and HEAD) requests, the authenticated requests and the
+# requests to /api/. Each budget is given as "concurrent queued wait": the
+# number of requests handled at a time, the number of requests waiting their
+# turn, and how long (in seconds) they wait at most (ie. admission-anonymous
+# = 50 100 5). The other requests are refused with a "503 Service
+# Unavailable" error, telling the clients to come back "admission-retry-after"
+# seconds later (default is 10). If empty (the default) there is no limit.
+#
+admission-anonymous =
+admission-authenticated =
+admission-api =
+admission-retry-after = 10
+
+# Rate limiting, by client: each rule is given as "rate burst", the client
+# may send "burst" requests at once, and then "rate" requests per minute.
+# The other requests are refused with a "429 Too Many Requests" error. The
+# rules apply to the login form ("rate-limit-login"), the register form
+# ("rate-limit-register"), the requests to /api/ ("rate-limit-api") and the
+# images (";thumb" and ";get_image", "rate-limit-image"). If empty (the
+# default) there is no limit.
+#
+# The clients are counted by address. With "rate-limit-by-user = 1" the
+# authenticated requests are counted by user instead (except for the login
+# and register forms), once their credentials are known to be valid.
+#
+rate-limit-login =
+rate-limit-register =
+rate-limit-api =
+rate-limit-image =
+rate-limit-by-user = 0
 """)
 
 
@@ -327,10 +479,22 @@ class Server(object):
     accept_cors = False
     dispatcher = URIDispatcher()
     wsgi_server = None
+    writer_server = None
+    writer_path = None
+    # Serves the requests this process cannot (the readers of the pre-fork
+    # mode forward them to the writer, see ikaaro.workers)
+    writer_application = None
+    text_indexer = None
+    text_extractor = None
+    text_cache = None
+    # Catalog reopen
+    catalog_generation = None
+    catalog_reopen_count = 0
+    catalog_reopen_time = 0.0
 
 
     def __init__(self, target, read_only=False, cache_size=None,
-                 profile_space=False, port=None):
+                 profile_space=False, port=None, mail_spool=True):
         set_server(self)
         target = lfs.get_absolute_path(target)
         self.target = target
@@ -356,6 +520,14 @@ class Server(object):
         # Accept cors
         self.accept_cors = config.get_value(
             'accept-cors', type=Boolean, default=False)
+        # Compression
+        self.gzip_min_size = config.get_value('gzip-min-size')
+        gzip_types = config.get_value('gzip-types') or compressible_types
+        self.gzip_types = frozenset(gzip_types)
+        # Uploads
+        self.max_upload_size = config.get_value('max-upload-size')
+        self.upload_spool_threshold = config.get_value(
+            'upload-spool-threshold')
 
         # Profile Memory
         if profile_space is True:
@@ -373,6 +545,30 @@ class Server(object):
         # Get database
         database = get_database(target, size_min, size_max, read_only)
         self.database = database
+        # Group commit (see Database.save_changes_in_group)
+        commit_window = config.get_value('database-commit-window')
+        if commit_window and not read_only:
+            database.commit_window = commit_window / 1000.0
+            database.commit_group_size = config.get_value(
+                'database-commit-group-size')
+        # Text extraction in other processes (see ikaaro.textextract)
+        processes = config.get_value('text-extraction-processes')
+        if self.index_text and processes and not read_only:
+            self.text_extractor = TextExtractor(
+                '%s/log/extraction' % target, processes,
+                timeout=config.get_value('text-extraction-timeout'),
+                memory=config.get_value('text-extraction-memory'),
+                max_size=config.get_value('text-extraction-max-size'))
+        # Cache of the text extracted (see ikaaro.textcache)
+        text_cache_size = config.get_value('text-cache-size')
+        if self.index_text and text_cache_size and not read_only:
+            self.text_cache = TextCache('%s/text_cache' % target,
+                                        text_cache_size * 1024 * 1024)
+        # Deferred full-text indexing (see ikaaro.textindex)
+        text_deferred = config.get_value('index-text-deferred')
+        if self.index_text and text_deferred and not read_only:
+            self.text_indexer = TextIndexer(database,
+                                            concurrency=processes or 1)
         # Find out the root class
         root = get_root(database)
         self.root = root
@@ -392,7 +588,45 @@ class Server(object):
         logger = WebLogger(event_log)
         register_logger(logger, 'itools.web')
         # Useful the current uploads stats
-        self.upload_stats = {}
+        self.upload_stats = UploadStats()
+        # Time spent by the requests, by phase (see /api/devpanel/metrics)
+        self.request_metrics = RequestMetrics()
+        # Sampled profiling of the requests
+        self.profiler = RequestProfiler(
+            '%s/log/profile' % target,
+            sample=config.get_value('profile-sample'),
+            paths=config.get_value('profile-paths'),
+            views=config.get_value('profile-views'),
+            min_time=config.get_value('profile-min-time'))
+        # The resources to reindex when another changes
+        self.dependencies = DependencyGraph()
+        # Time events
+        self.scheduler = TimeEventScheduler(
+            self.cron_manager, config.get_value('cron-interval'))
+        # Slow requests log
+        self.watchdog = SlowRequestWatchdog(
+            '%s/log/slow' % target,
+            threshold=config.get_value('slow-request-time'),
+            interval=config.get_value('slow-request-interval'))
+        # Admission control
+        limits = {}
+        for name in budget_names:
+            value = config.get_value('admission-%s' % name) or ()
+            value = [ float(x) if i == 2 else int(x)
+                      for i, x in enumerate(value[:3]) ]
+            limits[name] = value
+        self.admission = AdmissionControl(
+            limits, retry_after=config.get_value('admission-retry-after') or 10)
+        # Rate limiting
+        limits = {}
+        for name in rule_names:
+            value = config.get_value('rate-limit-%s' % name) or ()
+            limits[name] = [ int(x) for x in value[:2] ]
+        self.rate_limiter = RateLimiter(
+            limits, by_user=config.get_value('rate-limit-by-user'),
+            verified=self.admission.verified)
+        # Background jobs (run by the writer, see launch_jobs)
+        self.jobs = JobQueue('%s/jobs' % target, database)
 
         # Email service
         self.spool = lfs.resolve2(self.target, 'spool')
@@ -404,8 +638,18 @@ class Server(object):
         self.smtp_host = get_value('smtp-host')
         self.smtp_login = get_value('smtp-login', default='').strip()
         self.smtp_password = get_value('smtp-password', default='').strip()
-        # Email is sent asynchronously
-        self.flush_spool()
+        self.mail_spool = MailSpool(
+            self.spool, self.smtp_host, self.smtp_login, self.smtp_password,
+            rate=get_value('smtp-rate'),
+            batch_size=get_value('smtp-batch-size'),
+            max_retries=get_value('smtp-max-retries'),
+            retry_delay=get_value('smtp-retry-delay'))
+        # Email is sent asynchronously (unless another process is in charge
+        # of the spool, see ikaaro.workers)
+        self.run_mail_spool = mail_spool
+        if mail_spool:
+            self.mail_spool.recover()
+            self.flush_spool()
         # Logging events
         log_file = '%s/log/events' % target
         log_level = config.get_value('log-level')
@@ -440,8 +684,19 @@ class Server(object):
 
     def get_database(self):
         database = self.database
-        # Reopen so if we have one readonly request it will works
-        database.backend.catalog._db.reopen()
+        # Reopen the catalog only when a commit has been done since the last
+        # time we looked (maybe by another process, see ikaaro.workers)
+        generation = get_catalog_generation(self.target)
+        if generation != self.catalog_generation:
+            t0 = time()
+            database.backend.catalog._db.reopen()
+            # Forget the handlers loaded before the commit
+            if self.read_only:
+                database.cache.clear()
+            self.catalog_generation = generation
+            self.catalog_reopen_count += 1
+            self.catalog_reopen_time += time() - t0
+            add_timing('catalog_reopen', time() - t0)
         # Ok
         return database
 
@@ -465,7 +720,9 @@ class Server(object):
     def start(self, detach=False, profile=False, loop=True):
         msg = 'Start database %s %s %s' % (detach, profile, loop)
         log_info(msg)
-        self.profile = '{0}/log/profile'.format(self.target) if profile else None
+        # Profile every request, unless config.conf tells which ones
+        if profile and not self.profiler.is_enabled():
+            self.profiler.sample = 1
         # Daemon mode
         if detach:
             become_daemon()
@@ -487,7 +744,10 @@ class Server(object):
             context.root.launch_at_start(context)
         # Listen & set context
         if not self.read_only:
+            self.load_dependencies()
+            self.launch_text_indexer()
             self.launch_cron()
+            self.launch_jobs()
         self.listen(address, self.port)
 
         # XXX The interpreter do not go here
@@ -496,11 +756,61 @@ class Server(object):
         return True
 
 
+    def start_worker(self, listener, writer_path, profile=False):
+        """Start a worker of a pre-fork server (see ikaaro.workers).  The
+        listening socket is owned by the master process; the writer also
+        listens on the 'writer_path' unix socket, where the readers forward
+        the requests that need to write.
+        """
+        if profile and not self.profiler.is_enabled():
+            self.profiler.sample = 1
+        self.writer_path = writer_path
+        # The writer is in charge of the start hook and of the cron
+        if not self.read_only:
+            with self.database.init_context() as context:
+                context.root.launch_at_start(context)
+            self.load_dependencies()
+            self.launch_text_indexer()
+            self.launch_cron()
+            self.launch_jobs()
+        self.listen(None, self.port, listener=listener)
+
+
+    def load_dependencies(self):
+        # Load the dependencies between the resources, and keep them
+        # up-to-date (instead of searching the catalog at every commit)
+        database = self.database
+        with database.init_context():
+            self.dependencies.load(database)
+        database.dependencies = self.dependencies
+
+
+    def launch_text_indexer(self):
+        text_indexer = self.text_indexer
+        if text_indexer is None:
+            return
+        # Index the text left by the previous run, then the new one
+        database = self.database
+        with database.init_context():
+            text_indexer.load(database)
+        text_indexer.start()
+
+
     def launch_cron(self):
-        # Set cron interval
-        interval = self.config.get_value('cron-interval')
-        if interval:
-            cron(self.cron_manager, interval)
+        if not self.config.get_value('cron-interval'):
+            return
+        # Load the time events, and keep them up-to-date
+        database = self.database
+        with database.init_context() as context:
+            self.scheduler.load(database, context)
+        database.scheduler = self.scheduler
+        self.scheduler.start()
+
+
+    def launch_jobs(self):
+        # Run the jobs left by the previous run, then the new ones
+        self.jobs.recover()
+        self.jobs.start()
 
 
     def reindex_catalog(self, quiet=False, quick=False, as_test=False):
@@ -524,7 +834,20 @@ class Server(object):
         error_detected = False
         if as_test:
             log = open('%s/log/update-catalog' % self.target, 'w').write
-        with self.database.init_context() as context:
+        # Forget the text of the documents not found (unless the text is
+        # indexed later, see ikaaro.textindex)
+        text_cache = self.text_cache
+        if self.text_indexer is not None:
+            text_cache = None
+        if text_cache is not None:
+            text_cache.start_sweep()
+        # The values kept out of the catalog, if loaded (see
+        # Database.update_graphs)
+        database = self.database
+        indexed = []
+        graphs = (getattr(database, 'dependencies', None) is not None or
+                  getattr(database, 'scheduler', None) is not None)
+        with database.init_context() as context:
             for obj in root.traverse_resources():
                 if not quiet or doc_n % 10000==0:
                     print('{0} {1}'.format(doc_n, obj.abspath))
@@ -534,6 +857,8 @@ class Server(object):
                 # Index the document
                 try:
                     catalog.index_document(values)
+                    if graphs:
+                        indexed.append(get_graph_values(values))
                 except Exception:
                     if as_test:
                         error_detected = True
@@ -548,6 +873,8 @@ class Server(object):
                 self.database.make_room()
 
         if not error_detected:
+            if text_cache is not None:
+                text_cache.end_sweep()
             if as_test:
                 # Delete the empty log file
                 remove('%s/log/update-catalog' % self.target)
@@ -566,6 +893,9 @@ class Server(object):
             if lfs.exists(old_catalog_path):
                 lfs.remove(old_catalog_path)
             lfs.move(catalog_path, old_catalog_path)
+            bump_catalog_generation(self.target)
+            if graphs:
+                database.update_graphs(indexed)
             # Commit / Report
             t2, v2 = time(), vmsize()
             v = (v2 - v1)/1024
@@ -608,11 +938,16 @@ class Server(object):
         # Stop wsgi server
         if self.wsgi_server:
             self.wsgi_server.stop()
+        if self.writer_server:
+            self.writer_server.stop()
+        # Stop the text extraction workers
+        if self.text_extractor is not None:
+            self.text_extractor.close()
         # Close database
         self.close()
 
 
-    def listen(self, address, port):
+    def listen(self, address, port, listener=None):
         # Language negotiation
         init_language_selector(select_language)
         # Say hello
@@ -627,16 +962,52 @@ class Server(object):
         if address == '*':
             address = ''
         self.port = port
+        # The page sent when the requests are refused
+        if self.admission.is_enabled():
+            self.render_unavailable()
+        # Read requests are served concurrently, every greenlet must keep
+        # its own context
+        install_context_tracer()
+        # Pre-fork mode: readers forward the writes to the writer
+        wsgi_application = application
+        if self.writer_path:
+            from workers import ReaderApplication, make_unix_listener
+            if self.read_only:
+                wsgi_application = ReaderApplication(self.writer_path)
+                self.writer_application = wsgi_application.forward
+            else:
+                self.writer_server = WSGIServer(
+                    make_unix_listener(self.writer_path),
+                    forwarded_application,
+                    handler_class=ServerHandler,
+                    log=self.access_log)
+                self.writer_server.start()
+        if listener is None:
+            listener = (address or '', port)
         self.wsgi_server = WSGIServer(
-            (address or '', port), application,
+            listener, wsgi_application,
             handler_class=ServerHandler,
             log=self.access_log)
         gevent_signal(SIGTERM, self.stop)
         gevent_signal(SIGINT, self.stop)
-        if self.profile:
-            runctx("self.wsgi_server.serve_forever()", globals(), locals(), self.profile)
-        else:
-            self.wsgi_server.serve_forever()
+        self.wsgi_server.serve_forever()
+
+
+    def render_unavailable(self):
+        """Render once and for all the page of the UnavailableView, sent
+        when a request is refused by the admission control.
+        """
+        try:
+            with self.database.init_context(commit_at_exit=False):
+                response = self.do_request('GET', '/;unavailable')
+        except StandardError:
+            log_error('Cannot render the unavailable page', domain='ikaaro')
+            return
+        entity = response['entity']
+        context = response['context']
+        if type(entity) is str and context.content_type:
+            self.admission.body = entity
+            self.admission.content_type = context.content_type
 
 
     #def save_running_informations(self):
@@ -671,9 +1042,7 @@ class Server(object):
     # Mailing
     #######################################################################
     def get_spool_size(self):
-        spool = lfs.open(self.spool)
-        # We have always a 'failed' directory => "-1"
-        return len(spool.get_names()) - 1
+        return self.mail_spool.get_size()
 
 
     def save_email(self, message):
@@ -688,10 +1057,19 @@ class Server(object):
             file.write(message.as_string())
         finally:
             file.close()
+        # The file is kept in case of crash, see MailSpool.recover
+        name = basename(tmp_path)
+        if self.run_mail_spool:
+            self.mail_spool.add(name)
+        elif self.writer_path:
+            # Sent by the writer (pre-fork mode)
+            from workers import notify_mail_spool
+            notify_mail_spool(self.writer_path, name)
 
 
     def flush_spool(self):
-        cron(self._smtp_send, timedelta(seconds=1))
+        if self.run_mail_spool:
+            self.mail_spool.start()
 
 
     def send_email(self, message):
@@ -699,79 +1077,6 @@ class Server(object):
         self.flush_spool()
 
 
-    def _smtp_send(self):
-        nb_max_mails_to_send = 2
-        spool = lfs.open(self.spool)
-
-        def get_names():
-            # Find out emails to send
-            locks = set()
-            names = set()
-            for name in spool.get_names():
-                if name == 'failed':
-                    # Skip "failed" special directory
-                    continue
-                if name[-5:] == '.lock':
-                    locks.add(name[:-5])
-                else:
-                    names.add(name)
-            names.difference_update(locks)
-            return names
-
-        # Send emails
-        names = get_names()
-        smtp_host = self.smtp_host
-        for name in list(names)[:nb_max_mails_to_send]:
-            # 1. Open connection
-            try:
-                smtp = SMTP(smtp_host)
-            except Exception:
-                self.smtp_log_error()
-                spool.move(name, 'failed/%s' % name)
-                return 60 if get_names() else False
-            log_info('CONNECTED to %s' % smtp_host)
-
-            # 2. Login
-            if self.smtp_login and self.smtp_password:
-                smtp.login(self.smtp_login, self.smtp_password)
-
-            # 3. Send message
-            try:
-                message = spool.open(name).read()
-                headers = HeaderParser().parsestr(message)
-                subject = headers['subject']
-                from_addr = headers['from']
-                to_addr = headers['to']
-                smtp.sendmail(from_addr, to_addr, message)
-                # Remove
-                spool.remove(name)
-                # Log
-                log_msg = 'Email "%s" sent from "%s" to "%s"'
-                log_info(log_msg % (subject, from_addr, to_addr))
-            except SMTPRecipientsRefused:
-                # The recipient addresses has been refused
-                self.smtp_log_error()
-                spool.move(name, 'failed/%s' % name)
-            except SMTPResponseException, excp:
-                # The SMTP server returns an error code
-                self.smtp_log_error()
-                spool.move(name, 'failed/%s_%s' % (excp.smtp_code, name))
-            except Exception:
-                self.smtp_log_error()
-
-            # 4. Close connection
-            smtp.quit()
-
-        # Is there something left?
-        return 60 if get_names() else False
-
-
-    def smtp_log_error(self):
-        summary = 'Error sending email\n'
-        details = format_exc()
-        log_error(summary + details)
-
-
     def register_dispatch_routes(self):
         # Dispatch base routes from ikaaro
         self.register_urlpatterns_from_package('ikaaro.urls')
@@ -819,63 +1124,66 @@ class Server(object):
     # Time events
     #######################################################################
     def cron_manager(self):
+        """Send the time events due by now, see ikaaro.scheduler
+        """
         database = self.database
-        error = False
+        scheduler = self.scheduler
         # Build fake context
         with database.init_context() as context:
             context.is_cron = True
             context.git_message = u'[CRON]'
             # Go
             t0 = time()
-            catalog = database.catalog
             query = RangeQuery('next_time_event', None, context.timestamp)
             search = database.search(query)
-            if not search:
-                return self.config.get_value('cron-interval')
-            nb = len(search)
+            brains = [ x for x in search.get_documents()
+                       if not scheduler.is_failing(x.abspath, t0) ]
+            if not brains:
+                return
+            nb = len(brains)
             msg = 'Cron launched for {nb} resources'.format(nb=nb)
             log_info(msg, domain='itools.cron')
-            for brain in search.get_documents():
+            errors = 0
+            for brain in brains:
                 tcron0 = time()
+                abspath = brain.abspath
                 payload = brain.next_time_event_payload
                 if payload:
                     payload = pickle.loads(payload)
-                resource = database.get_resource(brain.abspath)
+                resource = database.get_resource(abspath)
+                # The changes of every resource are kept apart, so a failure
+                # only aborts those of the resource (and the events of the
+                # others are not sent again)
+                database.start_batch_step()
                 try:
                     resource.time_event(payload)
+                    # Reindex resource (unless removed)
+                    if database.get_resource(abspath, soft=True) is not None:
+                        database.change_resource(resource)
+                    database.save_batch_step()
                 except Exception:
                     # Log error
                     log_error('Cron error\n' + format_exc())
                     context.root.alert_on_internal_server_error(context)
-                    # Abort changes
+                    errors += 1
+                    # Leave the resource aside for a while
+                    scheduler.failed(abspath)
                     database.abort_changes()
-                    # With error
-                    error = True
-                    break
-                # Reindex resource without committing
-                values = resource.get_catalog_values()
-                catalog.index_document(values)
-                catalog.save_changes()
+                    continue
+                scheduler.succeeded(abspath)
                 # Log
                 tcron1 = time()
-                msg = 'Done for %s in %s seconds' % (brain.abspath, tcron1-tcron0)
+                msg = 'Done for %s in %s seconds' % (abspath, tcron1-tcron0)
                 log_info(msg, domain='itools.cron')
-            # Save changes
-            if not error:
-                try:
-                    database.save_changes()
-                except Exception:
-                    log_error('Cron error on save changes\n' + format_exc())
-                    context.root.alert_on_internal_server_error(context)
+            # Commit, once for all the resources
+            database.flush_group()
             # Message
             t1 = time()
-            if not error:
+            if not errors:
                 msg = '[OK] Cron finished for {nb} resources in {s} seconds'.format(nb=nb, s=t1-t0)
             else:
-                msg = '[ERROR] Cron finished for {nb} resources in {s} seconds'.format(nb=nb, s=t1-t0)
+                msg = '[ERROR] Cron finished for {nb} resources in {s} seconds ({errors} errors)'.format(nb=nb, s=t1-t0, errors=errors)
             log_info(msg, domain='itools.cron')
-        # Again, and again
-        return self.config.get_value('cron-interval')
 
 
 
@@ -987,6 +1295,10 @@ class ServerConfig(ConfigFile):
         'smtp-from': String(default=''),
         'smtp-login': String(default=''),
         'smtp-password': String(default=''),
+        'smtp-rate': Integer(default=0),
+        'smtp-batch-size': Integer(default=50),
+        'smtp-max-retries': Integer(default=5),
+        'smtp-retry-delay': Integer(default=60),
         # Logging
         'log-level': String(default='warning'),
         'log-email': Email(default=''),
@@ -997,9 +1309,40 @@ class ServerConfig(ConfigFile):
         # Tuning
         'database-size': String(default='19500:20500'),
         'database-readonly': Boolean(default=False),
+        'database-commit-window': Integer(default=0),
+        'database-commit-group-size': Integer(default=20),
         'index-text': Boolean(default=True),
+        'index-text-deferred': Boolean(default=False),
+        'text-extraction-processes': Integer(default=0),
+        'text-extraction-timeout': Integer(default=60),
+        'text-extraction-memory': Integer(default=512),
+        'text-extraction-max-size': Integer(default=0),
+        'text-cache-size': Integer(default=0),
         'max-width': Integer(default=None),
         'max-height': Integer(default=None),
+        'gzip-min-size': Integer(default=1024),
+        'gzip-types': Tokens(default=compressible_types),
+        'max-upload-size': Integer(default=0),
+        'upload-spool-threshold': Integer(default=1048576),
+        # Profiling
+        'profile-sample': Integer(default=0),
+        'profile-paths': Tokens(default=()),
+        'profile-views': Tokens(default=()),
+        'profile-min-time': Integer(default=0),
+        # Slow requests
+        'slow-request-time': Integer(default=0),
+        'slow-request-interval': Integer(default=200),
+        # Admission control
+        'admission-anonymous': Tokens(default=()),
+        'admission-authenticated': Tokens(default=()),
+        'admission-api': Tokens(default=()),
+        'admission-retry-after': Integer(default=10),
+        # Rate limiting
+        'rate-limit-login': Tokens(default=()),
+        'rate-limit-register': Tokens(default=()),
+        'rate-limit-api': Tokens(default=()),
+        'rate-limit-image': Tokens(default=()),
+        'rate-limit-by-user': Boolean(default=False),
     }
 
 
@@ -0,0 +1,402 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The mail spool.
+
+The messages are written to the 'spool' folder (see Server.save_email), and
+queued in memory for a greenlet that sends them, keeping the connection to
+the SMTP server open while there are messages to send.  The worker sleeps
+until a message is queued (or must be sent again); the folder is only read
+once, at start, to recover the messages of the previous run.
+
+In pre-fork mode only the writer runs the worker, the readers write the
+messages to the folder and tell the writer (see ikaaro.workers).
+
+The messages are sent in batches of "smtp-batch-size", at most "smtp-rate"
+messages per second.  A message the SMTP server refuses for good (5xx) is
+moved to the 'spool/failed' folder.  Otherwise it is sent again later, at
+most "smtp-max-retries" times, waiting "smtp-retry-delay" seconds the first
+time and twice as long every next time.  When the connection fails, the
+messages wait while the worker connects again.
+"""
+
+# Import from the Standard Library
+from collections import deque
+from email.parser import HeaderParser
+from os import listdir, remove, rename, stat
+from os.path import exists
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused
+from smtplib import SMTPResponseException, SMTPServerDisconnected
+from socket import error as socket_error
+from time import time
+from traceback import format_exc
+
+# Import from gevent
+from gevent import sleep, spawn
+from gevent import socket as gsocket
+from gevent.event import Event
+
+# Import from itools
+from itools.log import log_error, log_info
+
+
+class GeventSMTP(SMTP):
+    """Do not block the other greenlets while talking to the SMTP server.
+    """
+
+    def _get_socket(self, host, port, timeout):
+        return gsocket.create_connection((host, port), timeout)
+
+
+
+class MailSpool(object):
+
+    # Close the connection after this time without messages (seconds)
+    idle_timeout = 60
+    # Check the connection is still open after this time (seconds)
+    noop_interval = 10
+    # Wait before connecting again after a failure (seconds, doubled every
+    # time up to the maximum)
+    reconnect_delay = 5
+    max_reconnect_delay = 300
+    # Timeout of the socket (seconds)
+    timeout = 60
+
+    def __init__(self, path, host, login='', password='', rate=0,
+                 batch_size=50, max_retries=5, retry_delay=60):
+        self.path = path
+        self.host = host
+        self.login = login
+        self.password = password
+        self.rate = rate or 0
+        self.batch_size = batch_size or 50
+        self.max_retries = max_retries or 0
+        self.retry_delay = retry_delay or 60
+        # The worker
+        self.greenlet = None
+        self.event = Event()
+        # The connection
+        self.smtp = None
+        self.last_used = 0
+        self.reconnect_at = 0
+        self.next_reconnect_delay = self.reconnect_delay
+        # The messages to send
+        self.queue = deque()
+        # The messages known, queued, waiting or being sent
+        self.names = set()
+        # The messages to send again: {name: time}, and the number of times
+        # they have been tried: {name: retries}
+        self.waiting = {}
+        self.retries = {}
+        # Stats
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.connections = 0
+        self.connection_errors = 0
+        self.sent_times = deque()
+
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.run)
+
+
+    def run(self):
+        while True:
+            self.event.wait(self.get_timeout())
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.log_error()
+
+
+    def get_timeout(self):
+        """Return the number of seconds to sleep until there is something to
+        do, or None to sleep until a message is queued.
+        """
+        now = time()
+        if now < self.reconnect_at:
+            return self.reconnect_at - now
+        if self.queue:
+            return 0
+        times = self.waiting.values()
+        if self.smtp:
+            times.append(self.last_used + self.idle_timeout)
+        if not times:
+            return None
+        return max(min(times) - now, 0)
+
+
+    def flush(self):
+        now = time()
+        if now < self.reconnect_at:
+            return
+        # The messages to send again
+        for name, send_time in self.waiting.items():
+            if send_time <= now:
+                del self.waiting[name]
+                self.queue.append(name)
+
+        queue = self.queue
+        if queue:
+            size = min(self.batch_size, len(queue))
+            self.send_batch([ queue.popleft() for i in range(size) ])
+        elif self.smtp and now - self.last_used >= self.idle_timeout:
+            self.disconnect()
+
+
+    #######################################################################
+    # The spool folder
+    #######################################################################
+    def add(self, name):
+        """Queue the message, already written to the spool folder (unless
+        it is known already).
+        """
+        if name in self.names:
+            return
+        self.names.add(name)
+        self.queue.append(name)
+        self.event.set()
+
+
+    def forget(self, name):
+        self.names.discard(name)
+        self.retries.pop(name, None)
+
+
+    def recover(self):
+        """Queue the messages left in the spool folder by the previous run,
+        the oldest first.
+        """
+        names = self.names
+        locks = set()
+        messages = []
+        for name in listdir(self.path):
+            if name == 'failed' or name in names:
+                continue
+            if name[-5:] == '.lock':
+                locks.add(name[:-5])
+                continue
+            try:
+                mtime = stat('%s/%s' % (self.path, name)).st_mtime
+            except OSError:
+                continue
+            messages.append((mtime, name))
+        messages.sort()
+        for mtime, name in messages:
+            names.add(name)
+            if name in locks:
+                self.wait(name)
+            else:
+                self.queue.append(name)
+        self.event.set()
+
+
+    def get_size(self):
+        return len(self.queue) + len(self.waiting)
+
+
+    def wait(self, name, delay=None):
+        if delay is None:
+            delay = self.retry_delay
+        self.waiting[name] = time() + delay
+
+
+    def move_to_failed(self, name, target=None):
+        self.forget(name)
+        rename('%s/%s' % (self.path, name),
+               '%s/failed/%s' % (self.path, target or name))
+        self.failed += 1
+
+
+    def retry(self, name):
+        retries = self.retries.get(name, 0) + 1
+        if retries > self.max_retries:
+            self.move_to_failed(name)
+            return
+        self.retries[name] = retries
+        self.wait(name, self.retry_delay * 2 ** (retries - 1))
+        self.retried += 1
+
+
+    #######################################################################
+    # SMTP
+    #######################################################################
+    def connect(self):
+        smtp = self.smtp
+        if smtp is not None:
+            if time() - self.last_used < self.noop_interval:
+                return smtp
+            # The server may have closed the connection meanwhile
+            try:
+                if smtp.noop()[0] == 250:
+                    return smtp
+            except (SMTPException, socket_error):
+                pass
+            self.disconnect()
+
+        smtp = GeventSMTP(self.host, timeout=self.timeout)
+        if self.login and self.password:
+            smtp.login(self.login, self.password)
+        log_info('CONNECTED to %s' % self.host)
+        self.smtp = smtp
+        self.last_used = time()
+        self.connections += 1
+        self.next_reconnect_delay = self.reconnect_delay
+        return smtp
+
+
+    def disconnect(self):
+        smtp = self.smtp
+        if smtp is None:
+            return
+        self.smtp = None
+        try:
+            smtp.quit()
+        except (SMTPException, socket_error):
+            smtp.close()
+
+
+    def connection_failed(self):
+        self.log_error()
+        self.disconnect()
+        self.connection_errors += 1
+        self.reconnect_at = time() + self.next_reconnect_delay
+        self.next_reconnect_delay = min(self.next_reconnect_delay * 2,
+                                        self.max_reconnect_delay)
+
+
+    def send(self, smtp, name):
+        path = '%s/%s' % (self.path, name)
+        with open(path) as file:
+            message = file.read()
+        headers = HeaderParser().parsestr(message, headersonly=True)
+        subject = headers['subject']
+        from_addr = headers['from']
+        to_addr = headers['to']
+        smtp.sendmail(from_addr, to_addr, message)
+        # Remove
+        remove(path)
+        self.forget(name)
+        # Log
+        log_msg = 'Email "%s" sent from "%s" to "%s"'
+        log_info(log_msg % (subject, from_addr, to_addr))
+
+
+    def send_batch(self, names):
+        for i, name in enumerate(names):
+            path = '%s/%s' % (self.path, name)
+            if not exists(path):
+                # Removed meanwhile
+                self.forget(name)
+                continue
+            if exists(path + '.lock'):
+                self.wait(name)
+                continue
+
+            try:
+                smtp = self.connect()
+            except Exception:
+                self.connection_failed()
+                self.queue.extendleft(reversed(names[i:]))
+                return
+
+            try:
+                self.send(smtp, name)
+            except (SMTPServerDisconnected, socket_error):
+                # The message is sent again with the next connection
+                self.retry(name)
+                self.connection_failed()
+                self.queue.extendleft(reversed(names[i+1:]))
+                return
+            except SMTPRecipientsRefused:
+                # The recipient addresses has been refused
+                self.log_error()
+                self.move_to_failed(name)
+            except SMTPResponseException, excp:
+                # The SMTP server returns an error code, try again later
+                # unless it is a permanent error
+                self.log_error()
+                if excp.smtp_code >= 500:
+                    self.move_to_failed(name,
+                                       '%s_%s' % (excp.smtp_code, name))
+                else:
+                    self.retry(name)
+            except Exception:
+                self.log_error()
+                self.retry(name)
+            else:
+                self.sent += 1
+                self.sent_times.append(time())
+                self.prune_sent_times()
+
+            self.last_used = time()
+            if self.rate:
+                sleep(1.0 / self.rate)
+
+
+    def log_error(self):
+        summary = 'Error sending email\n'
+        details = format_exc()
+        log_error(summary + details)
+
+
+    #######################################################################
+    # Metrics
+    #######################################################################
+    def prune_sent_times(self):
+        """Forget the messages sent before the last minute.
+        """
+        since = time() - 60
+        sent_times = self.sent_times
+        while sent_times and sent_times[0] < since:
+            sent_times.popleft()
+
+
+    def get_send_rate(self):
+        """Return the number of messages sent by second, in the last
+        minute.
+        """
+        self.prune_sent_times()
+        return len(self.sent_times) / 60.0
+
+
+    def to_text(self):
+        """Return the state of the spool, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, value, help in [
+            ('ikaaro_mail_spool_size', 'gauge', self.get_size(),
+             'Messages in the spool.'),
+            ('ikaaro_mail_send_rate', 'gauge', self.get_send_rate(),
+             'Messages sent by second, in the last minute.'),
+            ('ikaaro_mail_sent_total', 'counter', self.sent,
+             'Messages sent.'),
+            ('ikaaro_mail_retries_total', 'counter', self.retried,
+             'Messages to be sent again after an error.'),
+            ('ikaaro_mail_failed_total', 'counter', self.failed,
+             'Messages moved to the failed folder.'),
+            ('ikaaro_mail_connections_total', 'counter', self.connections,
+             'Connections to the SMTP server.'),
+            ('ikaaro_mail_connection_errors_total', 'counter',
+             self.connection_errors,
+             'Errors connecting or talking to the SMTP server.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, value))
+        lines.append('')
+        return '\n'.join(lines)
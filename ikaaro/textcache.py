@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the text extracted from the office documents ("text-cache-size",
+see File.to_text), so the text of a file that did not change is not
+extracted again every time the resource is reindexed.
+
+The text is kept in the 'text_cache' folder of the instance, compressed, one
+file by document, named after the SHA-1 of the document.  When the cache is
+bigger than "text-cache-size" megabytes, the entries used the longest time
+ago are removed.  A full reindex of the catalog (see Server.reindex_catalog)
+also removes the entries of the documents not found (see
+TextCache.end_sweep).
+"""
+
+# Import from the Standard Library
+from hashlib import sha1
+from os import listdir, makedirs, remove, rename, stat, utime
+from os.path import exists
+from time import time
+from zlib import compress, decompress, error as zlib_error
+
+# Import from ikaaro
+from database import get_handler_path
+
+
+class TextCache(object):
+
+    # Remove entries until the cache is this much of the maximum size
+    low_water = 0.9
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        # The entries: {sha: [size, last used]}, and their total size
+        self.entries = {}
+        self.size = 0
+        # The entries used by the full reindex, see start_sweep
+        self.used = None
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+
+    def get_path(self, sha):
+        return '%s/%s/%s' % (self.path, sha[:2], sha)
+
+
+    def load(self):
+        """Find out the entries left by the previous run.
+        """
+        if not exists(self.path):
+            makedirs(self.path)
+            return
+        for folder in listdir(self.path):
+            for sha in listdir('%s/%s' % (self.path, folder)):
+                if sha[-4:] == '.tmp':
+                    continue
+                try:
+                    st = stat(self.get_path(sha))
+                except OSError:
+                    continue
+                self.entries[sha] = [st.st_size, st.st_mtime]
+                self.size += st.st_size
+
+
+    def get_key(self, database, handler):
+        """Return the SHA-1 of the document, read from the file behind the
+        handler if possible.
+        """
+        key = sha1()
+        path = get_handler_path(database, handler)
+        if path is None:
+            key.update(handler.to_str())
+        else:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(65536), ''):
+                    key.update(chunk)
+        return key.hexdigest()
+
+
+    def get(self, sha):
+        """Return the text of the document, or None if not in the cache.
+        """
+        entry = self.entries.get(sha)
+        if entry is not None:
+            path = self.get_path(sha)
+            try:
+                with open(path, 'rb') as file:
+                    text = decompress(file.read()).decode('utf-8')
+            except (IOError, OSError, zlib_error):
+                self.forget(sha)
+            else:
+                # Keep the last time used on disk too, for the next run
+                entry[1] = time()
+                utime(path, (entry[1], entry[1]))
+                if self.used is not None:
+                    self.used.add(sha)
+                self.hits += 1
+                return text
+
+        self.misses += 1
+        return None
+
+
+    def put(self, sha, text):
+        data = compress(text.encode('utf-8'))
+        path = self.get_path(sha)
+        folder = '%s/%s' % (self.path, sha[:2])
+        if not exists(folder):
+            makedirs(folder)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        # Atomic
+        rename(tmp_path, path)
+        self.forget(sha, remove_file=False)
+        self.entries[sha] = [len(data), time()]
+        self.size += len(data)
+        if self.used is not None:
+            self.used.add(sha)
+        if self.size > self.max_size:
+            self.evict()
+
+
+    def forget(self, sha, remove_file=True):
+        entry = self.entries.pop(sha, None)
+        if entry is None:
+            return
+        self.size -= entry[0]
+        if remove_file:
+            try:
+                remove(self.get_path(sha))
+            except OSError:
+                pass
+
+
+    def evict(self):
+        """Remove the entries used the longest time ago, until the cache is
+        small enough.
+        """
+        size = self.max_size * self.low_water
+        entries = sorted(self.entries.items(), key=lambda x: x[1][1])
+        for sha, entry in entries:
+            if self.size <= size:
+                break
+            self.forget(sha)
+            self.evictions += 1
+
+
+    #######################################################################
+    # Clean up, on full reindex
+    #######################################################################
+    def start_sweep(self):
+        """Start counting the entries used, see end_sweep.
+        """
+        self.used = set()
+
+
+    def end_sweep(self):
+        """Remove the entries not used since start_sweep: the documents
+        have been removed or changed.
+        """
+        used = self.used
+        if used is None:
+            return
+        self.used = None
+        for sha in self.entries.keys():
+            if sha not in used:
+                self.forget(sha)
+
+
+    #######################################################################
+    # Metrics
+    #######################################################################
+    def to_text(self):
+        """Return the state of the cache, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, value, help in [
+            ('ikaaro_text_cache_entries', 'gauge', len(self.entries),
+             'Documents whose text is in the cache.'),
+            ('ikaaro_text_cache_bytes', 'gauge', self.size,
+             'Size of the cache (compressed).'),
+            ('ikaaro_text_cache_hits_total', 'counter', self.hits,
+             'Texts found in the cache.'),
+            ('ikaaro_text_cache_misses_total', 'counter', self.misses,
+             'Texts not found in the cache.'),
+            ('ikaaro_text_cache_evictions_total', 'counter', self.evictions,
+             'Texts removed from the cache, the cache being too big.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, value))
+        lines.append('')
+        return '\n'.join(lines)
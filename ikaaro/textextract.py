@@ -0,0 +1,281 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Text extraction in other processes ("text-extraction-processes").
+
+The text of the office documents (PDF, MS Office, ODF...) is extracted by a
+pool of worker processes (see File.to_text), so a document that makes the
+parser loop or eat the memory does not hurt the server.  At most
+"text-extraction-processes" of them run at the same time, each extracting
+the documents one after the other.  A worker is killed after
+"text-extraction-timeout" seconds on a document, it may not use more than
+"text-extraction-memory" megabytes (it stops when it runs out of memory), and
+it is replaced after "max_documents" documents.  The documents bigger than
+"text-extraction-max-size" bytes are not read.
+
+When the text cannot be extracted, the document is indexed without it, and
+the failure is appended to the 'log/extraction' file, one JSON object per
+line (see /api/devpanel/log/extraction).
+"""
+
+# Import from the Standard Library
+from json import dumps
+from os.path import getsize
+from resource import RLIMIT_AS, setrlimit
+import sys
+from time import strftime
+
+# Import from gevent
+from gevent import Timeout
+from gevent.lock import Semaphore
+from gevent.subprocess import Popen, PIPE
+
+# Import from itools
+from itools.web import get_context
+
+# Import from ikaaro
+from database import DBSEM, get_handler_path
+
+
+# Run by the worker: for every document, read a line from stdin with the
+# module and the name of the handler class and the size of the document,
+# then the document; write a line to stdout with the status ('ok', 'error',
+# or 'exit' if the worker stops) and the size of the answer, then the answer
+# (the text, UTF-8, or the error).  The CPU time is limited by document.
+child_code = """
+import sys
+from importlib import import_module
+from resource import RLIMIT_CPU, RLIM_INFINITY, RUSAGE_SELF
+from resource import getrusage, setrlimit
+timeout = int(sys.argv[1])
+stdin, stdout = sys.stdin, sys.stdout
+while True:
+    line = stdin.readline()
+    if not line:
+        break
+    module, name, size = line.split()
+    data = stdin.read(int(size))
+    if timeout:
+        usage = getrusage(RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime)
+        setrlimit(RLIMIT_CPU, (used + timeout, RLIM_INFINITY))
+    status = 'ok'
+    try:
+        cls = getattr(import_module(module), name)
+        answer = cls(string=data).to_text().encode('utf-8')
+    except MemoryError:
+        status, answer = 'exit', 'out of memory'
+    except Exception, error:
+        status, answer = 'error', repr(error)
+    data = None
+    stdout.write('%s %d\\n' % (status, len(answer)))
+    stdout.write(answer)
+    stdout.flush()
+    if status == 'exit':
+        break
+"""
+
+
+class ExtractionError(Exception):
+    pass
+
+
+
+class ExtractionWorker(object):
+    """A worker process, see child_code.
+    """
+
+    def __init__(self, extractor):
+        command = [sys.executable, '-c', child_code,
+                   str(extractor.timeout or 0)]
+        self.process = Popen(command, stdin=PIPE, stdout=PIPE,
+                             preexec_fn=extractor.set_limits, close_fds=True)
+        self.documents = 0
+        # Between a question and its answer
+        self.busy = False
+
+
+    def is_ready(self):
+        return not self.busy and self.process.poll() is None
+
+
+    def extract(self, cls, data):
+        process = self.process
+        self.busy = True
+        self.documents += 1
+        try:
+            header = '%s %s %d\n' % (cls.__module__, cls.__name__, len(data))
+            process.stdin.write(header)
+            process.stdin.write(data)
+            process.stdin.flush()
+            line = process.stdout.readline()
+            if line:
+                status, size = line.split()
+                answer = process.stdout.read(int(size))
+        except (IOError, OSError):
+            line = None
+        if not line:
+            raise ExtractionError('exit status %d' % self.stop())
+        self.busy = False
+
+        if status == 'ok':
+            return unicode(answer, 'utf-8')
+        if status == 'exit':
+            self.stop()
+        raise ExtractionError(answer)
+
+
+    def stop(self):
+        """Stop the worker, return its exit status.
+        """
+        process = self.process
+        if process.poll() is None:
+            process.kill()
+        return process.wait()
+
+
+
+class TextExtractor(object):
+
+    # Replace a worker after it has extracted this many documents (the
+    # parsers do not always free their memory)
+    max_documents = 100
+
+    def __init__(self, log_path, processes=2, timeout=60, memory=512,
+                 max_size=0):
+        self.log_path = log_path
+        self.processes = processes
+        self.timeout = timeout or None
+        self.memory = memory or None
+        self.max_size = max_size or None
+        self.semaphore = Semaphore(processes)
+        # The workers waiting for a document
+        self.workers = []
+        # Stats
+        self.extracted = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.skipped = 0
+
+
+    def extract_text(self, handler, abspath):
+        """Return the text of the handler, or None if it cannot be
+        extracted.
+        """
+        # The size of the file on disk, not to load a document too big
+        database = handler.database
+        path = get_handler_path(database, handler) if database else None
+        if path is None:
+            data = handler.to_str()
+            size = len(data)
+        else:
+            size = getsize(path)
+        if self.max_size and size > self.max_size:
+            self.skipped += 1
+            self.report(abspath, handler, size, 'too big')
+            return None
+        if path is not None:
+            with open(path, 'rb') as file:
+                data = file.read()
+
+        # The text indexer (see ikaaro.textindex) does not hold the
+        # database meanwhile
+        context = get_context()
+        unlock = (getattr(context, 'unlock_extraction', False)
+                  and DBSEM.is_reader())
+        if unlock:
+            DBSEM.release()
+        try:
+            with self.semaphore:
+                text = self.extract(handler.__class__, data)
+        except ExtractionError, error:
+            self.failed += 1
+            self.report(abspath, handler, size, str(error))
+            return None
+        finally:
+            if unlock:
+                DBSEM.acquire(write=False)
+        self.extracted += 1
+        return text
+
+
+    def set_limits(self):
+        # Called by the worker, before running the code
+        if self.memory:
+            size = self.memory * 1024 * 1024
+            setrlimit(RLIMIT_AS, (size, size))
+
+
+    def extract(self, cls, data):
+        workers = self.workers
+        worker = workers.pop() if workers else ExtractionWorker(self)
+        timeout = Timeout(self.timeout)
+        timeout.start()
+        try:
+            return worker.extract(cls, data)
+        except Timeout, error:
+            if error is not timeout:
+                raise
+            worker.stop()
+            self.timeouts += 1
+            raise ExtractionError('timeout')
+        finally:
+            timeout.cancel()
+            if worker.is_ready() and worker.documents < self.max_documents:
+                workers.append(worker)
+            else:
+                worker.stop()
+
+
+    def close(self):
+        """Stop the workers waiting for a document.
+        """
+        workers = self.workers
+        while workers:
+            workers.pop().stop()
+
+
+    def report(self, abspath, handler, size, error):
+        entry = {
+            'time': strftime('%Y-%m-%d %H:%M:%S'),
+            'abspath': str(abspath),
+            'mimetype': handler.get_mimetype(),
+            'size': size,
+            'error': error}
+        with open(self.log_path, 'a') as file:
+            file.write(dumps(entry) + '\n')
+
+
+    #######################################################################
+    # Metrics
+    #######################################################################
+    def to_text(self):
+        """Return the stats, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, value, help in [
+            ('ikaaro_text_extraction_total', 'counter', self.extracted,
+             'Documents whose text has been extracted.'),
+            ('ikaaro_text_extraction_failed_total', 'counter', self.failed,
+             'Documents whose text could not be extracted.'),
+            ('ikaaro_text_extraction_timeouts_total', 'counter',
+             self.timeouts, 'Extractions stopped after the timeout.'),
+            ('ikaaro_text_extraction_skipped_total', 'counter', self.skipped,
+             'Documents too big to be read.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, value))
+        lines.append('')
+        return '\n'.join(lines)
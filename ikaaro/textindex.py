@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred full-text indexing ("index-text-deferred").
+
+The text of the resources (DBResource.to_text) is not extracted when they
+are indexed, within the commit: the resources are indexed without it and
+marked ('text_pending'), then queued for a greenlet that extracts the text
+later, sharing the database with the requests, and indexes it, a batch of
+resources at a time.  The text of "concurrency" resources is extracted at
+the same time (the number of "text-extraction-processes", see
+ikaaro.textextract, which do not hold the database meanwhile).
+
+The queue is kept in memory.  The resources left by the previous run are
+found in the catalog at start ('text_pending').
+"""
+
+# Import from the Standard Library
+from collections import OrderedDict
+from time import time
+from traceback import format_exc
+
+# Import from gevent
+from gevent import sleep, spawn
+from gevent.event import Event
+from gevent.pool import Pool
+
+# Import from itools
+from itools.database import PhraseQuery
+from itools.log import log_error, log_warning
+
+
+class TextIndexer(object):
+
+    # Index the text of N resources at most by catalog commit
+    batch_size = 20
+
+    def __init__(self, database=None, concurrency=1):
+        self.database = database
+        self.concurrency = concurrency
+        # The resources to index, the oldest first: {abspath: time queued}
+        self.queue = OrderedDict()
+        # The text of the resources being indexed: {abspath: text}
+        self.texts = {}
+        # The worker
+        self.event = Event()
+        self.greenlet = None
+        # Stats
+        self.indexed = 0
+        self.failed = 0
+
+
+    def load(self, database):
+        """Queue the resources whose text was not indexed by the previous
+        run.
+        """
+        query = PhraseQuery('text_pending', True)
+        for brain in database.search(query).get_documents():
+            self.add(brain.abspath)
+
+
+    def add(self, abspath):
+        if abspath not in self.queue:
+            self.queue[abspath] = time()
+            self.event.set()
+
+
+    def defer(self, resource, values):
+        """Called by DBResource.get_catalog_values: set the text of the
+        resource if it has been extracted, queue the resource otherwise.
+        """
+        abspath = values['abspath']
+        text = self.texts.get(abspath)
+        if text is not None:
+            values['text'] = text
+        else:
+            values['text_pending'] = True
+            self.add(abspath)
+
+
+    #######################################################################
+    # The worker
+    #######################################################################
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.run)
+
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            while self.queue:
+                try:
+                    self.index_batch()
+                except Exception:
+                    log_error('Text indexing error\n' + format_exc())
+                sleep(0)
+
+
+    def extract(self, resource):
+        try:
+            return resource.to_text()
+        except Exception:
+            log_warning('Indexation failed: %s' % resource.abspath,
+                        domain='ikaaro')
+            self.failed += 1
+            return u''
+
+
+    def index_batch(self):
+        database = self.database
+        queue = self.queue
+        # 1. Extract the text, only reading the database (so the other
+        # readers are not held)
+        texts = {}
+        def extract(abspath):
+            with database.init_context(commit_at_exit=False,
+                                       write_lock=False) as context:
+                context.unlock_extraction = True
+                resource = context.root.get_resource(abspath, soft=True)
+                if resource is not None:
+                    texts[abspath] = self.extract(resource)
+            sleep(0)
+
+        size = min(self.batch_size, len(queue))
+        paths = [ queue.popitem(last=False)[0] for i in range(size) ]
+        Pool(self.concurrency).map(extract, paths)
+        if not texts:
+            return
+
+        # 2. Index
+        with database.init_context(commit_at_exit=False) as context:
+            root = context.root
+            catalog = database.catalog
+            self.texts = texts
+            try:
+                for abspath in texts:
+                    # Changed meanwhile, its text will be extracted again
+                    if abspath in queue:
+                        continue
+                    resource = root.get_resource(abspath, soft=True)
+                    if resource is None:
+                        continue
+                    catalog.index_document(resource.get_catalog_values())
+                    self.indexed += 1
+                database.save_catalog_changes()
+            except Exception:
+                # Left to the next run, see load
+                catalog.abort_changes()
+                raise
+            finally:
+                self.texts = {}
+
+
+    #######################################################################
+    # Metrics
+    #######################################################################
+    def get_size(self):
+        return len(self.queue)
+
+
+    def get_lag(self):
+        """Return the time the oldest resource of the queue has been waiting
+        (seconds).
+        """
+        for queued in self.queue.itervalues():
+            return time() - queued
+        return 0.0
+
+
+    def to_text(self):
+        """Return the state of the indexer, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, value, help in [
+            ('ikaaro_text_index_pending', 'gauge', self.get_size(),
+             'Resources whose text is to be indexed.'),
+            ('ikaaro_text_index_lag_seconds', 'gauge', self.get_lag(),
+             'Time the oldest resource to index has been waiting.'),
+            ('ikaaro_text_index_total', 'counter', self.indexed,
+             'Resources whose text has been indexed.'),
+            ('ikaaro_text_index_failed_total', 'counter', self.failed,
+             'Resources whose text could not be extracted.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, value))
+        lines.append('')
+        return '\n'.join(lines)
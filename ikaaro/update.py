@@ -24,6 +24,11 @@ from itools.database import AndQuery, PhraseQuery, RangeQuery
 from itools.gettext import MSG
 from itools.web import STLView, ERROR
 
+# Import from ikaaro
+from database import get_graph_values
+from jobs import register_job
+from messages import MSG_JOB_QUEUED
+
 
 ERROR_MSG = MSG(u'Inconsistent class_id "{class_id}", resource version is {resource_version} but cls_version is {cls_version} ({abspath})')
 
@@ -104,8 +109,9 @@ def find_versions_to_update(context, force=False):
 
 
 
-def run_next_update_method(context, force=False):
-    """Update the database to the given versions.
+def run_next_update_method(context, force=False, progress=None):
+    """Update the database to the given versions.  The progress function,
+    if given, is called with the number of resources done and the total.
     """
     database = context.database
     log = open('{0}/log/update'.format(database.path), 'w')
@@ -130,9 +136,14 @@ def run_next_update_method(context, force=False):
     context.set_mtime = False
     # Update
     i = 0
+    total = len(search)
     resources_old2new = database.resources_old2new
+    # The resources reindexed directly, see Database.update_graphs
+    indexed = []
     for resource in search.get_resources():
         i += 1
+        if progress:
+            progress(i, total, git_message)
         path = str(resource.abspath)
         abspath = resources_old2new.get(path, path)
         if abspath is None:
@@ -148,6 +159,7 @@ def run_next_update_method(context, force=False):
             database.catalog.unindex_document(str(resource.abspath))
             values = resource.get_catalog_values()
             database.catalog.index_document(values)
+            indexed.append(get_graph_values(values))
             continue
 
         try:
@@ -165,20 +177,23 @@ def run_next_update_method(context, force=False):
             if force is False:
                 return messages
         # Commit every 200 resources for better performances
-        if i % 200 == 0:
+        if i % 200 == 0 and database.has_changed:
             database.save_changes()
+            database.update_graphs(indexed)
+            indexed = []
     # Commit
     if not database.has_changed:
         # We reindex so the class_version is reindexed
-        database.catalog.save_changes()
+        database.save_catalog_changes()
     else:
         database.save_changes()
+    database.update_graphs(indexed)
     # Ok
     return messages
 
 
 
-def do_run_next_update_method(context, force=False):
+def do_run_next_update_method(context, force=False, progress=None):
     if context.server.read_only:
         return
     versions = find_versions_to_update(context, force)
@@ -188,7 +203,7 @@ def do_run_next_update_method(context, force=False):
     if not versions['cls_to_update']:
         return [MSG(u'Nothing to update')]
     while versions['cls_to_update']:
-        messages = run_next_update_method(context, force)
+        messages = run_next_update_method(context, force, progress)
         if messages:
             # Abort changes
             context.database.abort_changes()
@@ -212,10 +227,12 @@ class UpdateInstanceView(STLView):
 
 
     def run_next_update_method(self, context, force=False):
-        # Run update method
-        msgs = do_run_next_update_method(context, force)
+        # Run update method, in the background
+        user = context.user.name if context.user else None
+        job_id = context.server.jobs.add(
+            'update_instance', u'Update instance', user=user, force=force)
         # Ok
-        context.message = msgs
+        context.message = MSG_JOB_QUEUED.gettext(id=job_id)
 
 
     def action_do_next_update(self, resource, context, form):
@@ -224,3 +241,17 @@ class UpdateInstanceView(STLView):
 
     def action_force_next_update(self, resource, context, form):
         return self.run_next_update_method(context, force=True)
+
+
+
+def update_instance(context, job, force=False):
+    """The job of UpdateInstanceView, return the messages.
+    """
+    messages = do_run_next_update_method(context, force, job.progress)
+    if not messages:
+        return []
+    # The errors of the update methods are byte strings (see
+    # run_next_update_method)
+    return [ x.gettext() if isinstance(x, MSG) else x for x in messages ]
+
+register_job('update_instance', update_instance)
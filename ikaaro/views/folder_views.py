@@ -37,6 +37,7 @@ from ikaaro.buttons import Remove_BrowseButton, RenameButton, CopyButton, CutBut
 from ikaaro.buttons import ZipButton
 from ikaaro.datatypes import CopyCookie
 from ikaaro.exceptions import ConsistencyError
+from ikaaro.jobs import register_job
 from ikaaro.utils import generate_name, get_base_path_query
 from ikaaro.widgets import SelectWidget, TextWidget
 from ikaaro import messages
@@ -711,13 +712,26 @@ class Folder_BrowseContent(BrowseForm):
 
     def action_zip(self, resource, context, form):
         names = sorted(form['ids'], reverse=True)
-        data = resource.export_zip(names)
-        # Content-Type & Content-Disposition
-        context.set_content_type('application/zip')
-        filename = 'archive.zip'
-        context.set_content_disposition('inline', filename)
-        # Ok
-        return data
+        # The archive is built in the background, then downloaded from
+        # the result of the job
+        user = context.user.name if context.user else None
+        job_id = context.server.jobs.add(
+            'export_zip', u'Zip %s' % resource.abspath, user=user,
+            folder=str(resource.abspath), names=names)
+        url = '/api/devpanel/jobs/%s/result' % job_id
+        return context.come_back(messages.MSG_ARCHIVE_QUEUED, url=url)
+
+
+
+def export_zip(context, job, folder, names):
+    """The job of Folder_BrowseContent.action_zip
+    """
+    folder = context.database.get_resource(folder)
+    with open(job.get_result_path(), 'wb') as file:
+        folder.export_zip(names, file, progress=job.progress)
+    job.set_result_file('application/zip', 'archive.zip')
+
+register_job('export_zip', export_zip)
 
 
 
@@ -0,0 +1,140 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Slow requests watchdog.
+
+While a request lasts longer than "slow-request-time", the stack of its
+greenlet is sampled every "slow-request-interval".  When it ends, an entry
+is appended to the 'log/slow' file, one JSON object per line.
+
+The sampling is done by a system thread, so a request that does not give
+the hand back to the other greenlets (a long computation) is sampled too.
+"""
+
+# Import from the Standard Library
+from json import dumps
+import sys
+from thread import get_ident, start_new_thread
+from time import sleep, strftime, time
+from traceback import format_stack
+
+# Import from gevent
+from gevent import getcurrent
+
+# Import from ikaaro
+from metrics import get_route
+
+
+class WatchedRequest(object):
+
+    __slots__ = ['greenlet', 'environ', 't0', 'samples']
+
+    def __init__(self, greenlet, environ):
+        self.greenlet = greenlet
+        self.environ = environ
+        self.t0 = time()
+        self.samples = []
+
+
+
+class SlowRequestWatchdog(object):
+
+    # Keep the memory bounded for the requests that never end
+    max_samples = 50
+
+    def __init__(self, path, threshold=0, interval=200):
+        self.path = path
+        self.threshold = (threshold or 0) / 1000.0
+        self.interval = (interval or 200) / 1000.0
+        # {greenlet: WatchedRequest}
+        self.requests = {}
+        self.thread_id = None
+        self.main_thread_id = None
+
+
+    def start(self, environ):
+        """Start watching the request, return None if the watchdog is
+        disabled.
+        """
+        if not self.threshold:
+            return None
+        # Start the sampling thread (there are no threads after a fork)
+        if self.thread_id is None:
+            self.main_thread_id = get_ident()
+            self.thread_id = start_new_thread(self.run, ())
+        greenlet = getcurrent()
+        request = WatchedRequest(greenlet, environ)
+        self.requests[greenlet] = request
+        return request
+
+
+    def stop(self, request, context):
+        self.requests.pop(request.greenlet, None)
+        seconds = time() - request.t0
+        if seconds < self.threshold:
+            return
+        # Build the entry
+        environ = request.environ
+        uri = environ.get('PATH_INFO') or '/'
+        query = environ.get('QUERY_STRING')
+        if query:
+            uri = '%s?%s' % (uri, query)
+        user = getattr(context, 'user', None)
+        timings = getattr(context, 'timings', None) or {}
+        commit_time = timings.get('before_commit', 0) + timings.get('commit', 0)
+        entry = {
+            'date': strftime('%Y-%m-%d %H:%M:%S'),
+            'method': environ.get('REQUEST_METHOD'),
+            'uri': uri,
+            'view': get_route(context),
+            'user': user.name if user else None,
+            'time': round(seconds, 6),
+            'lock_wait': round(timings.get('lock_wait', 0), 6),
+            'search_count': getattr(context, 'search_count', 0),
+            'commit_time': round(commit_time, 6),
+            'timings': dict([ (k, round(v, 6)) for k, v in timings.items() ]),
+            'samples': [ {'time': t, 'stack': stack}
+                         for t, stack in request.samples ]}
+        # Write
+        with open(self.path, 'a') as log:
+            log.write(dumps(entry) + '\n')
+
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.sample()
+            except Exception:
+                # The requests change while we look at them, try again
+                pass
+
+
+    def sample(self):
+        now = time()
+        for request in self.requests.values():
+            seconds = now - request.t0
+            if seconds < self.threshold:
+                continue
+            if len(request.samples) >= self.max_samples:
+                continue
+            # The frame of a running greenlet is the one of the main thread
+            frame = request.greenlet.gr_frame
+            if frame is None:
+                frame = sys._current_frames().get(self.main_thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(format_stack(frame))
+            request.samples.append((round(seconds, 3), stack))
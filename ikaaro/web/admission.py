@@ -0,0 +1,221 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Admission control.
+
+The requests are sorted into three budgets, each with its own limits:
+
+- api: the requests to /api/
+- authenticated: the requests with valid credentials (the 'iauth' cookie or
+  the Authorization header), and the anonymous requests that are not GET or
+  HEAD (login, register...)
+- anonymous: the other requests
+
+A budget admits up to "concurrent" requests at a time.  The requests beyond
+wait in a queue of up to "queued" requests, for at most "wait" seconds.  The
+other requests are rejected at once with "503 Service Unavailable" and a
+Retry-After header, the body is the page of the UnavailableView.
+
+The limits are set in config.conf, for instance "admission-anonymous = 50
+100 5" (a limit of 0, or no value, means no limit).  The requests are
+admitted before they enter the database context, and leave once it is
+released (before the response is sent).
+
+The credentials cannot be checked before the database is touched: they are
+known to be valid once a request carrying them has been authenticated (see
+AdmissionControl.verify).  Until then, or once they fail, the request is
+given the anonymous budget.
+"""
+
+# Import from the Standard Library
+from collections import OrderedDict
+from Cookie import SimpleCookie, CookieError
+
+# Import from gevent
+from gevent.lock import Semaphore
+
+# Import from itools
+from itools.web.utils import reason_phrases
+
+
+budget_names = ('anonymous', 'authenticated', 'api')
+
+
+def get_credentials(environ):
+    """Return the credentials of the request (the Authorization header or
+    the 'iauth' cookie), or None.
+    """
+    credentials = environ.get('HTTP_AUTHORIZATION')
+    if credentials:
+        return credentials
+    cookies = environ.get('HTTP_COOKIE')
+    if not cookies or 'iauth=' not in cookies:
+        return None
+    try:
+        cookie = SimpleCookie(cookies).get('iauth')
+    except CookieError:
+        return None
+    if cookie is None:
+        return None
+    return cookie.value or None
+
+
+
+class AdmissionBudget(object):
+
+    def __init__(self, name, concurrent=0, queued=0, wait=0):
+        self.name = name
+        self.max_concurrent = concurrent
+        self.max_queued = queued
+        self.max_wait = wait or None
+        if concurrent:
+            self.semaphore = Semaphore(concurrent)
+        else:
+            self.semaphore = None
+        # Stats
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+
+
+    def acquire(self):
+        """Return True if the request is admitted, False if it must be
+        rejected.
+        """
+        semaphore = self.semaphore
+        if semaphore is None:
+            self.active += 1
+            return True
+
+        if semaphore.locked():
+            # Queue
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            try:
+                admitted = semaphore.acquire(timeout=self.max_wait)
+            finally:
+                self.queued -= 1
+            if not admitted:
+                self.rejected += 1
+                return False
+        else:
+            semaphore.acquire()
+
+        self.active += 1
+        return True
+
+
+    def release(self):
+        self.active -= 1
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+
+class AdmissionControl(object):
+
+    # Remember the valid credentials of so many sessions at most
+    max_verified = 10000
+
+    def __init__(self, limits, retry_after=10):
+        """The limits are given by budget name:
+
+            {'anonymous': (concurrent, queued, wait), ...}
+        """
+        self.budgets = {}
+        for name in budget_names:
+            budget_limits = limits.get(name) or ()
+            self.budgets[name] = AdmissionBudget(name, *budget_limits)
+        self.retry_after = retry_after
+        # The body of the 503 responses, see Server.render_unavailable
+        self.content_type = 'text/plain'
+        self.body = '503 %s' % reason_phrases[503]
+        # The credentials known to be valid, the last used at the end
+        self.verified = OrderedDict()
+
+
+    def is_enabled(self):
+        for budget in self.budgets.itervalues():
+            if budget.semaphore is not None:
+                return True
+        return False
+
+
+    def get_budget(self, environ):
+        path = environ.get('PATH_INFO') or '/'
+        if path.startswith('/api/'):
+            return self.budgets['api']
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.budgets['authenticated']
+        credentials = get_credentials(environ)
+        if credentials and credentials in self.verified:
+            return self.budgets['authenticated']
+        return self.budgets['anonymous']
+
+
+    def verify(self, environ, authenticated):
+        """Called once the request has been handled: remember whether its
+        credentials, if any, are valid.
+        """
+        credentials = get_credentials(environ)
+        if not credentials:
+            return
+        verified = self.verified
+        verified.pop(credentials, None)
+        if authenticated:
+            verified[credentials] = True
+            if len(verified) > self.max_verified:
+                verified.popitem(last=False)
+
+
+    def unavailable_application(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if path.startswith('/api/'):
+            content_type = 'text/plain'
+            body = '503 %s' % reason_phrases[503]
+        else:
+            content_type = self.content_type
+            body = self.body
+        headers = [
+            ('Server', 'ikaaro.web'),
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(self.retry_after)),
+            ('Cache-Control', 'no-cache')]
+        start_response('503 %s' % reason_phrases[503], headers)
+        return [body]
+
+
+    def to_text(self):
+        """Return the state of the budgets, in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, attribute, help in [
+            ('ikaaro_admission_active', 'gauge', 'active',
+             'Requests being handled.'),
+            ('ikaaro_admission_queued', 'gauge', 'queued',
+             'Requests waiting to be admitted.'),
+            ('ikaaro_admission_rejected_total', 'counter', 'rejected',
+             'Requests rejected with 503.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for budget_name in budget_names:
+                budget = self.budgets[budget_name]
+                lines.append('%s{budget="%s"} %d'
+                             % (name, budget_name, getattr(budget, attribute)))
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Gzip compression of the responses.
+
+Text responses are compressed when the client accepts it, if they are big
+enough ("gzip-min-size" in config.conf) and their type is in the allowlist
+("gzip-types").  The skin files may be compressed once and for all with
+icms-compress-ui.py, their compressed variant (a '.gz' file next to the
+original) is then served directly.
+"""
+
+# Import from the Standard Library
+from cStringIO import StringIO
+from gzip import GzipFile
+from os import stat, walk
+from os.path import basename
+
+# Import from itools
+from itools.fs.common import get_mimetype
+
+
+# Default allowlist of the types to compress
+compressible_types = (
+    'application/javascript', 'application/json', 'application/x-javascript',
+    'application/xhtml+xml', 'application/xml', 'image/svg+xml', 'text/css',
+    'text/csv', 'text/html', 'text/javascript', 'text/plain', 'text/xml')
+
+
+def accepts_gzip(environ):
+    """Tell whether the client accepts gzip encoded responses.
+    """
+    accept_encoding = environ.get('HTTP_ACCEPT_ENCODING')
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        coding, kk, parameters = coding.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        # gzip;q=0 means "not acceptable"
+        parameters = parameters.replace(' ', '')
+        if parameters.startswith('q='):
+            try:
+                return float(parameters[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+
+def is_compressible(content_type, types):
+    if not content_type:
+        return False
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    return mimetype in types
+
+
+
+def gzip_data(data, level=6):
+    output = StringIO()
+    # mtime=0 so the same data always gives the same bytes
+    gzip_file = GzipFile(fileobj=output, mode='wb', compresslevel=level,
+                         mtime=0)
+    gzip_file.write(data)
+    gzip_file.close()
+    return output.getvalue()
+
+
+
+def get_gzip_etag(etag):
+    """The ETag of the compressed variant must differ from the original.
+    """
+    if etag.endswith('"'):
+        return etag[:-1] + '-gzip"'
+    return etag
+
+
+
+def get_vary(headers):
+    vary = [ value for name, value in headers if name.lower() == 'vary' ]
+    vary = [ x.strip() for x in ','.join(vary).split(',') if x.strip() ]
+    if 'accept-encoding' not in [ x.lower() for x in vary ]:
+        vary.append('Accept-Encoding')
+    return ', '.join(vary)
+
+
+
+def compress_response(environ, headers, entity, min_size, types):
+    """Compress the entity if possible, return the new headers and entity.
+    """
+    if not min_size or len(entity) < min_size:
+        return headers, entity
+    content_type = None
+    for name, value in headers:
+        name = name.lower()
+        if name == 'content-type':
+            content_type = value
+        elif name in ('content-encoding', 'content-range'):
+            return headers, entity
+    if not is_compressible(content_type, types):
+        return headers, entity
+
+    # The response depends on the Accept-Encoding header
+    headers = [ x for x in headers if x[0].lower() != 'vary' ] + [
+        ('Vary', get_vary(headers))]
+    if not accepts_gzip(environ):
+        return headers, entity
+
+    entity = gzip_data(entity)
+    new_headers = []
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'content-length':
+            value = str(len(entity))
+        elif lower == 'etag':
+            value = get_gzip_etag(value)
+        new_headers.append((name, value))
+    new_headers.append(('Content-Encoding', 'gzip'))
+    return new_headers, entity
+
+
+
+def precompress_folder(path, min_size, types):
+    """Write a compressed copy (with the '.gz' extension) of the files of the
+    given folder, if not already up-to-date.  Return the number of files
+    written.
+    """
+    n = 0
+    for dirpath, dirnames, filenames in walk(path):
+        for filename in filenames:
+            if filename.endswith('.gz'):
+                continue
+            source = '%s/%s' % (dirpath, filename)
+            if not is_compressible(get_mimetype(basename(source)), types):
+                continue
+            st = stat(source)
+            if st.st_size < min_size:
+                continue
+            target = source + '.gz'
+            try:
+                if stat(target).st_mtime >= st.st_mtime:
+                    continue
+            except OSError:
+                pass
+            with open(source, 'rb') as f:
+                data = gzip_data(f.read(), level=9)
+            with open(target, 'wb') as f:
+                f.write(data)
+            n += 1
+    return n
@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental parser of multipart/form-data request bodies.
+
+The input is read in bounded chunks.  The values of the file fields are
+given as (filename, mimetype, UploadedFile), where the UploadedFile is kept
+in memory while small and spooled to a temporary file above a threshold.
+"""
+
+# Import from the Standard Library
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+
+# Import from itools
+from itools.web.exceptions import BadRequest
+from itools.web.headers import get_type
+
+# Import from ikaaro
+from ikaaro.exceptions import RequestEntityTooLarge
+
+
+class UploadedFile(object):
+    """The body of an uploaded file, as a file-like object.
+    """
+
+    def __init__(self, filename, mimetype, spool_threshold):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.file = SpooledTemporaryFile(max_size=spool_threshold)
+        self.size = 0
+
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+
+    def tell(self):
+        return self.file.tell()
+
+
+    def close(self):
+        self.file.close()
+
+
+    def getvalue(self):
+        """Return the whole body as a byte string (loads it in memory).
+        """
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+
+    def __len__(self):
+        return self.size
+
+
+
+def get_body_value(body):
+    """Return the given upload body as a byte string, whether it is already
+    a byte string or an UploadedFile.
+    """
+    if hasattr(body, 'getvalue'):
+        return body.getvalue()
+    return body
+
+
+
+class MultipartParser(object):
+
+    chunk_size = 65536
+    max_headers_size = 65536
+
+    def __init__(self, input, length, boundary, spool_threshold,
+                 max_size=0, on_read=None):
+        self.input = input
+        self.remaining = length
+        self.read_size = 0
+        self.max_size = max_size
+        self.delimiter = '\r\n--%s' % boundary
+        self.spool_threshold = spool_threshold
+        self.on_read = on_read
+        # The CRLF before the first delimiter is optional
+        self.buffer = '\r\n'
+
+
+    def read_chunk(self):
+        if self.remaining <= 0:
+            raise BadRequest
+        data = self.input.read(min(self.chunk_size, self.remaining))
+        if not data:
+            # The client closed the connection
+            raise BadRequest
+        self.remaining -= len(data)
+        self.read_size += len(data)
+        if self.max_size and self.read_size > self.max_size:
+            raise RequestEntityTooLarge
+        if self.on_read:
+            self.on_read(self.read_size)
+        return data
+
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            self.buffer += self.read_chunk()
+
+
+    def read_headers(self):
+        while '\r\n\r\n' not in self.buffer:
+            if len(self.buffer) > self.max_headers_size:
+                raise BadRequest
+            self.buffer += self.read_chunk()
+        headers, self.buffer = self.buffer.split('\r\n\r\n', 1)
+        parsed = {}
+        for line in headers.split('\r\n'):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                parsed[name] = get_type(name).decode(value.strip())
+        return parsed
+
+
+    def read_body(self, output):
+        """Read up to the next delimiter, the data is written into the given
+        output (if any).
+        """
+        delimiter = self.delimiter
+        keep = len(delimiter) - 1
+        while True:
+            index = self.buffer.find(delimiter)
+            if index >= 0:
+                if output is not None:
+                    output.write(self.buffer[:index])
+                self.buffer = self.buffer[index + len(delimiter):]
+                return
+            # Keep what may be the beginning of the delimiter
+            if len(self.buffer) > keep:
+                if output is not None:
+                    output.write(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            self.buffer += self.read_chunk()
+
+
+    def parse(self):
+        form = {}
+        # Skip the preamble
+        self.read_body(None)
+        while True:
+            # The last delimiter is followed by "--"
+            self.fill(2)
+            end, self.buffer = self.buffer[:2], self.buffer[2:]
+            if end == '--':
+                break
+            elif end != '\r\n':
+                raise BadRequest
+            headers = self.read_headers()
+            # Find out the parameter name
+            if 'content-disposition' not in headers:
+                raise BadRequest
+            value, header_parameters = headers['content-disposition']
+            name = header_parameters.get('name')
+            if name is None:
+                raise BadRequest
+            # Load the value
+            if 'filename' in header_parameters:
+                filename = header_parameters['filename']
+                if filename:
+                    # Strip the path (for IE).
+                    filename = filename.split('\\')[-1]
+                    # Default content-type, see
+                    # http://tools.ietf.org/html/rfc2045#section-5.2
+                    if 'content-type' in headers:
+                        mimetype = headers['content-type'][0]
+                    else:
+                        mimetype = 'text/plain'
+                    body = UploadedFile(filename, mimetype,
+                                        self.spool_threshold)
+                    self.read_body(body)
+                    body.seek(0)
+                    form[name] = filename, mimetype, body
+                else:
+                    self.read_body(None)
+                    form[name] = None
+            else:
+                body = StringIO()
+                self.read_body(body)
+                body = body.getvalue()
+                if name not in form:
+                    form[name] = body
+                else:
+                    if isinstance(form[name], list):
+                        form[name].append(body)
+                    else:
+                        form[name] = [form[name], body]
+        # Skip the epilogue
+        while self.remaining > 0:
+            self.read_chunk()
+        return form
@@ -0,0 +1,262 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Conditional and byte-range requests (RFC 7232 and RFC 7233), used to
+serve the files of the database.
+
+The files may be given as a byte string, or as a path on the file system to
+be streamed without loading them in memory.
+"""
+
+# Import from the Standard Library
+from calendar import timegm
+from email.utils import mktime_tz, parsedate_tz
+from hashlib import md5
+from os import stat
+from uuid import uuid4
+
+
+# Do not build huge multipart responses
+max_ranges = 20
+chunk_size = 65536
+
+
+def get_etag(data):
+    """Return a strong ETag for the given content.
+    """
+    return '"%s"' % md5(data).hexdigest()
+
+
+
+def get_file_etag(path):
+    """Same as get_etag, for the file at the given path, but made from its
+    inode, modification time and size (the file is not read).  The commits
+    replace the files of the database (see Database.replace_handler_file),
+    so a file changed has a new inode.
+    """
+    st = stat(path)
+    return '"%x-%x-%x"' % (st.st_ino, int(st.st_mtime * 1000000),
+                           st.st_size)
+
+
+
+def get_timestamp(date):
+    """Parse an HTTP date, return None if not valid.
+    """
+    date = parsedate_tz(date.split(';')[0])
+    if date is None:
+        return None
+    return mktime_tz(date)
+
+
+
+def get_mtime_timestamp(mtime):
+    if mtime is None:
+        return None
+    if mtime.tzinfo is None:
+        return int(timegm(mtime.timetuple()))
+    return int(timegm(mtime.utctimetuple()))
+
+
+
+def match_etags(value, etag):
+    """Tell whether the If-None-Match header matches the ETag (weak
+    comparison).
+    """
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for x in value.split(','):
+        x = x.strip()
+        if x == '*':
+            return True
+        if x.startswith('W/'):
+            x = x[2:]
+        if x == etag:
+            return True
+    return False
+
+
+
+def is_not_modified(environ, etag, mtime):
+    """Tell whether to answer "304 Not Modified".  The If-None-Match header
+    has precedence over If-Modified-Since.
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return match_etags(if_none_match, etag)
+    since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if since:
+        since = get_timestamp(since)
+        mtime = get_mtime_timestamp(mtime)
+        if since is not None and mtime is not None:
+            return since >= mtime
+    return False
+
+
+
+def check_if_range(environ, etag, mtime):
+    """Tell whether the Range header must be honored.  With If-Range the
+    ranges are only sent if the entity has not changed.
+    """
+    if_range = environ.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    # Entity tag (strong comparison)
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    # Date
+    date = get_timestamp(if_range)
+    mtime = get_mtime_timestamp(mtime)
+    return date is not None and mtime is not None and date >= mtime
+
+
+
+def parse_range(value, size):
+    """Parse the Range header.  Return None if the header must be ignored,
+    an empty list if the ranges cannot be satisfied, or the list of the
+    ranges [(first, last), ...] (last byte included).
+    """
+    if not value:
+        return None
+    unit, kk, value = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in value.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:
+                # Suffix: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                first = max(size - length, 0)
+                last = size - 1
+            else:
+                first = int(first)
+                if not last:
+                    last = size - 1
+                elif int(last) < first:
+                    return None
+                else:
+                    last = min(int(last), size - 1)
+        except ValueError:
+            return None
+        if first < size:
+            ranges.append((first, last))
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
+
+def get_multipart_parts(ranges, size, content_type):
+    """Return the boundary and the parts of a multipart/byteranges body, as
+    a list of headers (byte strings) and ranges (tuples).
+    """
+    boundary = uuid4().hex
+    parts = []
+    for first, last in ranges:
+        parts.append('--%s\r\n' % boundary)
+        parts.append('Content-Type: %s\r\n' % content_type)
+        parts.append('Content-Range: bytes %d-%d/%d\r\n\r\n'
+                     % (first, last, size))
+        parts.append((first, last))
+        parts.append('\r\n')
+    parts.append('--%s--\r\n' % boundary)
+    return boundary, parts
+
+
+
+def get_multipart_byteranges(data, ranges, content_type):
+    """Return the content type and the body of a multipart/byteranges
+    response.
+    """
+    boundary, parts = get_multipart_parts(ranges, len(data), content_type)
+    body = [ data[x[0]:x[1]+1] if type(x) is tuple else x for x in parts ]
+    content_type = 'multipart/byteranges; boundary=%s' % boundary
+    return content_type, ''.join(body)
+
+
+
+class FileSlice(object):
+    """File-like object to read the bytes from first to last (included) of
+    the given file.
+    """
+
+    def __init__(self, file, first, last):
+        self.file = file
+        self.file.seek(first)
+        self.left = last - first + 1
+
+
+    def __len__(self):
+        return self.left
+
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        if size == 0:
+            return ''
+        data = self.file.read(size)
+        self.left -= len(data)
+        return data
+
+
+    def close(self):
+        self.file.close()
+
+
+
+def iter_file_byteranges(file, parts):
+    try:
+        for part in parts:
+            if type(part) is not tuple:
+                yield part
+                continue
+            first, last = part
+            file.seek(first)
+            left = last - first + 1
+            while left > 0:
+                data = file.read(min(left, chunk_size))
+                if not data:
+                    return
+                left -= len(data)
+                yield data
+    finally:
+        file.close()
+
+
+
+def get_file_multipart_byteranges(file, size, ranges, content_type):
+    """Same as get_multipart_byteranges, for an open file.  Return the
+    content type, the length and an iterator over the body.
+    """
+    boundary, parts = get_multipart_parts(ranges, size, content_type)
+    length = 0
+    for part in parts:
+        if type(part) is tuple:
+            length += part[1] - part[0] + 1
+        else:
+            length += len(part)
+    content_type = 'multipart/byteranges; boundary=%s' % boundary
+    return content_type, length, iter_file_byteranges(file, parts)
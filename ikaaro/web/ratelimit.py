@@ -0,0 +1,218 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rate limiting, by client.
+
+Each rule applies to some requests:
+
+- login: the ';login' view
+- register: the ';register' view
+- api: the requests to /api/
+- image: the ';thumb' and ';get_image' views
+
+and gives every client a bucket of "burst" tokens, refilled at "rate" tokens
+per minute.  A request takes a token, without tokens left it is refused
+with "429 Too Many Requests".  The limits are set in config.conf, for
+instance "rate-limit-login = 10 5".
+
+The client is the remote address (the first one of X-Forwarded-For, like
+CMSContext.get_remote_ip).  With "rate-limit-by-user" the requests that
+carry valid credentials are counted by user instead, except for the login
+and register rules.  The credentials cannot be checked here (this is done
+before the database is touched): like for the admission control, they are
+valid once a request carrying them has been authenticated (see
+AdmissionControl.verify).  Until then the request is counted by address,
+so made up credentials do not give a new bucket.
+
+In pre-fork mode the rate is limited by the readers, before they forward
+the requests to the writer (see ikaaro.workers).
+"""
+
+# Import from the Standard Library
+from base64 import decodestring
+from time import time
+from urllib import unquote
+
+# Import from ikaaro
+from admission import get_credentials
+
+
+rule_names = ('login', 'register', 'api', 'image')
+
+# Some rules are always by remote address
+by_address = frozenset(['login', 'register'])
+
+# Forget the clients whose bucket is full again, every N requests
+clean_interval = 1000
+
+
+def get_rule_name(path):
+    if path.startswith('/api/'):
+        return 'api'
+    name = path.rsplit('/', 1)[-1]
+    if name in (';login', ';register'):
+        return name[1:]
+    if name in (';thumb', ';get_image'):
+        return 'image'
+    return None
+
+
+
+def get_remote_ip(environ):
+    remote_ip = environ.get('HTTP_X_FORWARDED_FOR')
+    if remote_ip:
+        return remote_ip.split(',', 1)[0].strip()
+    return environ.get('REMOTE_ADDR')
+
+
+
+def get_user_id(credentials):
+    """Return the user id of the credentials (the Authorization header or
+    the 'iauth' cookie, see ikaaro.web.admission.get_credentials), or None.
+    See CMSContext.get_authentication_credentials
+    """
+    credentials = credentials.split()[-1]
+    try:
+        credentials = decodestring(unquote(credentials.strip('"')))
+    except Exception:
+        return None
+    user_id, kk, token = credentials.partition(':')
+    return user_id or None
+
+
+
+class RateLimitRule(object):
+
+    def __init__(self, name, rate=0, burst=0):
+        self.name = name
+        # Tokens per second
+        self.rate = rate / 60.0
+        self.burst = burst or rate
+        # {client: [tokens, time]}
+        self.buckets = {}
+        # Stats
+        self.allowed = 0
+        self.limited = 0
+
+
+    def consume(self, client, now):
+        """Take a token from the bucket of the client, return the number of
+        seconds to wait before the next token if there is none left, or 0.
+        """
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = [self.burst, now]
+        else:
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            bucket[0] = min(tokens, self.burst)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.limited += 1
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= 1
+        self.allowed += 1
+        return 0
+
+
+    def clean(self, now):
+        for client, (tokens, last) in self.buckets.items():
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[client]
+
+
+
+class RateLimiter(object):
+
+    def __init__(self, limits, by_user=False, verified=None):
+        """The limits are given by rule name:
+
+            {'login': (rate, burst), ...}
+
+        The verified credentials are those of the admission control (see
+        AdmissionControl.verified).
+        """
+        self.rules = {}
+        for name in rule_names:
+            rule_limits = limits.get(name)
+            if rule_limits and rule_limits[0]:
+                self.rules[name] = RateLimitRule(name, *rule_limits)
+        self.by_user = by_user
+        self.verified = verified if verified is not None else {}
+        self.counter = 0
+
+
+    def is_enabled(self):
+        return bool(self.rules)
+
+
+    def get_client(self, rule, environ):
+        if self.by_user and rule.name not in by_address:
+            credentials = get_credentials(environ)
+            if credentials and credentials in self.verified:
+                user_id = get_user_id(credentials)
+                if user_id:
+                    return 'user:%s' % user_id
+        return get_remote_ip(environ)
+
+
+    def check(self, environ):
+        """Return the number of seconds the client must wait if the request
+        is refused, or 0.
+        """
+        if not self.rules:
+            return 0
+        name = get_rule_name(environ.get('PATH_INFO') or '/')
+        rule = self.rules.get(name)
+        if rule is None:
+            return 0
+
+        now = time()
+        # Keep the memory bounded
+        self.counter += 1
+        if self.counter % clean_interval == 0:
+            for x in self.rules.itervalues():
+                x.clean(now)
+
+        client = self.get_client(rule, environ)
+        return rule.consume(client, now)
+
+
+    def too_many_requests_application(self, environ, start_response, wait):
+        body = '429 Too Many Requests'
+        headers = [
+            ('Server', 'ikaaro.web'),
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(int(wait) + 1)),
+            ('Cache-Control', 'no-cache')]
+        start_response(body, headers)
+        return [body]
+
+
+    def get_stats(self):
+        stats = []
+        for name in rule_names:
+            rule = self.rules.get(name)
+            if rule is None:
+                continue
+            stats.append({
+                'name': name,
+                'rate': rule.rate * 60,
+                'burst': rule.burst,
+                'allowed': rule.allowed,
+                'limited': rule.limited,
+                'clients': len(rule.buckets)})
+        return stats
@@ -0,0 +1,261 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fast path for the skin files (/ui/...): they are served before the
+context is built, without taking the database lock, authenticating the user
+or touching the catalog.  Whatever cannot be served from here (language
+negotiation, obsolete paths, 404...) goes through the usual views.
+"""
+
+# Import from the Standard Library
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import md5
+from os import stat
+from os.path import basename
+from stat import S_ISREG
+
+# Import from itools
+from itools.fs.common import get_mimetype
+from itools.web.utils import reason_phrases
+
+# Import from ikaaro
+from ikaaro.skins import skin_registry
+from compression import accepts_gzip, get_gzip_etag, gzip_data
+from compression import is_compressible, precompress_folder
+from ranges import get_file_etag
+from wsgi import get_response_iterable
+
+
+class StaticFile(object):
+
+    __slots__ = ['path', 'mtime', 'size', 'etag', 'last_modified', 'mimetype',
+                 'data', 'gzip_data', 'gzip_size', 'cached']
+
+    def __init__(self, local_path, st, cached=True):
+        """The files kept in memory are read once, the others are streamed
+        from the file system at every request.
+        """
+        self.path = local_path
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.last_modified = formatdate(int(st.st_mtime), usegmt=True)
+        self.mimetype = get_mimetype(basename(local_path))
+        self.data = None
+        self.cached = cached
+        # The compressed variant made by icms-compress-ui.py (if up-to-date)
+        self.gzip_data = None
+        self.gzip_size = None
+        try:
+            gzip_st = stat(local_path + '.gz')
+        except OSError:
+            pass
+        else:
+            if gzip_st.st_mtime >= st.st_mtime:
+                self.gzip_size = gzip_st.st_size
+
+        if not cached:
+            # Not read, the ETag is made from the metadata
+            self.etag = get_file_etag(local_path)
+            return
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        self.size = len(data)
+        self.etag = '"%s"' % md5(data).hexdigest()
+        self.data = data
+        if self.gzip_size is not None:
+            try:
+                with open(local_path + '.gz', 'rb') as f:
+                    self.gzip_data = f.read()
+            except IOError:
+                self.gzip_size = None
+
+
+    def get_gzip_data(self):
+        """Return the compressed data, None if not available.
+        """
+        if self.gzip_data is None and self.cached:
+            # Compress once the files kept in memory
+            self.gzip_data = gzip_data(self.data)
+        return self.gzip_data
+
+
+
+class StaticFilesCache(object):
+    """In-memory cache of the skin files, validated with the mtime of the
+    file at every hit.
+    """
+
+    # Bigger files are streamed, not kept in memory
+    max_file_size = 1024 * 1024
+
+    def __init__(self):
+        self.files = {}
+
+
+    def get(self, local_path):
+        try:
+            st = stat(local_path)
+        except OSError:
+            return None
+        if not S_ISREG(st.st_mode):
+            return None
+        # Cache hit
+        static_file = self.files.get(local_path)
+        if (static_file and static_file.mtime == st.st_mtime
+                and static_file.size == st.st_size):
+            return static_file
+        # Cache miss
+        cached = st.st_size <= self.max_file_size
+        try:
+            static_file = StaticFile(local_path, st, cached)
+        except (IOError, OSError):
+            return None
+        if cached:
+            self.files[local_path] = static_file
+        else:
+            self.files.pop(local_path, None)
+        return static_file
+
+
+    def clear(self):
+        self.files.clear()
+
+
+static_files_cache = StaticFilesCache()
+
+
+
+def get_static_file(server, path):
+    """Return the static file for the given '/ui/...' path, None if it must
+    be served by the views.
+    """
+    # /ui/cached/<timestamp>/<skin>/<path> or /ui/<skin>/<path>
+    parts = path.split('/', 3)
+    if len(parts) < 4:
+        return None
+    cached = parts[2] == 'cached'
+    if cached:
+        parts = parts[3].split('/', 2)
+        if len(parts) < 3 or parts[0] != server.timestamp:
+            return None
+        skin_name, web_path = parts[1], parts[2]
+    else:
+        skin_name, web_path = parts[2], parts[3]
+    skin = skin_registry.get(skin_name)
+    if skin is None or '..' in web_path.split('/'):
+        return None
+    # Same lookup order than CMSContext.get_template
+    for skin_key in (skin.get_environment_key(server), skin.key):
+        static_file = static_files_cache.get('%s/%s' % (skin_key, web_path))
+        if static_file is not None:
+            return cached, static_file
+    return None
+
+
+
+def is_not_modified(environ, etag, mtime):
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = [ x.strip() for x in if_none_match.split(',') ]
+        return etag in etags or '*' in etags
+    since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if since:
+        since = parsedate_tz(since.split(';')[0])
+        if since is not None:
+            return mktime_tz(since) >= int(mtime)
+    return False
+
+
+
+def static_application(environ, start_response, server):
+    """Serve the skin file, return None if it must be served by the views.
+    """
+    method = environ.get('REQUEST_METHOD')
+    if method not in ('GET', 'HEAD'):
+        return None
+    found = get_static_file(server, environ.get('PATH_INFO', ''))
+    if found is None:
+        return None
+    cached, static_file = found
+
+    # Compression
+    data = static_file.data
+    path = static_file.path
+    size = static_file.size
+    etag = static_file.etag
+    encoding = None
+    compressible = (server.gzip_min_size
+                    and static_file.size >= server.gzip_min_size
+                    and is_compressible(static_file.mimetype,
+                                        server.gzip_types))
+    if compressible and accepts_gzip(environ):
+        compressed = static_file.get_gzip_data()
+        if compressed is not None:
+            data = compressed
+            size = len(compressed)
+            etag = get_gzip_etag(etag)
+            encoding = 'gzip'
+        elif not static_file.cached and static_file.gzip_size is not None:
+            path = path + '.gz'
+            size = static_file.gzip_size
+            etag = get_gzip_etag(etag)
+            encoding = 'gzip'
+
+    headers = [
+        ('Server', 'ikaaro.web'),
+        ('ETag', etag),
+        ('Last-Modified', static_file.last_modified)]
+    if compressible:
+        headers.append(('Vary', 'Accept-Encoding'))
+    if cached:
+        headers.append(('Cache-Control', 'max-age=315360000'))
+    if server.accept_cors and environ.get('HTTP_ORIGIN'):
+        headers.extend([
+            ('Access-Control-Allow-Credentials', 'true'),
+            ('Access-Control-Allow-Origin', environ['HTTP_ORIGIN']),
+            ('Access-Control-Allow-Headers', 'Authorization')])
+    # 304 Not Modified
+    if is_not_modified(environ, etag, static_file.mtime):
+        start_response('304 %s' % reason_phrases[304], headers)
+        return []
+    # The files not kept in memory are streamed
+    file = None
+    if data is None and method != 'HEAD':
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            return None
+    # 200 Ok
+    headers.append(('Content-Type', static_file.mimetype))
+    headers.append(('Content-Length', str(size)))
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    start_response('200 %s' % reason_phrases[200], headers)
+    if method == 'HEAD':
+        return []
+    if file is not None:
+        return get_response_iterable(environ, file)
+    return [data]
+
+
+
+def precompress_skins(min_size, types):
+    """Compress the files of the registered skins (see icms-compress-ui.py).
+    Return the number of files written.
+    """
+    n = 0
+    for name in sorted(skin_registry):
+        n += precompress_folder(skin_registry[name].key, min_size, types)
+    return n
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Progress of the uploads, as shown by the ProgressBarWidget.
+
+The stats are polled (/;upload_stats?upload_id=...) while the upload holds
+the database lock, so they are answered here, before the database context
+is entered.
+"""
+
+# Import from the Standard Library
+from json import dumps
+from time import time
+
+# Import from itools
+from itools.uri import decode_query
+from itools.web.utils import reason_phrases
+
+
+class UploadStats(object):
+    """The bytes received and the total size of the uploads, by upload id.
+    Finished uploads are kept "ttl" seconds, so the progress bar sees them
+    complete.
+    """
+
+    ttl = 60
+
+    def __init__(self):
+        # {upload_id: [uploaded_size, total_size, finished_time]}
+        self.uploads = {}
+
+
+    def start(self, upload_id, total_size):
+        self.clean()
+        self.uploads[upload_id] = [0, total_size, None]
+
+
+    def update(self, upload_id, uploaded_size):
+        stats = self.uploads.get(upload_id)
+        if stats is not None:
+            stats[0] = uploaded_size
+
+
+    def finish(self, upload_id):
+        stats = self.uploads.get(upload_id)
+        if stats is not None:
+            stats[2] = time()
+
+
+    def clean(self):
+        expired = time() - self.ttl
+        for upload_id, stats in self.uploads.items():
+            if stats[2] is not None and stats[2] < expired:
+                del self.uploads[upload_id]
+
+
+    def get(self, upload_id, default=None):
+        """Return the tuple (uploaded_size, total_size).
+        """
+        stats = self.uploads.get(upload_id)
+        if stats is None:
+            return default
+        return stats[0], stats[1]
+
+
+    def __len__(self):
+        return len(self.uploads)
+
+
+
+def get_upload_id(environ):
+    """Return the upload id sent by the ProgressBarWidget, or None.
+    """
+    query = environ.get('QUERY_STRING')
+    if not query or 'upload_id' not in query:
+        return None
+    upload_id = decode_query(query).get('upload_id')
+    try:
+        return int(upload_id)
+    except (TypeError, ValueError):
+        return None
+
+
+
+def upload_stats_application(environ, start_response, server):
+    """Same answer than the UploadStatsView.
+    """
+    stats = None
+    upload_id = get_upload_id(environ)
+    if upload_id is not None:
+        stats = server.upload_stats.get(upload_id)
+
+    if stats is None:
+        data = dumps({'valid_id': False})
+    else:
+        uploaded_size, total_size = stats
+        data = dumps({'valid_id': True,
+                      'uploaded_size': uploaded_size,
+                      'total_size': total_size})
+    headers = [
+        ('Server', 'ikaaro.web'),
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(data))),
+        ('Cache-Control', 'no-cache')]
+    start_response('200 %s' % reason_phrases[200], headers)
+    return [data]
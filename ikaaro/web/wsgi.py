@@ -14,40 +14,278 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""The WSGI entry point.
+
+Views may return a byte string, a file-like object or an iterator of byte
+strings.  Files and iterators are streamed in chunks once the database
+context has been released (so they must not need the database anymore);
+when their length is unknown the response is sent with chunked transfer
+encoding.
+"""
+
 # Import from standard library
+from os import fstat
+from sys import exc_info
 from time import time
 
 # Import from itools
 from itools.log import log_error
+from itools.web.exceptions import ClientError
 from itools.web.router import RequestMethod
 from itools.web.utils import reason_phrases
 
+# Import from ikaaro
+from ikaaro.metrics import add_timing, get_route
+from compression import compress_response
+
+
+chunk_size = 65536
+
+
+def get_entity_length(entity):
+    if type(entity) is str:
+        return len(entity)
+    # File-like object on the file system
+    fileno = getattr(entity, 'fileno', None)
+    if fileno is None:
+        return None
+    try:
+        position = entity.tell() if hasattr(entity, 'tell') else 0
+        return fstat(fileno()).st_size - position
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def iter_file(file, size=chunk_size):
+    try:
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            yield data
+    finally:
+        close = getattr(file, 'close', None)
+        if close:
+            close()
+
+
+def get_response_iterable(environ, entity):
+    if entity is None:
+        return []
+    if type(entity) is str:
+        return [entity]
+    if hasattr(entity, 'read'):
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(entity, chunk_size)
+        return iter_file(entity)
+    # An iterator
+    return entity
+
+
+
+class TimedResponse(object):
+    """Wraps the response to count the time spent sending it, the timings of
+    the request are added to the metrics once it is closed.
+    """
+
+    def __init__(self, iterable, t0, route, timings, metrics):
+        self.iterable = iterable
+        self.t0 = t0
+        self.t1 = time()
+        self.route = route
+        self.timings = timings
+        self.metrics = metrics
+
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close:
+                close()
+        finally:
+            t2 = time()
+            self.timings['response_write'] = t2 - self.t1
+            self.timings['total'] = t2 - self.t0
+            self.metrics.add_request(self.route, self.timings)
+
+
 
 def application(environ, start_response):
     from ikaaro.server import get_server
-    t0 = time()
+    from static import static_application
+    from uploads import upload_stats_application
+    server = get_server()
+    # Skin files are served without entering the database context
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/ui/'):
+        response = static_application(environ, start_response, server)
+        if response is not None:
+            return response
+    # And so is the progress of the uploads
+    if path == '/;upload_stats':
+        return upload_stats_application(environ, start_response, server)
+    # Refuse the clients that send too many requests
+    response = check_rate_limit(environ, start_response, server)
+    if response is not None:
+        return response
+    return database_application(environ, start_response, server)
+
+
+
+def forwarded_application(environ, start_response):
+    """The application of the writer of the pre-fork mode, for the requests
+    forwarded by the readers (see ikaaro.workers), whose rate has been
+    limited by the readers already.
+    """
+    from ikaaro.server import get_server
+    from ikaaro.workers import mail_spool_application, mail_spool_path
+    from uploads import upload_stats_application
     server = get_server()
-    with server.database.init_context(commit_at_exit=False) as context:
+    path = environ.get('PATH_INFO')
+    if path == '/;upload_stats':
+        return upload_stats_application(environ, start_response, server)
+    # The messages written to the mail spool by the readers
+    if path == mail_spool_path:
+        return mail_spool_application(environ, start_response, server)
+    return database_application(environ, start_response, server)
+
+
+
+def check_rate_limit(environ, start_response, server):
+    """Return the response refusing the request if the client has sent too
+    many of them (see ikaaro.web.ratelimit), or None.
+    """
+    rate_limiter = server.rate_limiter
+    wait = rate_limiter.check(environ)
+    if wait:
+        return rate_limiter.too_many_requests_application(
+            environ, start_response, wait)
+    return None
+
+
+
+def database_application(environ, start_response, server):
+    from ikaaro.context import read_body
+    t0 = time()
+    # GET and HEAD requests share the database, others have it for them alone
+    method = environ.get('REQUEST_METHOD')
+    write_lock = method not in ('GET', 'HEAD')
+    # The body is read before the database lock is taken, so a slow upload
+    # does not hold it (the files are spooled to disk); the errors are
+    # answered once the context is set
+    body = body_error = None
+    if write_lock:
         try:
-            # Init context from wsgi envrion
-            context.init_from_environ(environ)
-            # Handle the request
-            RequestMethod.handle_request(context)
-            t1 = time()
-            # Compute request time
-            context.request_time = t1-t0
-            # Callback at end of request
-            context.on_request_end()
+            body = read_body(environ, server)
         except StandardError:
-            log_error('Internal error', domain='itools.web')
-            context.set_default_response(500)
-        finally:
-            headers =  context.header_response
-            if context.content_type:
-                headers.append(('Content-Type', context.content_type))
-            if context.entity:
-                headers.append(('Content-Length', str(len(context.entity))))
-            status = context.status or 500
-            status = '{0} {1}'.format(status, reason_phrases[status])
-            start_response(str(status), headers)
-            yield context.entity
+            body = {}
+            body_error = exc_info()
+    # Shed the load before the requests pile up behind the database lock
+    # (see ikaaro.web.admission)
+    admission = server.admission
+    budget = admission.get_budget(environ)
+    if not budget.acquire():
+        return admission.unavailable_application(environ, start_response)
+    # Slow requests are logged (see ikaaro.watchdog)
+    watchdog = server.watchdog
+    request = watchdog.start(environ)
+    context = None
+    forward = False
+    try:
+        while True:
+            with server.database.init_context(commit_at_exit=False,
+                                              write_lock=write_lock,
+                                              group_commit=True) as context:
+                profile = server.profiler.start(environ)
+                try:
+                    # Init context from wsgi envrion
+                    t1 = time()
+                    context.init_from_environ(environ, body=body)
+                    add_timing('init', time() - t1, context)
+                    if body_error is not None:
+                        raise body_error[0], body_error[1], body_error[2]
+                    # Handle the request
+                    timings = context.timings
+                    nested = sum(timings.values())
+                    t1 = time()
+                    RequestMethod.handle_request(context)
+                    t2 = time()
+                    # The view is what is left once the nested phases are
+                    # removed
+                    nested = sum(timings.values()) - nested
+                    add_timing('view', t2 - t1 - nested, context)
+                    # Compute request time
+                    context.request_time = t2-t0
+                    # Callback at end of request
+                    context.on_request_end()
+                except ClientError, error:
+                    # The request body is malformed or too large
+                    context.set_default_response(error.code)
+                except StandardError:
+                    log_error('Internal error', domain='itools.web')
+                    context.set_default_response(500)
+                finally:
+                    headers =  context.header_response
+                    if context.content_type:
+                        headers.append(('Content-Type', context.content_type))
+                    entity = context.entity
+                    has_length = [ x for x in headers
+                                   if x[0] == 'Content-Length' ]
+                    if entity and not has_length:
+                        length = get_entity_length(entity)
+                        if length is not None:
+                            headers.append(('Content-Length', str(length)))
+                    status = context.status or 500
+                    status = '{0} {1}'.format(status, reason_phrases[status])
+                    route = get_route(context)
+                    timings = context.timings
+                    if profile is not None:
+                        server.profiler.stop(profile, route)
+            # A GET request that changes the database is served again, with
+            # the lock for writing (see ikaaro.database.check_write_lock), by
+            # the writer in pre-fork mode
+            if write_lock or not getattr(context, 'write_lock_required',
+                                         False):
+                break
+            if server.writer_application is not None:
+                forward = True
+                break
+            write_lock = True
+        # The changes are committed with those of the next requests, the
+        # response is sent once they are
+        group = getattr(context, 'commit_group', None)
+        if group is not None:
+            t1 = time()
+            committed = group.wait()
+            add_timing('commit_wait', time() - t1, context)
+            if not committed:
+                log_error('Group commit failed: %s' % group.error,
+                          domain='itools.web')
+                status = '500 %s' % reason_phrases[500]
+                entity = status
+                headers = [('Content-Type', 'text/plain'),
+                           ('Content-Length', str(len(entity)))]
+        # The next requests with the same credentials are admitted as
+        # authenticated if they are valid
+        admission.verify(environ, context.user is not None)
+    finally:
+        budget.release()
+        if request is not None:
+            watchdog.stop(request, context)
+    if forward:
+        return server.writer_application(environ, start_response)
+    # Compress the text responses (once the lock has been released)
+    if type(entity) is str and entity:
+        headers, entity = compress_response(environ, headers, entity,
+                                            server.gzip_min_size,
+                                            server.gzip_types)
+    # Send the response once the database lock has been released, so a slow
+    # client does not hold the other requests
+    start_response(str(status), headers)
+    response = get_response_iterable(environ, entity)
+    return TimedResponse(response, t0, route, timings, server.request_metrics)
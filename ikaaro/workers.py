@@ -0,0 +1,332 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pre-fork mode of the web server.
+
+The master process owns the listening socket and forks the workers: one
+writer, that opens the database in read-write mode, and N readers, that
+open it in read-only mode.  The readers serve the GET and HEAD requests and
+forward the others to the writer through a unix socket, as well as the GET
+requests that turn out to change the database (see
+ikaaro.database.check_write_lock).
+"""
+
+# Import from the Standard Library
+from errno import ECHILD, EINTR
+from httplib import HTTPConnection
+from os import _exit, getpid, kill, remove, wait
+from os.path import exists, isfile
+from signal import signal, SIG_DFL, SIGINT, SIGTERM
+import socket
+from traceback import format_exc
+from urllib import quote
+
+# Import from gevent
+from gevent import fork
+from gevent import socket as gsocket
+
+# Import from itools
+from itools.core import become_daemon
+from itools.fs import lfs
+from itools.log import log_error, log_info
+from itools.web.utils import reason_phrases
+
+# Import from ikaaro
+from server import Server, get_config, get_server
+from web.wsgi import application, check_rate_limit
+
+
+# Headers that must not be forwarded by a proxy (RFC 2616, 13.5.1)
+hop_by_hop = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'])
+
+
+def get_writer_path(target):
+    return '%s/writer.sock' % target
+
+
+def make_tcp_listener(address, port, backlog=256):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
+
+
+def make_unix_listener(path, backlog=256):
+    if exists(path):
+        remove(path)
+    sock = gsocket.socket(gsocket.AF_UNIX, gsocket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+# Where the readers tell the writer of the messages they write to the mail
+# spool (see ikaaro.spool)
+mail_spool_path = '/;mail_spool'
+
+
+def notify_mail_spool(writer_path, name):
+    """Tell the writer to send the message, written to the spool folder by
+    a reader.  If it cannot be told, the message is sent once the writer
+    starts again (see MailSpool.recover).
+    """
+    connection = UnixHTTPConnection(writer_path)
+    try:
+        connection.request('POST', '%s?name=%s' % (mail_spool_path, name),
+                           '', {'Content-Length': '0'})
+        connection.getresponse().read()
+    except (socket.error, gsocket.error):
+        log_error('Cannot tell the writer of the message "%s"' % name,
+                  domain='ikaaro.web')
+    finally:
+        connection.close()
+
+
+
+def mail_spool_application(environ, start_response, server):
+    """The writer queues the message written by a reader.
+    """
+    name = environ.get('QUERY_STRING', '')[5:]
+    spool = server.mail_spool
+    if ('/' in name or name[-5:] == '.lock'
+            or not isfile('%s/%s' % (spool.path, name))):
+        status = '404 %s' % reason_phrases[404]
+    else:
+        spool.add(name)
+        server.flush_spool()
+        status = '204 %s' % reason_phrases[204]
+    start_response(status, [('Content-Length', '0')])
+    return []
+
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+
+    def connect(self):
+        sock = gsocket.socket(gsocket.AF_UNIX, gsocket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+
+class ReaderApplication(object):
+    """WSGI application of the readers: the read requests are served from
+    the read-only database, the others are forwarded to the writer.
+    """
+
+    read_methods = ('GET', 'HEAD')
+    chunk_size = 65536
+
+    def __init__(self, writer_path):
+        self.writer_path = writer_path
+
+
+    def __call__(self, environ, start_response):
+        # The uploads are received, and their progress known, by the writer
+        path = environ.get('PATH_INFO')
+        if path == '/;upload_stats':
+            return self.forward(environ, start_response)
+        # Only the readers tell the writer of the messages to send
+        if path == mail_spool_path:
+            status = '404 %s' % reason_phrases[404]
+            start_response(status, [('Content-Type', 'text/plain')])
+            return [status]
+        if environ.get('REQUEST_METHOD') in self.read_methods:
+            return application(environ, start_response)
+        # The rate is limited here, the writer only sees the readers
+        response = check_rate_limit(environ, start_response, get_server())
+        if response is not None:
+            return response
+        return self.forward(environ, start_response)
+
+
+    def get_request_uri(self, environ):
+        uri = environ.get('RAW_URI')
+        if uri:
+            return uri
+        uri = quote(environ.get('PATH_INFO') or '/')
+        query = environ.get('QUERY_STRING')
+        if query:
+            uri = '%s?%s' % (uri, query)
+        return uri
+
+
+    def get_request_headers(self, environ):
+        headers = {}
+        for key, value in environ.iteritems():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+                if name.lower() not in hop_by_hop:
+                    headers[name] = value
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        if environ.get('CONTENT_LENGTH'):
+            headers['Content-Length'] = str(environ['CONTENT_LENGTH'])
+        # The writer only sees the unix socket, tell it the client address
+        remote_addr = environ.get('REMOTE_ADDR')
+        if remote_addr:
+            forwarded_for = headers.get('X-Forwarded-For')
+            if forwarded_for:
+                remote_addr = '%s, %s' % (forwarded_for, remote_addr)
+            headers['X-Forwarded-For'] = remote_addr
+        return headers
+
+
+    def forward(self, environ, start_response):
+        connection = UnixHTTPConnection(self.writer_path)
+        # Send the request (the body is streamed from wsgi.input)
+        body = environ['wsgi.input'] if environ.get('CONTENT_LENGTH') else ''
+        try:
+            connection.request(environ['REQUEST_METHOD'],
+                               self.get_request_uri(environ),
+                               body, self.get_request_headers(environ))
+            response = connection.getresponse()
+        except (socket.error, gsocket.error):
+            log_error('Cannot forward the request to the writer',
+                      domain='ikaaro.web')
+            connection.close()
+            status = '503 %s' % reason_phrases[503]
+            start_response(status, [('Content-Type', 'text/plain'),
+                                    ('Retry-After', '5')])
+            return [status]
+
+        # Send the response (keep repeated headers, like Set-Cookie)
+        headers = []
+        for line in response.msg.headers:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            if name.strip().lower() not in hop_by_hop:
+                headers.append((name.strip(), value.strip()))
+        status = '%d %s' % (response.status, response.reason)
+        start_response(status, headers)
+        return self.iter_response(connection, response)
+
+
+    def iter_response(self, connection, response):
+        try:
+            while True:
+                data = response.read(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            connection.close()
+
+
+
+class Master(object):
+    """The master process of the pre-fork server: it owns the listening
+    socket, forks the workers and starts them again if they die.
+    """
+
+    def __init__(self, target, workers, port=None, profile=False):
+        self.target = lfs.get_absolute_path(target)
+        self.workers = workers
+        self.port = port
+        self.profile = profile
+        self.writer_path = get_writer_path(self.target)
+        self.children = {}
+        self.stopping = False
+
+
+    def start(self, detach=False):
+        config = get_config(self.target)
+        # Find out the IP and port to listen to
+        address = config.get_value('listen-address').strip()
+        if not address:
+            raise ValueError('listen-address is missing from config.conf')
+        if address == '*':
+            address = ''
+        port = int(self.port or config.get_value('listen-port') or 0)
+        if not port:
+            raise ValueError('listen-port is missing from config.conf')
+        # Daemon mode
+        if detach:
+            become_daemon()
+        # The listening socket is shared by all the workers
+        self.listener = make_tcp_listener(address, port)
+        self.port = port
+        # Save PID (icms-stop.py will signal the master)
+        with open(self.target + '/pid', 'w') as f:
+            f.write(str(getpid()))
+        msg = 'Listen %s:%d with %d readers' % (address, port, self.workers)
+        log_info(msg)
+        print(msg)
+        # Fork the writer and the readers
+        self.spawn(read_only=False)
+        for i in range(self.workers):
+            self.spawn(read_only=True)
+        # Wait
+        signal(SIGTERM, self.stop)
+        signal(SIGINT, self.stop)
+        self.loop()
+        return True
+
+
+    def spawn(self, read_only):
+        pid = fork()
+        if pid:
+            self.children[pid] = read_only
+            return pid
+        # Worker
+        exit_code = 0
+        try:
+            signal(SIGTERM, SIG_DFL)
+            signal(SIGINT, SIG_DFL)
+            server = Server(self.target, read_only=read_only, port=self.port,
+                            mail_spool=not read_only)
+            server.start_worker(self.listener, self.writer_path,
+                                profile=self.profile)
+        except Exception:
+            log_error('Worker error\n' + format_exc())
+            exit_code = 1
+        _exit(exit_code)
+
+
+    def loop(self):
+        while self.children:
+            try:
+                pid, status = wait()
+            except OSError, e:
+                if e.errno == EINTR:
+                    continue
+                if e.errno == ECHILD:
+                    break
+                raise
+            read_only = self.children.pop(pid, None)
+            if read_only is None or self.stopping:
+                continue
+            # A worker died, start a new one
+            kind = 'reader' if read_only else 'writer'
+            log_error('The %s %s died (%s), restart it' % (kind, pid, status))
+            self.spawn(read_only)
+
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.children.keys():
+            try:
+                kill(pid, SIGTERM)
+            except OSError:
+                pass
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from optparse import OptionParser
+
+# Import from itools
+from itools import __version__
+
+# Import from ikaaro
+from ikaaro.server import get_config, load_modules
+from ikaaro.web.compression import compressible_types
+from ikaaro.web.static import precompress_skins
+
+
+if __name__ == '__main__':
+    # The command line parser
+    usage = '%prog [OPTIONS] TARGET'
+    version = 'itools %s' % __version__
+    description = (
+        'Compresses the files of the skins used by the TARGET ikaaro '
+        'instance (a ".gz" file is written next to every file), so the web '
+        'server sends the compressed file directly.')
+    parser = OptionParser(usage, version=version, description=description)
+
+    # Parse arguments
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+    target = args[0]
+
+    # Load the skins of the instance
+    config = get_config(target)
+    load_modules(config)
+    # Compress
+    min_size = config.get_value('gzip-min-size')
+    if not min_size:
+        print 'Compression is disabled (see "gzip-min-size" in config.conf)'
+    else:
+        types = config.get_value('gzip-types') or compressible_types
+        n = precompress_skins(min_size, types)
+        print '%d files compressed' % n
@@ -26,7 +26,8 @@ from xapian import DatabaseLockError
 from itools import __version__
 
 # Import from ikaaro
-from ikaaro.server import Server
+from ikaaro.server import Server, get_pid
+from ikaaro.workers import Master
 
 if __name__ == '__main__':
     # The command line parser
@@ -45,12 +46,16 @@ if __name__ == '__main__':
     parser.add_option(
         '-p', '--port', default=None,
         help="Start the server on this port")
+    parser.add_option(
+        '-w', '--workers', type='int', default=0,
+        help="Pre-fork mode: start N read-only workers and one writer.")
     parser.add_option(
         '--quick', action="store_true", default=False,
         help="Do not check the database consistency.")
     parser.add_option(
         '--profile-time', action="store_true", default=False,
-        help="Write profile information tot the 'log/profile' file.")
+        help="Profile the requests into the 'log/profile' folder (all of "
+             "them unless the 'profile-*' options of config.conf are set).")
     parser.add_option(
         '--profile-space', action="store_true", default=False,
         help="Enable remote monitoring by guppy, http://guppy-pe.sf.net/")
@@ -62,6 +67,17 @@ if __name__ == '__main__':
         parser.error('Wrong number of arguments.')
     # Get target
     target = args[0]
+    # Pre-fork mode
+    if options.workers:
+        if options.read_only:
+            parser.error('--workers and --read-only cannot be used together')
+        if get_pid('%s/pid' % target) is not None:
+            print('[%s] The Web Server is already running.' % target)
+            exit(1)
+        master = Master(target, options.workers, port=options.port,
+                        profile=options.profile_time)
+        master.start(detach=options.detach)
+        exit(0)
     # Set-up the server
     try:
         server = Server(target, read_only=options.read_only,
@@ -18,14 +18,21 @@
 from unittest import TestCase, main
 from datetime import time
 
+# Import from gevent
+from gevent import joinall, sleep, spawn
+
 # Import from itools
 from itools.database import AndQuery, PhraseQuery
 
 # Import from ikaaro
-from ikaaro.database import Database
+from ikaaro.database import DBSEM, Database, ReadWriteLock
+from ikaaro.database import WriteLockRequired, get_handler_path
+from ikaaro.database import open_handler_file
+from ikaaro.dependencies import DependencyGraph
 from ikaaro.folder import Folder
 from ikaaro.utils import get_base_path_query
 from ikaaro.text import Text
+from ikaaro.web.multipart import UploadedFile
 
 
 class FreeTestCase(TestCase):
@@ -322,5 +329,223 @@ class FreeTestCase(TestCase):
                       ]))
 
 
+    def test_make_file_upload(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                container = root.make_resource('folder-test-upload', Folder)
+                # Kept in memory, then spooled to disk
+                for name, size in [('small.txt', 10), ('big.txt', 100000)]:
+                    data = 'x' * size
+                    body = UploadedFile(name, 'text/plain', 1024)
+                    body.write(data)
+                    body.seek(0)
+                    resource = container._make_file(name, name, 'text/plain',
+                                                    body, 'en')
+                    self.assertEqual(resource.get_value('filename'), name)
+                    handler = resource.get_value('data')
+                    self.assertEqual(handler.to_str(), data)
+                database.save_changes()
+                resource = root.get_resource('/folder-test-upload/big.txt')
+                self.assertEqual(len(resource.get_value('data').to_str()),
+                                 100000)
+
+
+
+    def test_commit_replaces_files(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                resource = root.make_resource('test-replace-files', Text,
+                                              data='old text')
+                database.save_changes()
+                handler = resource.get_value('data')
+                body = open_handler_file(get_handler_path(database, handler))
+                resource.set_value('data', 'new text')
+                database.save_changes()
+                # The file open is not changed by the commit
+                self.assertEqual(body.read(), 'old text')
+                body.close()
+                handler = resource.get_value('data')
+                path = get_handler_path(database, handler)
+                with open(path) as file:
+                    self.assertEqual(file.read(), 'new text')
+
+
+    def test_reader_cannot_change(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context(commit_at_exit=False,
+                                       write_lock=False) as context:
+                root = database.get_resource('/')
+                self.assertRaises(WriteLockRequired, root.make_resource,
+                                  'folder-test-reader', Folder)
+                self.assertRaises(WriteLockRequired, root.set_value,
+                                  'title', u'Reader')
+                self.assertEqual(context.write_lock_required, True)
+                self.assertEqual(database.has_changed, False)
+                self.assertEqual(
+                    root.get_resource('folder-test-reader', soft=True), None)
+
+
+    def test_graphs_updated_once_committed(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.dependencies = DependencyGraph()
+            with database.init_context():
+                root = database.get_resource('/')
+                root.make_resource('folder-test-graphs-1', Folder)
+                database.abort_changes()
+                self.assertEqual(database.dependencies.commits, 0)
+                root.make_resource('folder-test-graphs-2', Folder)
+                database.save_changes()
+                self.assertEqual(database.dependencies.commits, 1)
+
+
+
+
+class ReadWriteLockTestCase(TestCase):
+
+
+    def _worker(self, lock, events, name, write):
+        lock.acquire(write=write)
+        events.append(('in', name))
+        sleep(0.01)
+        events.append(('out', name))
+        lock.release()
+
+
+    def test_readers_share_the_lock(self):
+        lock = ReadWriteLock()
+        events = []
+        joinall([spawn(self._worker, lock, events, 'a', False),
+                 spawn(self._worker, lock, events, 'b', False)])
+        self.assertEqual(events, [('in', 'a'), ('in', 'b'),
+                                  ('out', 'a'), ('out', 'b')])
+
+
+    def test_writer_is_exclusive(self):
+        lock = ReadWriteLock()
+        events = []
+        joinall([spawn(self._worker, lock, events, 'a', False),
+                 spawn(self._worker, lock, events, 'w', True),
+                 spawn(self._worker, lock, events, 'b', False)])
+        self.assertEqual(events, [('in', 'a'), ('out', 'a'),
+                                  ('in', 'w'), ('out', 'w'),
+                                  ('in', 'b'), ('out', 'b')])
+
+
+
+class GroupCommitTestCase(TestCase):
+
+
+    def _writer(self):
+        DBSEM.acquire(write=True)
+        DBSEM.release()
+
+
+    def _start_group(self, database, resource):
+        """Change the resource, and commit the changes in a group, kept
+        waiting by another writer.
+        """
+        spawn(self._writer)
+        sleep(0)
+        resource.set_value('title', u'Group')
+        database.save_changes()
+        self.assertNotEqual(database.group, None)
+        return database.group
+
+
+    def test_abort_keeps_group(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.commit_window = 60
+            with database.init_context(group_commit=True):
+                root = database.get_resource('/')
+                first = root.make_resource('test-group-abort-1', Folder)
+                second = root.make_resource('test-group-abort-2', Folder)
+                database.save_changes()
+                group = self._start_group(database, first)
+                # Changes of the next transaction, aborted
+                first.set_value('title', u'Aborted')
+                second.set_value('title', u'Aborted')
+                database.abort_changes()
+                self.assertIs(database.group, group)
+                self.assertEqual(first.get_value('title'), u'Group')
+                self.assertNotEqual(second.get_value('title'), u'Aborted')
+                # The group is committed alone
+                database.flush_group()
+                self.assertEqual(group.wait(), True)
+                self.assertEqual(database.has_changed, False)
+                self.assertEqual(first.get_value('title'), u'Group')
+                self.assertNotEqual(second.get_value('title'), u'Aborted')
+
+
+    def test_aborted_change_commits_group(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.commit_window = 60
+            with database.init_context(group_commit=True):
+                root = database.get_resource('/')
+                first = root.make_resource('test-group-change-1', Folder)
+                second = root.make_resource('test-group-change-2', Folder)
+                database.save_changes()
+                group = self._start_group(database, first)
+                # A new resource cannot be undone alone, the group is
+                # committed first, but not the title set before
+                second.set_value('title', u'Aborted')
+                root.make_resource('test-group-change-3', Folder)
+                self.assertEqual(database.group, None)
+                self.assertEqual(group.wait(), True)
+                self.assertEqual(second.get_value('title'), u'Aborted')
+                database.abort_changes()
+                self.assertEqual(first.get_value('title'), u'Group')
+                self.assertNotEqual(second.get_value('title'), u'Aborted')
+                resource = root.get_resource('test-group-change-3', soft=True)
+                self.assertEqual(resource, None)
+
+
+    def test_batch(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                first = root.make_resource('test-batch-1', Folder)
+                second = root.make_resource('test-batch-2', Folder)
+                database.save_changes()
+                # A step kept, a step failing
+                database.start_batch_step()
+                first.set_value('title', u'Batch')
+                database.change_resource(first)
+                database.save_batch_step()
+                database.start_batch_step()
+                second.set_value('title', u'Failed')
+                database.abort_changes()
+                # One commit
+                database.flush_group()
+                self.assertEqual(database.has_changed, False)
+                database.abort_changes()
+                self.assertEqual(first.get_value('title'), u'Batch')
+                self.assertNotEqual(second.get_value('title'), u'Failed')
+
+
+    def test_reader_keeps_group(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.commit_window = 60
+            with database.init_context(group_commit=True) as context:
+                root = database.get_resource('/')
+                resource = root.make_resource('test-group-reader', Folder)
+                database.save_changes()
+                group = self._start_group(database, resource)
+                self.assertIs(context.commit_group, group)
+            # The reader reads the changes of the group, not committed yet
+            with database.init_context(commit_at_exit=False,
+                                       write_lock=False):
+                self.assertIs(database.group, group)
+                resource = database.get_resource('/test-group-reader')
+                self.assertEqual(resource.get_value('title'), u'Group')
+            # The other writers commit it first
+            with database.init_context():
+                self.assertEqual(database.group, None)
+            self.assertEqual(group.wait(), True)
+            self.assertEqual(database.has_changed, False)
+
+
+
 if __name__ == '__main__':
     main()
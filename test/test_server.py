@@ -15,16 +15,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from base64 import encodestring
+from datetime import datetime
+from json import loads
+from os import listdir, mkdir, rename
+from shutil import rmtree
+from smtplib import SMTPResponseException
 from StringIO import StringIO
+from tempfile import mkdtemp
+from time import time
 from unittest import TestCase, main
 
 # Import from itools
 from itools.database import PhraseQuery
 from itools.datatypes import String, Unicode
+from itools.handlers import TextFile
+from itools.web.exceptions import BadRequest
 from itools.web.views import ItoolsView, BaseView
 
 # Import from ikaaro
+from ikaaro.database import CommitGroup, open_handler_file
+from ikaaro.dependencies import DependencyGraph
+from ikaaro.jobs import Job, JobQueue, register_job
+from ikaaro.logtail import read_log
+from ikaaro.profiling import RequestProfiler
+from ikaaro.scheduler import TimeEventScheduler
 from ikaaro.server import Server
+from ikaaro.spool import MailSpool
+from ikaaro.textcache import TextCache
+from ikaaro.textextract import ExtractionError, TextExtractor
+from ikaaro.textindex import TextIndexer
+from ikaaro.web.admission import AdmissionControl
+from ikaaro.web.multipart import MultipartParser
+from ikaaro.web.ranges import FileSlice, get_file_etag, match_etags
+from ikaaro.web.ranges import parse_range
+from ikaaro.web.ratelimit import RateLimiter
+from ikaaro.web.uploads import UploadStats
+from ikaaro.workers import ReaderApplication
 
 
 class TestHTML_View(ItoolsView):
@@ -227,5 +254,711 @@ class ServerTestCase(TestCase):
 
 
 
+
+class MultipartTestCase(TestCase):
+
+    body = (
+        '--boundary\r\n'
+        'Content-Disposition: form-data; name="title"\r\n'
+        '\r\n'
+        'My file\r\n'
+        '--boundary\r\n'
+        'Content-Disposition: form-data; name="data"; filename="file.txt"\r\n'
+        'Content-Type: text/plain\r\n'
+        '\r\n'
+        'hello world\r\n'
+        '--boundary--\r\n')
+
+    def parse(self, chunk_size, spool_threshold=1024, on_read=None):
+        parser = MultipartParser(StringIO(self.body), len(self.body),
+                                 'boundary', spool_threshold, on_read=on_read)
+        parser.chunk_size = chunk_size
+        return parser.parse()
+
+
+    def test_parse(self):
+        # Small chunks, the delimiters are split across reads
+        for chunk_size in (3, 16, 65536):
+            form = self.parse(chunk_size, spool_threshold=4)
+            self.assertEqual(form['title'], 'My file')
+            filename, mimetype, body = form['data']
+            self.assertEqual(filename, 'file.txt')
+            self.assertEqual(mimetype, 'text/plain')
+            self.assertEqual(body.read(), 'hello world')
+
+
+    def test_no_content_disposition(self):
+        body = ('--boundary\r\n'
+                'Content-Type: text/plain\r\n'
+                '\r\n'
+                'hello world\r\n'
+                '--boundary--\r\n')
+        parser = MultipartParser(StringIO(body), len(body), 'boundary', 1024)
+        self.assertRaises(BadRequest, parser.parse)
+
+
+    def test_upload_stats(self):
+        stats = UploadStats()
+        stats.start(1, len(self.body))
+        self.parse(16, on_read=lambda size: stats.update(1, size))
+        stats.finish(1)
+        self.assertEqual(stats.get(1), (len(self.body), len(self.body)))
+        # Finished uploads expire
+        stats.ttl = -1
+        stats.clean()
+        self.assertEqual(stats.get(1), None)
+
+
+
+class RequestProfilerTestCase(TestCase):
+
+    def test_match(self):
+        environ = {'PATH_INFO': '/users/;edit'}
+        profiler = RequestProfiler('/tmp/profile', views=['edit'])
+        self.assertTrue(profiler.match(environ))
+        self.assertFalse(profiler.match({'PATH_INFO': '/'}))
+        # Only the minimum time: sample the requests all the same
+        profiler = RequestProfiler('/tmp/profile', min_time=100)
+        self.assertTrue(profiler.is_enabled())
+        matches = [ profiler.match(environ) for i in range(200) ]
+        self.assertEqual(matches.count(True), 2)
+
+
+
+class RangeTestCase(TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range('bytes=900-', 1000), [(900, 999)])
+        self.assertEqual(parse_range('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_range('bytes=0-1,5-9', 10), [(0, 1), (5, 9)])
+        self.assertEqual(parse_range('bytes=500-2000', 1000), [(500, 999)])
+        # Not satisfiable
+        self.assertEqual(parse_range('bytes=1000-', 1000), [])
+        # Ignored
+        self.assertEqual(parse_range(None, 1000), None)
+        self.assertEqual(parse_range('items=0-1', 1000), None)
+        self.assertEqual(parse_range('bytes=5-1', 1000), None)
+        self.assertEqual(parse_range('bytes=a-b', 1000), None)
+
+
+    def test_match_etags(self):
+        self.assertTrue(match_etags('"abc"', '"abc"'))
+        self.assertTrue(match_etags('"x", W/"abc"', '"abc"'))
+        self.assertTrue(match_etags('*', '"abc"'))
+        self.assertFalse(match_etags('"x"', '"abc"'))
+
+
+    def test_file_slice(self):
+        body = FileSlice(StringIO('0123456789'), 2, 5)
+        self.assertEqual(len(body), 4)
+        self.assertEqual(body.read(3), '234')
+        self.assertEqual(body.read(), '5')
+        self.assertEqual(body.read(), '')
+
+
+    def test_file_etag(self):
+        folder = mkdtemp()
+        try:
+            path = '%s/file' % folder
+            with open(path, 'wb') as file:
+                file.write('0123456789')
+            etag = get_file_etag(path)
+            self.assertEqual(get_file_etag(path), etag)
+            # Replaced (as by Database.replace_handler_file)
+            with open('%s.tmp' % path, 'wb') as file:
+                file.write('0123456789')
+            rename('%s.tmp' % path, path)
+            self.assertNotEqual(get_file_etag(path), etag)
+        finally:
+            rmtree(folder)
+
+
+    def test_handler_file(self):
+        folder = mkdtemp()
+        try:
+            path = '%s/file' % folder
+            with open(path, 'wb') as file:
+                file.write('0123456789')
+            body = open_handler_file(path)
+            # The file is replaced (as by Database.replace_handler_file)
+            with open('%s.tmp' % path, 'wb') as file:
+                file.write('abc')
+            rename('%s.tmp' % path, path)
+            self.assertEqual(body.read(), '0123456789')
+            body.close()
+        finally:
+            rmtree(folder)
+
+
+
+class AdmissionTestCase(TestCase):
+
+    def test_get_budget(self):
+        admission = AdmissionControl({})
+        self.assertFalse(admission.is_enabled())
+        get_budget = lambda **kw: admission.get_budget(kw).name
+        self.assertEqual(get_budget(PATH_INFO='/api/status',
+                                    REQUEST_METHOD='GET'), 'api')
+        self.assertEqual(get_budget(PATH_INFO='/', REQUEST_METHOD='GET'),
+                         'anonymous')
+        # The credentials are not known to be valid yet
+        environ = {'PATH_INFO': '/', 'REQUEST_METHOD': 'GET',
+                   'HTTP_COOKIE': 'iauth="xxx"'}
+        self.assertEqual(get_budget(**environ), 'anonymous')
+        admission.verify(environ, True)
+        self.assertEqual(get_budget(**environ), 'authenticated')
+        admission.verify(environ, False)
+        self.assertEqual(get_budget(**environ), 'anonymous')
+        self.assertEqual(get_budget(PATH_INFO='/', REQUEST_METHOD='GET',
+                                    HTTP_AUTHORIZATION='Basic xxx'),
+                         'anonymous')
+        self.assertEqual(get_budget(PATH_INFO='/;login',
+                                    REQUEST_METHOD='POST'), 'authenticated')
+
+
+    def test_reject(self):
+        admission = AdmissionControl({'anonymous': (1, 0, 1)})
+        self.assertTrue(admission.is_enabled())
+        budget = admission.budgets['anonymous']
+        self.assertTrue(budget.acquire())
+        # No room in the queue
+        self.assertFalse(budget.acquire())
+        self.assertEqual(budget.rejected, 1)
+        budget.release()
+        self.assertTrue(budget.acquire())
+        budget.release()
+        self.assertEqual(budget.active, 0)
+
+
+
+class RateLimitTestCase(TestCase):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter({'login': (60, 2)})
+        environ = {'PATH_INFO': '/;login', 'REMOTE_ADDR': '10.0.0.1'}
+        self.assertEqual(limiter.check(environ), 0)
+        self.assertEqual(limiter.check(environ), 0)
+        # No token left, wait for the next one (one second)
+        self.assertTrue(0 < limiter.check(environ) <= 1)
+        # Another client
+        environ['HTTP_X_FORWARDED_FOR'] = '10.0.0.2, 10.0.0.1'
+        self.assertEqual(limiter.check(environ), 0)
+        # Other requests are not limited
+        self.assertEqual(limiter.check({'PATH_INFO': '/'}), 0)
+        stats = limiter.get_stats()[0]
+        self.assertEqual(stats['allowed'], 3)
+        self.assertEqual(stats['limited'], 1)
+
+
+    def test_by_user(self):
+        verified = {}
+        limiter = RateLimiter({'api': (60, 1)}, by_user=True,
+                              verified=verified)
+        credentials = 'Basic %s' % encodestring('0:token').strip()
+        environ = {'PATH_INFO': '/api/', 'REMOTE_ADDR': '10.0.0.1',
+                   'HTTP_AUTHORIZATION': credentials}
+        self.assertEqual(limiter.check(environ), 0)
+        # Credentials not verified yet: counted by address
+        environ['HTTP_AUTHORIZATION'] = 'Basic %s' % encodestring('1:x').strip()
+        self.assertTrue(limiter.check(environ) > 0)
+        # Verified: counted by user
+        verified[credentials] = True
+        environ['HTTP_AUTHORIZATION'] = credentials
+        self.assertEqual(limiter.check(environ), 0)
+
+
+
+class ReaderApplicationTestCase(TestCase):
+
+    def test_forwarded_for(self):
+        reader = ReaderApplication('/tmp/writer.sock')
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_CONNECTION': 'close',
+                   'HTTP_COOKIE': 'a=b'}
+        headers = reader.get_request_headers(environ)
+        self.assertEqual(headers, {'Cookie': 'a=b',
+                                   'X-Forwarded-For': '10.0.0.1'})
+        environ['HTTP_X_FORWARDED_FOR'] = '10.0.0.2'
+        headers = reader.get_request_headers(environ)
+        self.assertEqual(headers['X-Forwarded-For'], '10.0.0.2, 10.0.0.1')
+
+
+
+class FakeSMTP(object):
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.sent = []
+
+
+    def sendmail(self, from_addr, to_addr, message):
+        error = self.errors.pop(0) if self.errors else None
+        if error:
+            raise SMTPResponseException(error, 'Error')
+        self.sent.append(to_addr)
+
+
+
+class MailSpoolTestCase(TestCase):
+
+    message = 'From: a@example.com\nTo: b@example.com\nSubject: Hi\n\nHi'
+
+    def setUp(self):
+        self.path = mkdtemp()
+        mkdir('%s/failed' % self.path)
+        for name in ('1', '2'):
+            with open('%s/%s' % (self.path, name), 'w') as file:
+                file.write(self.message)
+        self.spool = MailSpool(self.path, 'localhost', max_retries=1)
+        self.spool.recover()
+
+
+    def tearDown(self):
+        rmtree(self.path)
+
+
+    def flush(self, errors=()):
+        smtp = self.spool.smtp = FakeSMTP(errors)
+        self.spool.last_used = time()
+        self.spool.flush()
+        return smtp
+
+
+    def test_send(self):
+        smtp = self.flush()
+        self.assertEqual(len(smtp.sent), 2)
+        self.assertEqual(self.spool.get_size(), 0)
+        self.assertEqual(self.spool.sent, 2)
+
+
+    def test_add_known(self):
+        # Already queued, or being sent: not queued twice
+        self.spool.add('1')
+        self.assertEqual(len(self.spool.queue), 2)
+        self.spool.queue.popleft()
+        self.spool.add('1')
+        self.spool.recover()
+        self.assertEqual(len(self.spool.queue), 1)
+
+
+    def test_sent_times(self):
+        # Pruned when sending, not only when the metrics are read
+        self.spool.sent_times.append(time() - 120)
+        self.flush()
+        self.assertEqual(len(self.spool.sent_times), 2)
+
+
+    def test_retry(self):
+        # Temporary error, the message waits
+        self.flush(errors=[451])
+        self.assertEqual(self.spool.sent, 1)
+        self.assertEqual(self.spool.get_size(), 1)
+        self.assertEqual(len(self.spool.queue), 0)
+        # Retry too many times
+        name = self.spool.waiting.keys()[0]
+        self.spool.waiting[name] = 0
+        self.flush(errors=[451])
+        self.assertEqual(self.spool.get_size(), 0)
+        self.assertEqual(listdir('%s/failed' % self.path), [name])
+
+
+    def test_add(self):
+        self.flush()
+        with open('%s/3' % self.path, 'w') as file:
+            file.write(self.message)
+        # Nothing to do (once the connection is closed)
+        self.spool.smtp = None
+        self.assertEqual(self.spool.get_timeout(), None)
+        self.spool.add('3')
+        self.assertEqual(self.spool.get_timeout(), 0)
+        smtp = self.flush()
+        self.assertEqual(len(smtp.sent), 1)
+
+
+    def test_permanent_error(self):
+        self.flush(errors=[550])
+        self.assertEqual(self.spool.failed, 1)
+        self.assertEqual(len(listdir('%s/failed' % self.path)), 1)
+
+
+
+class SchedulerTestCase(TestCase):
+
+    def test_heap(self):
+        scheduler = TimeEventScheduler(None)
+        now = time()
+        in_an_hour = datetime.utcfromtimestamp(now + 3600)
+        a_minute_ago = datetime.utcfromtimestamp(now - 60)
+        # Nothing to do
+        self.assertEqual(scheduler.get_timeout(), None)
+        scheduler.update('/a', in_an_hour)
+        self.assertTrue(3590 < scheduler.get_timeout() <= 3600)
+        # Due
+        scheduler.update('/b', a_minute_ago)
+        self.assertEqual(scheduler.get_timeout(), 0)
+        scheduler.pop_due(now)
+        self.assertEqual(scheduler.times.keys(), ['/a'])
+        # Moved (the old item of the heap is skipped)
+        scheduler.update('/a', None)
+        self.assertEqual(scheduler.get_timeout(), None)
+
+
+    def test_failed(self):
+        scheduler = TimeEventScheduler(None)
+        scheduler.failed('/a')
+        self.assertTrue(scheduler.is_failing('/a', time()))
+        # Not before the delay
+        scheduler.update('/a', datetime.utcfromtimestamp(time()))
+        self.assertTrue(scheduler.get_timeout() > 50)
+        scheduler.succeeded('/a')
+        self.assertFalse(scheduler.is_failing('/a', time()))
+
+
+
+class DependencyGraphTestCase(TestCase):
+
+    def test_walk(self):
+        graph = DependencyGraph()
+        graph.update('/b', ['/a'])
+        graph.update('/c', ['/b'])
+        graph.update('/d', '/c')
+        self.assertEqual(graph.get_dependents(['/b']), set(['/c', '/d']))
+        # Cycles are fine
+        graph.update('/a', ['/d'])
+        self.assertEqual(graph.get_dependents(['/b']),
+                         set(['/a', '/b', '/c', '/d']))
+        self.assertEqual(graph.get_dependents(['/e']), set())
+
+
+    def test_update(self):
+        graph = DependencyGraph()
+        graph.update('/b', ['/a'])
+        graph.update('/b', ['/c'])
+        self.assertEqual(graph.get_dependents(['/a']), set())
+        self.assertEqual(graph.get_dependents(['/c']), set(['/b']))
+        graph.remove('/b')
+        self.assertEqual(graph.dependents, {})
+        self.assertEqual(graph.targets, {})
+
+
+
+class TextIndexerTestCase(TestCase):
+
+    def test_defer(self):
+        indexer = TextIndexer()
+        values = {'abspath': '/a'}
+        indexer.defer(None, values)
+        self.assertEqual(values, {'abspath': '/a', 'text_pending': True})
+        self.assertEqual(indexer.get_size(), 1)
+        self.assertTrue(indexer.get_lag() >= 0)
+        # Extracted by the indexer
+        indexer.texts = {'/a': u'Hello'}
+        values = {'abspath': '/a'}
+        indexer.defer(None, values)
+        self.assertEqual(values, {'abspath': '/a', 'text': u'Hello'})
+
+
+
+class FakeHandler(object):
+
+    database = None
+    key = None
+
+    def to_str(self):
+        return 'Hello world'
+
+
+    def get_mimetype(self):
+        return 'application/pdf'
+
+
+
+class TextExtractorTestCase(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+
+
+    def tearDown(self):
+        rmtree(self.path)
+
+
+    def test_max_size(self):
+        log = '%s/extraction' % self.path
+        extractor = TextExtractor(log, 1, max_size=5)
+        text = extractor.extract_text(FakeHandler(), '/a.pdf')
+        self.assertEqual(text, None)
+        self.assertEqual(extractor.skipped, 1)
+        # Reported
+        with open(log) as file:
+            entry = loads(file.read())
+        self.assertEqual(entry['abspath'], '/a.pdf')
+        self.assertEqual(entry['size'], 11)
+        self.assertEqual(entry['error'], 'too big')
+
+
+    def test_max_size_on_disk(self):
+        path = '%s/a.pdf' % self.path
+        with open(path, 'w') as file:
+            file.write('Hello world')
+        handler = FakeHandler()
+        handler.database = self
+        handler.key = path
+        handler.to_str = None
+        # Not loaded
+        extractor = TextExtractor('%s/extraction' % self.path, 1,
+                                  max_size=5)
+        self.assertEqual(extractor.extract_text(handler, '/a.pdf'), None)
+        self.assertEqual(extractor.skipped, 1)
+
+
+    def test_workers_reused(self):
+        extractor = TextExtractor('%s/extraction' % self.path, 1)
+        extractor.max_documents = 2
+        self.assertEqual(extractor.extract(TextFile, 'Hello'), u'Hello')
+        worker = extractor.workers[0]
+        self.assertEqual(extractor.extract(TextFile, 'world'), u'world')
+        self.assertEqual(worker.documents, 2)
+        # Replaced after max_documents
+        self.assertEqual(extractor.workers, [])
+        self.assertNotEqual(worker.process.poll(), None)
+        # A failure does not stop the worker
+        self.assertRaises(ExtractionError, extractor.extract, TextFile,
+                          '\xff')
+        self.assertEqual(len(extractor.workers), 1)
+        extractor.close()
+        self.assertEqual(extractor.workers, [])
+
+
+
+class TextCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+
+
+    def tearDown(self):
+        rmtree(self.path)
+
+
+    def test_cache(self):
+        cache = TextCache('%s/text_cache' % self.path, 1024)
+        key = cache.get_key(None, FakeHandler())
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, u'Hello world')
+        self.assertEqual(cache.get(key), u'Hello world')
+        # Persistent
+        cache = TextCache('%s/text_cache' % self.path, 1024)
+        self.assertEqual(cache.get(key), u'Hello world')
+
+
+    def test_evict(self):
+        cache = TextCache('%s/text_cache' % self.path, 100)
+        for i in range(10):
+            cache.put('%040d' % i, u'%d' % i * 100)
+        self.assertTrue(cache.size <= 100)
+        self.assertTrue(cache.evictions > 0)
+        # The last one is kept
+        self.assertEqual(cache.get('%040d' % 9), u'9' * 100)
+
+
+    def test_sweep(self):
+        cache = TextCache('%s/text_cache' % self.path, 1024)
+        cache.put('%040d' % 1, u'one')
+        cache.put('%040d' % 2, u'two')
+        cache.start_sweep()
+        cache.get('%040d' % 1)
+        cache.end_sweep()
+        self.assertEqual(cache.entries.keys(), ['%040d' % 1])
+
+
+
+def count_job(context, job, n=1):
+    for i in range(n):
+        job.progress(i + 1, n)
+    return {'n': n}
+
+register_job('count', count_job)
+
+
+
+class JobQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.jobs = JobQueue('%s/jobs' % self.path)
+
+
+    def tearDown(self):
+        rmtree(self.path)
+
+
+    def test_add(self):
+        job_id = self.jobs.add('count', u'Count', user='0', data='x', n=3)
+        job = self.jobs.get_job(job_id)
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(job['kwargs'], {'n': 3})
+        self.assertEqual(open(self.jobs.get_path(job_id, 'data')).read(), 'x')
+        self.assertEqual(list(self.jobs.queue), [job_id])
+        self.assertEqual(self.jobs.get_job('../x'), None)
+        self.assertRaises(ValueError, self.jobs.add, 'unknown', u'Unknown')
+
+
+    def test_cancel(self):
+        job_id = self.jobs.add('count', u'Count')
+        self.jobs.cancel(job_id)
+        self.assertEqual(self.jobs.get_job(job_id)['status'], 'cancelled')
+        # Not run
+        self.jobs.run_job(job_id)
+        self.assertEqual(self.jobs.get_job(job_id)['status'], 'cancelled')
+
+
+    def test_recover(self):
+        queued = self.jobs.add('count', u'Count')
+        running = self.jobs.add('count', u'Count')
+        job = self.jobs.get_job(running)
+        job['status'] = 'running'
+        self.jobs.save(job)
+        # Restart
+        jobs = JobQueue(self.jobs.path)
+        jobs.recover()
+        self.assertEqual(list(jobs.queue), [queued])
+        self.assertEqual(jobs.get_job(running)['status'], 'interrupted')
+
+
+
+class JobTestCase(TestCase):
+
+    def test_reindex_catalog(self):
+        # Pause at every resource
+        yield_interval = Job.yield_interval
+        Job.yield_interval = 0
+        try:
+            with Server('demo.hforge.org') as server:
+                jobs = server.jobs
+                job_id = jobs.add('reindex_catalog', u'Reindex the catalog')
+                jobs.run_job(job_id)
+                record = jobs.get_job(job_id)
+        finally:
+            Job.yield_interval = yield_interval
+        self.assertEqual(record['status'], 'done')
+        self.assertTrue(record['result']['n'] > 0)
+        self.assertEqual(record['done'], record['total'])
+
+
+    def test_failing_update(self):
+        import ikaaro.update
+        versions = [{'cls_to_update': [{}], 'cls_errors': []}]
+        def find_versions_to_update(context, force=False):
+            return versions.pop(0)
+        def run_next_update_method(context, force=False, progress=None):
+            return ['ERROR: "/" - class_id: "iKaaro"\n']
+        old_find = ikaaro.update.find_versions_to_update
+        old_run = ikaaro.update.run_next_update_method
+        ikaaro.update.find_versions_to_update = find_versions_to_update
+        ikaaro.update.run_next_update_method = run_next_update_method
+        try:
+            with Server('demo.hforge.org') as server:
+                jobs = server.jobs
+                job_id = jobs.add('update_instance', u'Update instance')
+                jobs.run_job(job_id)
+                record = jobs.get_job(job_id)
+        finally:
+            ikaaro.update.find_versions_to_update = old_find
+            ikaaro.update.run_next_update_method = old_run
+        self.assertEqual(record['status'], 'done')
+        self.assertEqual(record['result'],
+                         [u'Error during update method. See logs.',
+                          u'ERROR: "/" - class_id: "iKaaro"\n'])
+
+
+
+class LogTailTestCase(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.log = '%s/log' % self.path
+        with open(self.log, 'w') as file:
+            for i in range(10000):
+                file.write('line %d %s\n' % (i, 'even' if i % 2 else 'odd'))
+            # Being written
+            file.write('line 10000')
+
+
+    def tearDown(self):
+        rmtree(self.path)
+
+
+    def read(self, **kw):
+        offset, data = read_log(self.log, **kw)
+        return offset, ''.join(data).splitlines()
+
+
+    def test_tail(self):
+        offset, lines = self.read(tail=3)
+        self.assertEqual(lines, ['line 9997 even', 'line 9998 odd',
+                                 'line 9999 even'])
+        self.assertEqual(offset, len(open(self.log).read()) - 10)
+        # Follow
+        with open(self.log, 'a') as file:
+            file.write(' odd\n')
+        self.assertEqual(self.read(since=offset), (offset + 15,
+                                                   ['line 10000 odd']))
+        # Rotated
+        self.assertEqual(len(self.read(since=10 ** 9)[1]), 10001)
+
+
+    def test_grep(self):
+        offset, lines = self.read(tail=2, grep='9 even')
+        self.assertEqual(lines, ['line 9989 even', 'line 9999 even'])
+        offset, lines = self.read(since=0, grep='99 even')
+        self.assertEqual(len(lines), 100)
+
+
+
+class FakeResource(object):
+
+    def __init__(self, abspath):
+        self.abspath = abspath
+
+
+
+class CommitGroupTestCase(TestCase):
+
+    def test_one(self):
+        group = CommitGroup()
+        data = (('0', 'a@example.com'), 1, 'POST /a', [], [])
+        group.add(data)
+        self.assertEqual(group.get_data(), data)
+
+
+    def test_merge(self):
+        a, b = FakeResource('/a'), FakeResource('/b')
+        group = CommitGroup()
+        group.add((('0', 'a@example.com'), 1, 'POST /a',
+                   [(a, {'abspath': '/a'}), (b, {'abspath': '/b'})], []))
+        group.add((('1', u'b@example.com'), 2, None,
+                   [(b, {'abspath': '/b', 'title': 'b'})], ['/a']))
+        author, date, message, to_index, to_unindex = group.get_data()
+        self.assertEqual(author, ('0', 'a@example.com'))
+        self.assertEqual(date, 2)
+        self.assertEqual(message.splitlines(), [
+            'Group commit of 2 transactions',
+            '',
+            '0 <a@example.com>: POST /a',
+            '1 <b@example.com>: no comment',
+            '',
+            'Co-authored-by: 1 <b@example.com>'])
+        self.assertEqual(to_index, [(b, {'abspath': '/b', 'title': 'b'})])
+        self.assertEqual(to_unindex, ['/a'])
+
+
+    def test_done(self):
+        group = CommitGroup()
+        group.done(RuntimeError('aborted'))
+        self.assertFalse(group.wait())
+
+
+
 if __name__ == '__main__':
     main()